@@ -0,0 +1,195 @@
+# library export and import for the freezam project
+# Graham Arthur (garthur), Carnegie Mellon University
+
+import io
+import json
+import logging
+import zipfile
+
+import numpy as np
+
+import fzdb
+import fzio
+
+logger = logging.getLogger("fz.archive")
+
+# archives are zip files of columns, stored without compression since the
+# signatures are floats and the audio is already compressed:
+#   format.json          the format version, song count, contents and the 
+#                        posfreq settings (see fzdb.hash_settings)
+#   library.json         the library rows, one list per column
+#   sigs/<type>.bin      packed float32 signatures (see fzio.pack_signature)
+#   sigs/<type>.npy      the (offset, length, n_frames, n_dims) of each song,
+#                        length -1 if the song has no signature of that type
+#   audio.bin            stored audio, in the compact storage format
+#   audio.npy            the (offset, length) of each song's audio, -1 if none
+ARCHIVE_FORMAT = 2
+COLUMNS = ["song_id", "title", "artist", "album", "date", "length"]
+SIG_TYPES = ["maxpow", "posfreq"]
+
+def chunks(items, size):
+    """
+    splits a list of items into lists of at most size items
+    """
+    for k in range(0, len(items), size):
+        yield items[k:k + size]
+
+def save_array(archive, name, array):
+    """
+    writes a numpy array into the archive as a .npy entry
+    """
+    buf = io.BytesIO()
+    np.save(buf, array)
+    archive.writestr(name, buf.getvalue())
+
+def load_array(archive, name):
+    """
+    reads a .npy entry of the archive into memory
+    """
+    with archive.open(name) as f:
+        return np.load(io.BytesIO(f.read()))
+
+# EXPORT
+
+def export_library(databaser, location, audio=True, chunk_size=500):
+    """
+    exports every song in a databaser to an archive at location, with its
+    signatures and, if audio is set, its stored audio. each column is
+    streamed into the archive in turn, so nothing is decoded or analysed
+    and only a chunk of songs is in memory at once. songs that lose a 
+    signature on the way, like songs removed during the export, are marked
+    as missing it and left out on import. returns the number of songs 
+    exported with every signature
+    """
+    rows = list(databaser.iterate())
+    song_ids = [row[0] for row in rows]
+    logger.info("exporting %d songs to %s", len(rows), location)
+    with zipfile.ZipFile(location, "w", zipfile.ZIP_STORED, allowZip64=True) as archive:
+        archive.writestr("library.json", json.dumps(
+            dict((column, [row[k] for row in rows]) for k, column in enumerate(COLUMNS)),
+            default=float))
+        del rows
+
+        missing = set()
+        for sig_type in SIG_TYPES:
+            index = np.zeros((len(song_ids), 4), dtype=np.int64)
+            offset, k = 0, 0
+            with archive.open("sigs/" + sig_type + ".bin", "w", force_zip64=True) as output:
+                for chunk in chunks(song_ids, chunk_size):
+                    sigs = dict(databaser.iterate_signatures(sig_type, chunk))
+                    for song_id in chunk:
+                        if song_id not in sigs:
+                            logger.warning("song %s has no %s signature, it won't be imported",
+                                           song_id, sig_type)
+                            missing.add(song_id)
+                            index[k] = (offset, -1, 0, 0)
+                            k += 1
+                            continue
+                        buf, n_frames, n_dims = fzio.pack_signature(sigs[song_id])
+                        output.write(buf)
+                        index[k] = (offset, len(buf), n_frames, n_dims)
+                        offset, k = offset + len(buf), k + 1
+            save_array(archive, "sigs/" + sig_type + ".npy", index)
+
+        if audio:
+            index = np.full((len(song_ids), 2), -1, dtype=np.int64)
+            offset, k = 0, 0
+            with archive.open("audio.bin", "w", force_zip64=True) as output:
+                for chunk in chunks(song_ids, chunk_size):
+                    found = dict(databaser.iterate_audio(chunk))
+                    for song_id in chunk:
+                        if found.get(song_id) is not None:
+                            output.write(found[song_id])
+                            index[k] = (offset, len(found[song_id]))
+                            offset += len(found[song_id])
+                        k += 1
+            save_array(archive, "audio.npy", index)
+
+        archive.writestr("format.json", json.dumps({
+            "format": ARCHIVE_FORMAT, "n_songs": len(song_ids),
+            "signatures": SIG_TYPES, "audio": audio,
+            "posfreq": fzdb.hash_settings(databaser.params)}))
+    logger.info("%d songs exported!", len(song_ids) - len(missing))
+    return len(song_ids) - len(missing)
+
+# IMPORT
+
+def read_format(location):
+    """
+    reads the format.json of an archive at location, refusing archives 
+    newer than this freezam
+    """
+    with zipfile.ZipFile(location, "r") as archive:
+        with archive.open("format.json") as f:
+            fmt = json.load(f)
+    if (fmt["format"] > ARCHIVE_FORMAT):
+        logger.error("archive format %s is newer than this freezam", fmt["format"])
+        raise Exception("archive format " + str(fmt["format"]) + " is newer than this freezam")
+    return fmt
+
+def read_archive(location, chunk_size=500):
+    """
+    reads an archive at location, yielding lists of at most chunk_size
+    library records (see fzdb.song_record) in the order they were exported.
+    a signature the song was exported without is None
+    """
+    fmt = read_format(location)
+    with zipfile.ZipFile(location, "r") as archive:
+        with archive.open("library.json") as f:
+            library = json.load(f)
+        rows = list(zip(*[library[column] for column in COLUMNS]))
+        del library
+
+        # every column is read front to back, alongside the others
+        streams = dict((sig_type, (archive.open("sigs/" + sig_type + ".bin"),
+                                   load_array(archive, "sigs/" + sig_type + ".npy")))
+                       for sig_type in fmt["signatures"])
+        if fmt["audio"]:
+            streams["audio"] = (archive.open("audio.bin"), load_array(archive, "audio.npy"))
+        try:
+            for start in range(0, len(rows), chunk_size):
+                records = []
+                for k in range(start, min(start + chunk_size, len(rows))):
+                    sigs = {}
+                    for sig_type in fmt["signatures"]:
+                        stream, index = streams[sig_type]
+                        _, length, n_frames, n_dims = index[k]
+                        if (length < 0):
+                            sigs[sig_type] = None
+                            continue
+                        sigs[sig_type] = fzio.unpack_signature(stream.read(int(length)),
+                                                               int(n_frames), int(n_dims))
+                    audio = None
+                    if fmt["audio"] and streams["audio"][1][k][1] >= 0:
+                        audio = streams["audio"][0].read(int(streams["audio"][1][k][1]))
+                    records.append({"song": list(rows[k]), "sigs": sigs, "audio": audio})
+                yield records
+        finally:
+            for stream, _ in streams.values():
+                stream.close()
+
+def import_library(databaser, location, chunk_size=500):
+    """
+    imports the songs in an archive at location into a databaser, through
+    its bulk write path. songs that are already in the library, or that 
+    were exported without a signature, are skipped. archives made with 
+    other posfreq settings than the databaser's are refused (see 
+    fzdb.check_hash_settings). returns the number of songs imported
+    """
+    fmt = read_format(location)
+    if ("posfreq" in fmt):
+        fzdb.check_hash_settings([fmt["posfreq"][key] for key in 
+                                  fzdb.hash_settings(databaser.params)], databaser.params)
+    existing = set(row[0] for row in databaser.iterate())
+    imported = 0
+    for records in read_archive(location, chunk_size):
+        for record in records:
+            if any(sig is None for sig in record["sigs"].values()):
+                logger.warning("song %s was exported without a signature, skipping it",
+                               record["song"][0])
+        records = [record for record in records if record["song"][0] not in existing
+                   and all(sig is not None for sig in record["sigs"].values())]
+        if records:
+            imported += len(databaser.write_records(records))
+            logger.info("%d songs imported...", imported)
+    return imported
@@ -3,13 +3,25 @@
 
 import os
 import sys
+import csv
 import json
+import time
+import pickle
+import shutil
 import argparse
+import tempfile
 import logging
+import concurrent.futures
 import tabulate
 
 import fzsong
 import fzdb
+import fzarchive
+import fzdedupe
+import fzeval
+import fzindex
+import fzingest
+import fzlog
 
 class Freezam(object):
 
@@ -17,6 +29,7 @@ class Freezam(object):
         # initial locations
         self.root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
         self.log_file = os.path.join(self.root, "temp" + os.sep + "freezam.log")
+        self.cache_file = os.path.join(self.root, "temp" + os.sep + "fz_result_cache.pkl")
         
         # get settings
         self.db_settings = os.path.join(self.root,"settings" + os.sep + "db.json")
@@ -25,6 +38,7 @@ class Freezam(object):
         self.parameters = os.path.join(self.root, "settings" + os.sep + "param.json")
         with open(self.parameters) as p:
             self.parameters = json.load(p)
+        self.analysis = fzsong.get_analysis(self.parameters)
 
         # set up argument parsing
         parser = argparse.ArgumentParser(
@@ -33,6 +47,10 @@ class Freezam(object):
         parser.add_argument("-v", "--verbose", action="store_true", 
             help="activates verbose logging"
         )
+        parser.add_argument("--log-level", type=str.upper, default=None,
+            choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+            help="lowest level of messages logged, overriding the logging settings"
+        )
         subparsers = parser.add_subparsers()
 
         # parser for add subcommand
@@ -50,7 +68,14 @@ class Freezam(object):
         parser_ingest = subparsers.add_parser("ingest")
         parser_ingest.set_defaults(subcommand = self.ingest)
         parser_ingest.add_argument("dir", type=str,
-            help="directory from which to add songs to the library"
+            help="directory from which to add songs to the library, or a " +
+                 "manifest file with one song location (file or url) per line"
+        )
+        parser_ingest.add_argument("--jobs", type=int, default=os.cpu_count(),
+            help="number of processes used to analyse songs"
+        )
+        parser_ingest.add_argument("--queue", type=int, default=8,
+            help="maximum number of songs waiting between pipeline stages"
         )
         
         # parser for remove subcommand
@@ -61,17 +86,143 @@ class Freezam(object):
         # parser for identify subcommand
         parser_identify = subparsers.add_parser("identify")
         parser_identify.set_defaults(subcommand = self.identify)
-        parser_identify.add_argument("snippet", type=str, 
+        parser_identify.add_argument("snippet", type=str, nargs="?",
             help="location of the snippet to be identified"
         )
+        parser_identify.add_argument("--batch", type=str, default=None,
+            help="directory of snippets, or manifest file with one snippet " +
+                 "location per line, to identify in one pass over the library"
+        )
+        parser_identify.add_argument("--jobs", type=int, default=os.cpu_count(),
+            help="number of processes used to analyse snippets, and to search the " +
+                 "signature index, in batch mode"
+        )
         parser_identify.add_argument("--slow", action="store_true", default=False,
-            help="performs a slow linear search, for testing purposes"
+            help="performs a slow linear search, even when the search sig_type is posfreq"
+        )
+        parser_identify.add_argument("--progressive", action="store_true", default=False,
+            help="reads the snippet a second at a time, stopping once the best " +
+                 "match is confident"
         )
         parser_identify.add_argument("--matches", type=int, default=1)
+        parser_identify.add_argument("--no-cache", action="store_true", default=False,
+            help="always searches the library, without the cache of recent results"
+        )
+        parser_identify.add_argument("--cache-stats", action="store_true", default=False,
+            help="prints the hit and miss counters of the result cache"
+        )
         
+        # parser for lookup subcommand
+        parser_lookup = subparsers.add_parser("lookup")
+        parser_lookup.set_defaults(subcommand = self.lookup)
+        parser_lookup.add_argument("--title", type=str, help="song title", default=None)
+        parser_lookup.add_argument("--artist", type=str, help="artist name", default=None)
+        parser_lookup.add_argument("--album", type=str, help="album name", default=None)
+        parser_lookup.add_argument("--prefix", action="store_true", default=False,
+            help="match the start of each field instead of the whole field"
+        )
+
         # parser for lib subcommand
         parser_lib = subparsers.add_parser("lib")
         parser_lib.set_defaults(subcommand = self.lib)
+        parser_lib.add_argument("--limit", type=int, default=None,
+            help="maximum number of songs to list"
+        )
+        parser_lib.add_argument("--offset", type=int, default=0,
+            help="number of songs to skip before listing"
+        )
+        parser_lib.add_argument("--after", type=str, default=None,
+            help="only list songs with ids after this one, to resume a listing"
+        )
+        parser_lib.add_argument("--filter", type=str, default=None,
+            help="only list songs with this text in their title, artist or album"
+        )
+        parser_lib.add_argument("--format", choices=["table", "csv", "jsonl"], 
+            default="table",
+            help="output format, csv and jsonl print songs as they are fetched"
+        )
+
+        # parser for index subcommand
+        parser_index = subparsers.add_parser("index")
+        parser_index.set_defaults(subcommand = self.index)
+
+        # parser for compact subcommand
+        parser_compact = subparsers.add_parser("compact")
+        parser_compact.set_defaults(subcommand = self.compact)
+
+        # parser for dedupe subcommand
+        parser_dedupe = subparsers.add_parser("dedupe")
+        parser_dedupe.set_defaults(subcommand = self.dedupe)
+        parser_dedupe.add_argument("--jobs", type=int, default=os.cpu_count(),
+            help="number of processes used to match the library against itself"
+        )
+        parser_dedupe.add_argument("--remove", action="store_true", default=False,
+            help="removes every song in a cluster except the longest one"
+        )
+
+        # parser for export subcommand
+        parser_export = subparsers.add_parser("export")
+        parser_export.set_defaults(subcommand = self.export)
+        parser_export.add_argument("archive", type=str, 
+            help="file to write the library archive to"
+        )
+        parser_export.add_argument("--no-audio", action="store_true", default=False,
+            help="only exports metadata and signatures, without the stored audio"
+        )
+
+        # parser for import subcommand
+        parser_import = subparsers.add_parser("import")
+        parser_import.set_defaults(subcommand = self.import_archive)
+        parser_import.add_argument("archive", type=str, 
+            help="library archive written by export"
+        )
+        parser_import.add_argument("--batch", type=int, default=500,
+            help="number of songs written to the library at once"
+        )
+
+        # parser for evaluate subcommand
+        parser_evaluate = subparsers.add_parser("evaluate")
+        parser_evaluate.set_defaults(subcommand = self.evaluate)
+        parser_evaluate.add_argument("--library", type=str, default=None,
+            help="directory of wav files to build the library from, instead of " +
+                 "synthetic songs"
+        )
+        parser_evaluate.add_argument("--songs", type=int, default=20,
+            help="number of synthetic songs in the library"
+        )
+        parser_evaluate.add_argument("--negatives", type=int, default=10,
+            help="number of synthetic songs left out of the library, for false positives"
+        )
+        parser_evaluate.add_argument("--queries", type=int, default=40,
+            help="number of snippets of library songs to identify"
+        )
+        parser_evaluate.add_argument("--negative-queries", type=int, default=10,
+            help="number of snippets of songs outside the library to identify"
+        )
+        parser_evaluate.add_argument("--length", type=float, default=12,
+            help="snippet length in seconds"
+        )
+        parser_evaluate.add_argument("--snr", type=float, default=None,
+            help="signal to noise ratio (in dB) of white noise added to snippets"
+        )
+        parser_evaluate.add_argument("--gain", type=float, default=0.0,
+            help="largest random gain change (in dB) applied to snippets"
+        )
+        parser_evaluate.add_argument("--aligned", action="store_true", default=False,
+            help="only cuts snippets on whole seconds, so windows line up"
+        )
+        parser_evaluate.add_argument("--k", type=int, default=3,
+            help="number of matches for recall@k"
+        )
+        parser_evaluate.add_argument("--sweep", type=str, default=None,
+            help="json file of parameters (like search.threshold_epsilon) to lists " +
+                 "of values, every combination of which is evaluated"
+        )
+        parser_evaluate.add_argument("--jobs", type=int, default=os.cpu_count(),
+            help="number of configurations evaluated at once"
+        )
+        parser_evaluate.add_argument("--seed", type=int, default=0)
+        parser_evaluate.add_argument("--format", choices=["table", "json"], default="table")
 
         # parser for clear subcommand
         parser_clear = subparsers.add_parser("clear")
@@ -80,8 +231,23 @@ class Freezam(object):
         # parser for plot subcommand
         parser_plot = subparsers.add_parser("plot")
         parser_plot.set_defaults(subcommand = self.plot)
-        parser_plot.add_argument("song_id", type=str, 
-            help="songid of the song to be plotted"
+        parser_plot.add_argument("song_id", type=str, nargs="+",
+            help="songid of the song to be plotted, or several with --out-dir"
+        )
+        parser_plot.add_argument("--start", type=float, default=None,
+            help="time (in seconds) at which to start the plot"
+        )
+        parser_plot.add_argument("--end", type=float, default=None,
+            help="time (in seconds) at which to end the plot"
+        )
+        parser_plot.add_argument("--max-bins", type=int, default=512,
+            help="maximum number of frequency bins to plot"
+        )
+        parser_plot.add_argument("--out-dir", type=str, default=None,
+            help="renders every song to a png in this directory, in parallel"
+        )
+        parser_plot.add_argument("--jobs", type=int, default=os.cpu_count(),
+            help="number of processes used to render plots with --out-dir"
         )
         parser_plot.add_argument("--f", default=None, 
             help="specifies a file for the plot to be written to"
@@ -90,38 +256,28 @@ class Freezam(object):
         # parse arguments
         args = parser.parse_args(sys.argv[1:])
 
-        # set up logger
-        # if the old logging file exists, remove it, then make a new one
-        if os.path.exists(self.log_file):
-            os.remove(self.log_file)
-        f = open(self.log_file, "w+")
-        f.close()
-        # configure the logger
-        logging.basicConfig(filename=self.log_file, level=logging.DEBUG)
+        # set up logger, which writes from a background thread and rotates
+        # the log file instead of starting a new one every run
+        log_settings = self.parameters.get("logging", {})
+        fzlog.setup_logging(self.log_file, 
+                            level=args.log_level or log_settings.get("level", "INFO"),
+                            verbose=args.verbose,
+                            max_bytes=log_settings.get("max_bytes", 10485760),
+                            backups=log_settings.get("backups", 3))
         self.logger = logging.getLogger("fz")
-        # create console handler and send everything if verbose
-        ch = logging.StreamHandler(sys.stdout)
-        if args.verbose:
-            ch.setLevel(logging.DEBUG)
-        else:
-            ch.setLevel(logging.ERROR)
-        # create formatter and add to the handlers
-        fm = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-        ch.setFormatter(fm)
-        # add handlers to the logger
-        self.logger.addHandler(ch)
 
         self.logger.info("settings read!")
         self.logger.info("argument parsing set up!")
         self.logger.info("logger set up!")
 
         # set up databaser
-        if (self.db_settings["db_type"] == "sql"):
-            self.databaser = fzdb.PostgreSQLDB(self.db_settings["sql"], self.parameters)
-        elif (self.db_settings["db_type"] == "file"):
-            self.databaser = fzdb.FileSystemDB(self.db_settings, self.parameters)
-        else:
-            self.logger.error("invalid database type specified")
+        try:
+            self.databaser = fzdb.get_databaser(self.db_settings, self.parameters)
+        except (KeyError, ValueError):
+            self.logger.error("invalid database type specified", exc_info=True)
+            exit(1)
+        except Exception:
+            self.logger.error("could not set up the database", exc_info=True)
             exit(1)
 
         # log an unrecognized subcommand and exit
@@ -140,26 +296,40 @@ class Freezam(object):
         
         # now actually add to the library
         song = fzsong.SongEntry(args.song, title=args.title, artist=args.artist,
-                                album=args.album, date=args.date)
-        self.databaser.write(song)
+                                album=args.album, date=args.date, **self.analysis)
+        if not self.databaser.write(song):
+            self.logger.error("%s was not added to the library", args.song)
+            exit(1)
 
     def ingest(self, args):
         """
         top-level handler for ingesting a directory of songs
         """
         self.logger.info("ingesting...")
-        for dirpath, _, filenames in os.walk(args.dir):
-            for f in filenames:
-                song_path = os.path.abspath(os.path.join(dirpath, f))
-                song = fzsong.SongEntry(song_path, title=f, album=args.dir)
-
-                self.databaser.write(song)
+        songs = []
+        if os.path.isdir(args.dir):
+            for dirpath, _, filenames in os.walk(args.dir):
+                for f in filenames:
+                    song_path = os.path.abspath(os.path.join(dirpath, f))
+                    songs.append((song_path, {"title": f, "album": args.dir}))
+        else:
+            with open(args.dir) as manifest:
+                for line in manifest:
+                    location = line.strip()
+                    if location and not location.startswith("#"):
+                        songs.append((location, {"title": location.rsplit("/", 1)[-1]}))
+        # download, analysis and writes for different songs overlap
+        written = fzingest.ingest(songs, self.databaser, jobs=args.jobs, 
+                                  queue_size=args.queue, analysis=self.analysis)
+        print("Ingested %d of %d songs." % (len(written), len(songs)))
+        if (len(written) < len(songs)):
+            exit(1)
 
     def remove(self, args):
         """
         top-level handler for removing a song from the existing library
         """
-        self.logger.info("removing song " + args.id + " from library")
+        self.logger.info("removing song %s from library", args.id)
         self.databaser.remove(args.id)
 
     def clear(self, args):
@@ -172,17 +342,293 @@ class Freezam(object):
         """
         top-level handler for identifying a song from an existing song library
         """
+        if args.batch is not None:
+            self.identify_batch(args)
+            return
+        if args.snippet is None:
+            self.logger.error("no snippet to identify was given")
+            exit(1)
+        if args.progressive:
+            self.identify_progressive(args)
+            return
         self.logger.info("identifying the provided snippet...")
         
-        header = ["id", "title", "artist", "album", "date", "length"]
-        snippet = fzsong.SongEntry(args.snippet)
-        result = self.databaser.slow_search(snippet, num_matches=args.matches)
-        
+        header = ["id", "title", "artist", "album", "date", "length", "score"]
+        snippet = fzsong.SongEntry(args.snippet, **self.analysis)
+        # repeated snippets are answered from the cache while the library 
+        # is unchanged
+        cache, version = self.load_cache(args)
+        sig_type = "maxpow" if args.slow else self.parameters["search"].get("sig_type", "maxpow")
+        key = self.cache_key(cache, snippet.signature("maxpow"), args, sig_type)
+        result = cache.get(key, version)
         if result is None:
+            # only a search that finished is cached, a failed one is retried
+            try:
+                result = fzdb.identify(self.databaser, snippet, args.matches, sig_type) or []
+            except Exception:
+                self.logger.error("could not search the library", exc_info=True)
+                print("The search failed, see the log for details.")
+                exit(1)
+            cache.put(key, version, result)
+        
+        if not result:
             print("No matching songs were found. :(")
             self.logger.info("no matching songs were found :(")
         else:
             print(tabulate.tabulate(result, headers=header, tablefmt="orgtbl"))
+        self.save_cache(cache, args)
+
+    def identify_progressive(self, args):
+        """
+        top-level handler for identifying a snippet from as little of it as
+        possible, reporting how long identification took
+        """
+        self.logger.info("progressively identifying the provided snippet...")
+        header = ["id", "title", "artist", "album", "date", "length", "score"]
+        start = time.perf_counter()
+        search = self.parameters["search"]
+        matches, read = fzdb.progressive_search(
+            self.databaser, fzsong.stream_signature(args.snippet, **self.analysis),
+            num_matches=args.matches, margin=search["progressive_margin"],
+            **fzdb.search_settings(self.parameters))
+        elapsed = time.perf_counter() - start
+
+        if not matches:
+            print("No matching songs were found. :(")
+            self.logger.info("no matching songs were found :(")
+        else:
+            print(tabulate.tabulate(fzdb.match_rows(self.databaser, matches), 
+                                    headers=header, tablefmt="orgtbl"))
+            print("Identified from %.1f seconds of audio in %.3f seconds." % (read, elapsed))
+
+    def identify_batch(self, args):
+        """
+        top-level handler for identifying many snippets at once, printing the 
+        results as json lines
+        """
+        # gather the snippet locations from a directory or a manifest
+        if os.path.isdir(args.batch):
+            snippets = [os.path.abspath(os.path.join(dirpath, f))
+                        for dirpath, _, filenames in os.walk(args.batch)
+                        for f in sorted(filenames)]
+        else:
+            with open(args.batch) as manifest:
+                snippets = [line.strip() for line in manifest 
+                            if line.strip() and not line.startswith("#")]
+        self.logger.info("identifying %d snippets...", len(snippets))
+
+        # compute all of the snippet signatures up front, in parallel
+        header = ["id", "title", "artist", "album", "date", "length", "score"]
+        sigs = {}
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            futures = dict((pool.submit(fzsong.compute_signature, snippet, 
+                                        "maxpow", **self.analysis), snippet) 
+                           for snippet in snippets)
+            for future in concurrent.futures.as_completed(futures):
+                snippet = futures[future]
+                try:
+                    sigs[snippet] = future.result()
+                except BaseException:
+                    self.logger.error("could not analyse snippet %s", snippet)
+                    print(json.dumps({"snippet": snippet, "error": "could not analyse snippet"}),
+                          flush=True)
+
+        # cached snippets are answered right away
+        cache, version = self.load_cache(args)
+        keys = dict((snippet, self.cache_key(cache, sig, args)) for snippet, sig in sigs.items())
+        for snippet in list(sigs):
+            matches = cache.get(keys[snippet], version)
+            if matches is not None:
+                del sigs[snippet]
+                matches = [dict(zip(header, [str(x) for x in match])) for match in matches]
+                print(json.dumps({"snippet": snippet, "matches": matches}), flush=True)
+
+        # then scan the library once, streaming results as they are found. a
+        # built index is shared by --jobs worker processes instead, as long
+        # as it is up to date with the library
+        index = self.db_settings.get("index", {}).get("address")
+        if (index is not None and fzindex.current_generation(index) > 0 
+                and not fzindex.is_current(index, version)):
+            self.logger.warning("the signature index at %s is behind the library, searching "
+                                "the library instead. run fz index to rebuild it", index)
+            index = None
+        if (index is not None and fzindex.current_generation(index) > 0):
+            self.logger.info("searching the signature index at %s", index)
+            results = ((snippet, fzdb.match_rows(self.databaser, matches)) 
+                       for snippet, matches in fzindex.search(
+                           index, sigs, num_matches=args.matches, jobs=args.jobs,
+                           **fzdb.search_settings(self.parameters)))
+        else:
+            results = self.databaser.batch_search(sigs, num_matches=args.matches)
+        try:
+            for snippet, matches in results:
+                cache.put(keys[snippet], version, matches)
+                matches = [dict(zip(header, [str(x) for x in match])) for match in matches]
+                print(json.dumps({"snippet": snippet, "matches": matches}), flush=True)
+        except Exception:
+            # the snippets that finished are still cached
+            self.logger.error("could not search the library", exc_info=True)
+            self.save_cache(cache, args)
+            exit(1)
+        self.save_cache(cache, args)
+
+    def load_cache(self, args):
+        """
+        loads the search result cache kept between runs, and gets the current
+        library version. the cache is empty with --no-cache
+        """
+        settings = self.parameters["cache"]
+        cache = fzdb.ResultCache(settings["size"], settings["quantum"])
+        if (not args.no_cache and os.path.exists(self.cache_file)):
+            try:
+                with open(self.cache_file, "rb") as cache_file:
+                    saved = pickle.load(cache_file)
+                if (saved.size == cache.size and saved.quantum == cache.quantum):
+                    cache = saved
+            except:
+                self.logger.warning("could not load the result cache, starting empty")
+        return cache, self.databaser.version()
+
+    def cache_key(self, cache, sig, args, sig_type="maxpow"):
+        """
+        fingerprints a snippet signature with the settings its results depend
+        on, including the signature type that was searched
+        """
+        settings = fzdb.search_settings(self.parameters)
+        return cache.key(sig, args.matches, settings["epsilon"], settings["min_fraction"],
+                         sig_type)
+
+    def save_cache(self, cache, args):
+        """
+        saves the search result cache for the next run, and prints its 
+        counters if asked to
+        """
+        stats = cache.stats()
+        self.logger.info("result cache: %s", json.dumps(stats))
+        if args.cache_stats:
+            print("Result cache: %d entries, %d hits, %d misses, %.1f%% hit rate." % 
+                  (stats["entries"], stats["hits"], stats["misses"], 100 * stats["hit_rate"]))
+        if args.no_cache:
+            return
+        temp_file = self.cache_file + ".tmp"
+        with open(temp_file, "wb") as output:
+            pickle.dump(cache, output, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, self.cache_file)
+
+    def dedupe(self, args):
+        """
+        top-level handler for finding, and optionally removing, duplicate 
+        songs in the library
+        """
+        self.logger.info("looking for duplicate songs...")
+        clusters = fzdedupe.find_duplicates(self.databaser, self.parameters, 
+                                            db_settings=self.db_settings, jobs=args.jobs)
+        if not clusters:
+            print("No duplicate songs were found.")
+            return
+
+        header = ["cluster", "id", "title", "artist", "album", "length", "action"]
+        table = []
+        for k, cluster in enumerate(clusters):
+            rows = fzdedupe.surviving_rows(self.databaser, cluster)
+            if not rows:
+                continue
+            keeper = fzdedupe.pick_keeper(rows)
+            for row in rows:
+                duplicate = row[0] != keeper[0]
+                if (duplicate and args.remove):
+                    self.databaser.remove(row[0])
+                action = "keep" if not duplicate else "removed" if args.remove else "duplicate"
+                table.append([k, row[0], row[1], row[2], row[3], row[5], action])
+        if not table:
+            print("No duplicate songs were found.")
+            return
+        print(tabulate.tabulate(table, headers=header, tablefmt="orgtbl"))
+
+    def export(self, args):
+        """
+        top-level handler for exporting the library to an archive
+        """
+        count = fzarchive.export_library(self.databaser, args.archive, audio=not args.no_audio)
+        print("Exported %d songs to %s." % (count, args.archive))
+
+    def import_archive(self, args):
+        """
+        top-level handler for importing a library archive, without 
+        analysing any audio again
+        """
+        try:
+            count = fzarchive.import_library(self.databaser, args.archive, chunk_size=args.batch)
+        except ValueError as e:
+            # the archive's signatures were made with other posfreq settings
+            self.logger.error("could not import %s", args.archive, exc_info=True)
+            print(str(e).capitalize() + ".")
+            exit(1)
+        print("Imported %d songs from %s." % (count, args.archive))
+
+    def evaluate(self, args):
+        """
+        top-level handler for measuring identify recall, false positives and
+        latency on a throwaway library, for every configuration of a sweep
+        """
+        work_dir = tempfile.mkdtemp(prefix="fz_eval_songs_")
+        try:
+            if args.library is not None:
+                songs = fzeval.fixture_library(args.library, args.length)
+            else:
+                songs = fzeval.synthetic_library(work_dir, args.songs, seed=args.seed)
+            negatives = fzeval.synthetic_library(work_dir, args.negatives, seed=args.seed + 1)
+            if not songs:
+                self.logger.error("no songs long enough to evaluate with were found")
+                exit(1)
+            sweep = {}
+            if args.sweep is not None:
+                with open(args.sweep) as s:
+                    sweep = json.load(s)
+            augment = {"length": args.length, "snr": args.snr, "gain": args.gain,
+                       "offset": not args.aligned}
+            reports = fzeval.evaluate_sweep(
+                self.parameters, songs, negatives, sweep, jobs=args.jobs, augment=augment,
+                queries=args.queries, negative_queries=args.negative_queries, k=args.k,
+                seed=args.seed)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        if (args.format == "json"):
+            for report in reports:
+                print(json.dumps(report))
+            return
+        header = ["config", "recall@1", "recall@" + str(args.k), "false positives", 
+                  "p50 (ms)", "p95 (ms)", "p99 (ms)"]
+        table = [[", ".join(key + "=" + str(value) for key, value in report["config"].items()),
+                  report["recall@1"], report["recall@k"], report["false_positive_rate"],
+                  report["p50"], report["p95"], report["p99"]]
+                 for report in reports]
+        print(tabulate.tabulate(table, headers=header, tablefmt="orgtbl", floatfmt=".3f"))
+
+    def index(self, args):
+        """
+        top-level handler for rebuilding the shared signature index, which
+        running searches pick up as a new generation
+        """
+        index = self.db_settings.get("index", {}).get("address")
+        if index is None:
+            self.logger.error("no index address is set in the database settings")
+            exit(1)
+        generation = fzindex.build_index(self.databaser, index)
+        print("Published generation %d of the signature index." % generation)
+
+    def compact(self, args):
+        """
+        top-level handler for purging removed songs from the library, and 
+        from the shared signature index if one has been built. searches keep
+        running on the old library and index until the new ones are published
+        """
+        purged = self.databaser.compact()
+        index = self.db_settings.get("index", {}).get("address")
+        if (index is not None and fzindex.current_generation(index) > 0):
+            fzindex.build_index(self.databaser, index)
+        print("Compacted the library, purging %d removed songs." % purged)
 
     def lib(self, args):
         """
@@ -191,15 +637,60 @@ class Freezam(object):
         self.logger.info("listing library...")
         
         header = ["id", "title", "artist", "album", "date", "length"]
-        lib = self.databaser.list_db()
-        
-        print(tabulate.tabulate(lib, headers=header, tablefmt="orgtbl"))
+        lib = self.databaser.iterate(limit=args.limit, offset=args.offset,
+                                     filter=args.filter, after=args.after)
+
+        if (args.format == "table"):
+            print(tabulate.tabulate(list(lib), headers=header, tablefmt="orgtbl"))
+        elif (args.format == "csv"):
+            writer = csv.writer(sys.stdout)
+            writer.writerow(header)
+            for song in lib:
+                writer.writerow(song)
+        else:
+            for song in lib:
+                print(json.dumps(dict(zip(header, [str(x) for x in song]))))
+
+    def lookup(self, args):
+        """
+        top-level handler for looking up songs in the library by their metadata
+        """
+        song_info = dict((field, getattr(args, field)) for field in ["title", "artist", "album"]
+                         if getattr(args, field) is not None)
+        if not song_info:
+            self.logger.error("give at least one of --title, --artist or --album")
+            exit(1)
+        self.logger.info("looking up songs...")
+
+        header = ["id", "title", "artist", "album", "date", "length"]
+        songs = [self.databaser.get_info(song_id) 
+                 for song_id in self.databaser.lookup(song_info, prefix=args.prefix)]
+        # songs removed since the lookup have no info
+        songs = [song for song in songs if song is not None]
+        print(tabulate.tabulate(songs, headers=header, tablefmt="orgtbl"))
 
     def plot(self, args):
         """
         top-level handler for plotting a song currently in the library
         """
-        self.databaser.plot(args.song_id, args.f)
+        if args.out_dir is not None:
+            self.logger.info("plotting %d songs...", len(args.song_id))
+            plots = fzdb.plot_many(self.db_settings, self.parameters, args.song_id, 
+                                   args.out_dir, jobs=args.jobs, start=args.start, 
+                                   end=args.end, max_bins=args.max_bins)
+            failed = [song_id for song_id, location in plots if location is None]
+            print("Plotted %d of %d songs." % (len(plots) - len(failed), len(plots)))
+            if failed:
+                print("Could not plot " + ", ".join(failed) + ".")
+                exit(1)
+            return
+        if (len(args.song_id) > 1):
+            self.logger.error("use --out-dir to plot more than one song")
+            exit(1)
+        if not self.databaser.plot(args.song_id[0], args.f, start=args.start, end=args.end,
+                                   max_bins=args.max_bins):
+            print("Could not plot " + args.song_id[0] + ".")
+            exit(1)
 
 if __name__ == "__main__":
     Freezam()
\ No newline at end of file
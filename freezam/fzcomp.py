@@ -1,13 +1,16 @@
 # code for handling computations in the freezam project
 # Graham Arthur (garthur), Carnegie Mellon University
 
+import hashlib
 import logging
 import warnings
-from copy import copy
 
 import math
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from scipy import ndimage
 from scipy import signal
 from scipy import spatial
 from skimage import util
@@ -17,36 +20,61 @@ logger = logging.getLogger('fz.comp')
 
 # PERIODOGRAMS
 
-def compute_periodogram(series, samp_rate, h=10, delta=1, window_fn="hamming"):
+def compute_periodogram(series, samp_rate, h=10, delta=1, window_fn="hamming", 
+                        dtype=None):
     """
     given some signal (series), sampling rate, window size (in seconds), 
-    window shift (in seconds) and window function, compute the periodogram
+    window shift (in seconds) and window function, compute the periodogram.
+    the periodograms are computed in dtype if given, otherwise in the type 
+    of the series
     """
+    if dtype is not None:
+        series = np.asarray(series, dtype=dtype)
     H = h * samp_rate
     SHIFT = delta * samp_rate
     # slice time series into windows of length (h*samp_rate), stepping by
     # delta*samp_rate
     slices = util.view_as_windows(series, window_shape=(H,), step=SHIFT)
-    logger.info("windows computed!")
+    logger.debug("windows computed!")
     # throw away series for memory
     del series
     
     # compute the local periodograms
     freq = signal.periodogram(slices[0], fs=samp_rate, window=window_fn)[0]
-    logger.info("frequencies computed!")
+    logger.debug("frequencies computed!")
     pdgrams = [signal.periodogram(win_slice, fs=samp_rate, window=window_fn)[1]
                     for win_slice in slices]
     
-    logger.info("local periodograms computed!")
+    logger.debug("local periodograms computed!")
     return np.array(freq), np.array(pdgrams)
 
-def smooth_periodogram(l_pdgram, kernel):
-    # TODO implement this
+def get_kernel(kernel, width=5):
+    """
+    builds a normalized smoothing kernel of the given width. kernel is one of
+    daniell (uniform), modified_daniell (uniform with half weight ends), or 
+    any window known to scipy, like hamming or hann
+    """
+    if (kernel == "daniell"):
+        weights = np.ones(width)
+    elif (kernel == "modified_daniell"):
+        weights = np.ones(width)
+        weights[[0, -1]] = 0.5
+    else:
+        weights = signal.get_window(kernel, width, fftbins=False)
+    return weights / np.sum(weights)
+
+def smooth_periodogram(l_pdgrams, kernel, width=5):
     """
     given set of local periodograms (l_pdgrams), 
-    smooth them using some kernel choice (kernel)
+    smooth them using some kernel choice (kernel). every periodogram is
+    convolved along frequency in one vectorized pass
     """
-    pass
+    if (kernel is None or kernel == "None"):
+        return l_pdgrams
+    weights = get_kernel(kernel, width)
+    smoothed = ndimage.convolve1d(l_pdgrams, weights, axis=1, mode="reflect")
+    logger.debug("local periodograms smoothed!")
+    return smoothed
 
 def plot_periodogram(freq, pdgram):
     """
@@ -59,65 +87,116 @@ def plot_periodogram(freq, pdgram):
     plt.ylabel('PSD [V**2/Hz]')
     plt.show()
 
+def compute_spectrogram(series, samp_rate, max_bins=512, max_frames=2000):
+    """
+    computes a downsampled spectrogram of a signal (series) for display, with
+    at most max_bins + 1 frequency bins and max_frames time frames. frames 
+    beyond max_frames are pooled by their maximum power
+    """
+    nperseg = max(1, min(len(series), 2 * max_bins))
+    freq, times, spec = signal.spectrogram(series, fs=samp_rate, nperseg=nperseg)
+    if (spec.shape[1] > max_frames):
+        factor = math.ceil(spec.shape[1] / max_frames)
+        n = (spec.shape[1] // factor) * factor
+        spec = spec[:, :n].reshape(len(freq), -1, factor).max(axis=2)
+        times = times[:n].reshape(-1, factor).mean(axis=1)
+    return freq, times, spec
+
 def plot_spectrogram(series, samp_rate, title="", 
-                     save_location=None):
-    # TODO: TEST this from an entry_point
+                     save_location=None, offset=0, max_bins=512):
     """
-    takes a set of local periodograms (l_pdgrams), constructs 
-    a spectrogram, and then plots it
+    takes a signal (series), computes a downsampled spectrogram, and then 
+    plots it. offset is the time (in seconds) at which the series starts. 
+    plots written to a file are rendered with the agg backend, without 
+    touching pyplot
     """
-    plt.figure()
-    # compute the spectrogram
-    plt.specgram(series, Fs=samp_rate)
-    plt.title(title)
-    plt.xlabel("Time [s]")
-    plt.ylabel("Frequency [Hz]")
+    freq, times, spec = compute_spectrogram(series, samp_rate, max_bins)
+    if save_location is None:
+        fig = plt.figure()
+    else:
+        fig = Figure()
+        FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.pcolormesh(times + offset, freq, 10 * np.log10(spec + np.finfo(spec.dtype).tiny),
+                  shading="auto")
+    ax.set_title(title)
+    ax.set_xlabel("Time [s]")
+    ax.set_ylabel("Frequency [Hz]")
     if save_location is None:
         plt.show()
     else:
-        plt.savefig(save_location)
+        fig.savefig(save_location)
         
 
 # SIGNATURES
-def compute_sig_posfreq(freq, l_pdgrams):
+def compute_sig_posfreq(freq, l_pdgrams, n_peaks=None):
     """
     computes a signature from local periodograms (l_pdgram) using
-    the peak positive frequency method
+    the peak positive frequency method. if n_peaks is given, only the
+    n_peaks most powerful peaks of each periodogram are kept
     """
-    logger.info("computing the positive frequency signature...")
+    logger.debug("computing the positive frequency signature...")
     max_freq = max(freq)
     signatures = []
     # loop through periodograms
     for pdgram in l_pdgrams:
         # find the peaks in each periodogram
         peaks, _ = signal.find_peaks(pdgram)
+        if (n_peaks is not None and len(peaks) > n_peaks):
+            # keep the strongest peaks, still in frequency order
+            peaks = np.sort(peaks[np.argpartition(pdgram[peaks], -n_peaks)[-n_peaks:]])
         # append the frequencies associated with 
         signatures.append(freq[peaks] / max_freq)
-    return np.array(signatures)
+    # the number of peaks varies by window, so keep one array per window
+    sig = np.empty(len(signatures), dtype=object)
+    for i, peaks in enumerate(signatures):
+        sig[i] = peaks
+    return sig
 
 def compute_sig_maxpow(l_pdgrams, samp_rate, m=8):
     """
     computes a signature from local pdgrams (l_pdgram) using
     the maximum power method
     """
-    logger.info("computing the max power signature...")
+    logger.debug("computing the max power signature...")
     min_freq = (2**-(m+1))*(samp_rate/2)
+    l_pdgrams = np.asarray(l_pdgrams)
     signatures = []
     
-    # loop through the periodograms
-    for pdgram in l_pdgrams:
-        start = 0
-        l_sig = []
-        
-        # compute the signature for the kth octave
-        for k in range(0, m):
-            width = math.ceil((2**k) * min_freq)
-            l_sig.append(max(pdgram[start:start+width]))
-            start += width
-        signatures.append(copy(l_sig))
+    # compute the signature for the kth octave of every periodogram at once
+    start = 0
+    for k in range(0, m):
+        width = math.ceil((2**k) * min_freq)
+        signatures.append(np.max(l_pdgrams[:, start:start+width], axis=1))
+        start += width
     
-    logger.info("max power signature computed!")
-    return np.array(signatures)
+    logger.debug("max power signature computed!")
+    if not signatures:
+        return np.zeros((len(l_pdgrams), 0), dtype=l_pdgrams.dtype)
+    return np.stack(signatures, axis=1)
+
+def compute_sig_envelope(sig):
+    """
+    computes a coarse summary of a signature (sig): the minimum and maximum
+    of every dimension over all of its frames, in the signature's dtype
+    """
+    sig = np.asarray(sig)
+    if (len(sig) == 0):
+        return np.zeros((2, sig.shape[-1]), dtype=sig.dtype)
+    return np.array([np.min(sig, axis=0), np.max(sig, axis=0)])
+
+def envelope_may_match(sig_snippet, envelope, epsilon=1000, min_fraction=1.0):
+    """
+    checks if a snippet signature could match any signature with the given 
+    envelope. a matching frame has to be within epsilon of some frame of 
+    the full signature, and a frame can be no closer to it than to the box 
+    the envelope spans, so frames further than epsilon from the box can't
+    vote. the song is ruled out if too few frames are left to match
+    """
+    sig_snippet = np.asarray(sig_snippet)
+    outside = np.maximum(envelope[0] - sig_snippet, 0) + np.maximum(sig_snippet - envelope[1], 0)
+    close = np.sqrt(np.sum(outside ** 2, axis=1)) < epsilon
+    return bool(np.sum(close) >= required_votes(len(sig_snippet), min_fraction))
 
 # HASHES
 def compute_hash_wang(sig, h_table):
@@ -126,6 +205,68 @@ def compute_hash_wang(sig, h_table):
     """
     pass
 
+# minhash functions are (a*x + b) mod a mersenne prime, with coefficients 
+# drawn from a fixed seed so that every process hashes peaks the same way
+MINHASH_PRIME = (1 << 31) - 1
+
+def quantize_peaks(frame, bins=1024):
+    """
+    quantizes one window of a posfreq signature (normalized peak 
+    frequencies) into the set of frequency bins its peaks fall in
+    """
+    return np.unique(np.minimum((np.asarray(frame) * bins).astype(np.int64), bins - 1))
+
+def compute_minhash(sig, bins=1024, n_hashes=24, seed=0):
+    """
+    computes the minhash of every window of a posfreq signature, as an
+    (n_frames, n_hashes) array. windows without peaks hash to the prime
+    """
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, MINHASH_PRIME, size=n_hashes).astype(np.int64)
+    b = rng.randint(0, MINHASH_PRIME, size=n_hashes).astype(np.int64)
+    minhashes = np.full((len(sig), n_hashes), MINHASH_PRIME, dtype=np.int64)
+    for i, frame in enumerate(sig):
+        peaks = quantize_peaks(frame, bins)
+        if (len(peaks) > 0):
+            minhashes[i] = ((np.outer(peaks, a) + b) % MINHASH_PRIME).min(axis=0)
+    return minhashes
+
+def compute_lsh_hashes(sig, bins=1024, n_hashes=24, bands=8, seed=0):
+    """
+    buckets every window of a posfreq signature with banded lsh: its minhash
+    is cut into bands, and each band is hashed to a bucket. windows with 
+    similar peak sets share a bucket in some band with high probability.
+    returns (hashes, frames) arrays, with one signed 64 bit hash for each 
+    band of every window that has peaks
+    """
+    minhashes = compute_minhash(sig, bins, n_hashes, seed)
+    rows = n_hashes // bands
+    hashes, frames = [], []
+    for i, minhash in enumerate(minhashes):
+        if (minhash[0] == MINHASH_PRIME):
+            continue
+        for band in range(0, bands):
+            digest = hashlib.blake2b(minhash[band * rows:(band + 1) * rows].tobytes(), 
+                                     digest_size=8, salt=band.to_bytes(8, "little"))
+            hashes.append(int.from_bytes(digest.digest(), "little", signed=True))
+            frames.append(i)
+    return np.array(hashes, dtype=np.int64), np.array(frames, dtype=np.int32)
+
+def peak_similarity(sig_snippet, sig_full, offset, bins=1024):
+    """
+    scores a posfreq snippet signature against a full one, starting offset
+    frames in, by the mean jaccard similarity of their quantized peak sets
+    window by window. a snippet that doesn't fit at offset scores 0
+    """
+    if (offset < 0 or offset + len(sig_snippet) > len(sig_full) or len(sig_snippet) == 0):
+        return 0.0
+    total = 0.0
+    for frame_snippet, frame_full in zip(sig_snippet, sig_full[offset:]):
+        a, b = quantize_peaks(frame_snippet, bins), quantize_peaks(frame_full, bins)
+        union = len(np.union1d(a, b))
+        total += 1.0 if union == 0 else len(np.intersect1d(a, b, assume_unique=True)) / union
+    return total / len(sig_snippet)
+
 # SEARCH
 def match_signature(sig_snippet, sig_full, epsilon=1000, dist=spatial.distance.euclidean):
     """
@@ -147,4 +288,150 @@ def match_signature(sig_snippet, sig_full, epsilon=1000, dist=spatial.distance.e
         dists = [dist(x, y) for x, y in pairs]
         if all([d < epsilon for d in dists]):
             return True
-    return False
\ No newline at end of file
+    return False
+
+def required_votes(len_snippet, min_fraction=1.0):
+    """
+    the number of snippet frames that have to match for a snippet to match
+    """
+    return max(1, math.ceil(min_fraction * len_snippet - 1e-9))
+
+def score_signature(sig_snippet, sig_full, epsilon=1000, min_fraction=1.0):
+    """
+    compares two signatures by voting. at every offset of the snippet in the 
+    full signature, each snippet frame within epsilon of its aligned frame 
+    votes for the offset. returns the score of the best offset if at least 
+    min_fraction of the frames voted for it, otherwise None. scores are in 
+    [0, 1] and order matches by votes, then by the mean distance of the 
+    voting frames
+    """
+    sig_snippet = np.asarray(sig_snippet)
+    sig_full = np.asarray(sig_full)
+    len_snippet = len(sig_snippet)
+    len_full = len(sig_full)
+    if (len_snippet == 0 or len_full < len_snippet):
+        return None
+
+    # distances between every pair of frames, then the aligned ones per offset
+    dists = spatial.distance.cdist(sig_snippet, sig_full)
+    frames = np.arange(len_snippet)
+    aligned = dists[frames, frames + np.arange(len_full - len_snippet + 1)[:, None]]
+    close = aligned < epsilon
+    votes = np.sum(close, axis=1)
+    # the mean distance of the voting frames breaks ties between equal votes
+    mean_dist = np.sum(np.where(close, aligned, 0), axis=1) / np.maximum(votes, 1)
+    scores = (votes - mean_dist / epsilon) / len_snippet
+
+    best = np.argmax(scores)
+    if (votes[best] < required_votes(len_snippet, min_fraction)):
+        return None
+    return float(scores[best])
+
+def batch_match(song_sigs, snippet_sigs, epsilon=1000, num_matches=1, candidates=None,
+                min_fraction=1.0):
+    """
+    matches many snippets against a library in a single pass. song_sigs is an
+    iterable of (song_id, signature) pairs and snippet_sigs is a dictionary of 
+    snippet name to signature. if given, candidates maps each song_id to the 
+    names of the only snippets that could match it. yields (snippet name, 
+    list of (song id, score) pairs). when every frame has to match, a 
+    snippet is done as soon as it has num_matches matches. otherwise the 
+    whole library is voted on and the best num_matches are kept
+    """
+    strict = min_fraction >= 1.0
+    matches = dict((name, []) for name in snippet_sigs)
+    pending = dict(snippet_sigs)
+    for song_id, sig_full in song_sigs:
+        names = list(pending) if candidates is None else \
+            [name for name in candidates.get(song_id, []) if name in pending]
+        # compare every pending snippet against this song while it is loaded
+        for name in names:
+            score = score_signature(pending[name], sig_full, epsilon, min_fraction)
+            if score is None:
+                continue
+            matches[name].append((song_id, score))
+            if (strict and len(matches[name]) == num_matches):
+                del pending[name]
+                yield name, matches[name]
+        if not pending:
+            break
+    for name in pending:
+        ranked = sorted(matches[name], key=lambda match: -match[1])
+        yield name, ranked[:num_matches]
+
+class VoteCounter(object):
+    """
+    votes a growing snippet signature against a library, frame by frame. 
+    each new snippet frame only has to be compared with the library once, 
+    and scores are the same as those of score_signature on the whole snippet
+    """
+
+    def __init__(self, song_sigs, epsilon=1000):
+        """
+        loads the (song_id, signature) pairs in song_sigs, with no frames yet
+        """
+        self.epsilon = epsilon
+        self.songs = [(song_id, np.asarray(sig)) for song_id, sig in song_sigs 
+                      if len(sig) > 0]
+        # votes and summed distances of the voting frames, per song and offset
+        self.votes = [np.zeros(len(sig), dtype=int) for _, sig in self.songs]
+        self.dists = [np.zeros(len(sig)) for _, sig in self.songs]
+        self.n_frames = 0
+
+    def add_frames(self, frames):
+        """
+        adds the next frames of the snippet signature, voting for every offset
+        that puts them within epsilon of a library frame
+        """
+        frames = np.asarray(frames)
+        if (len(frames) == 0):
+            return
+        positions = np.arange(self.n_frames, self.n_frames + len(frames))
+        for (_, sig), votes, dists in zip(self.songs, self.votes, self.dists):
+            frame_dists = spatial.distance.cdist(frames, sig)
+            rows, cols = np.nonzero(frame_dists < self.epsilon)
+            offsets = cols - positions[rows]
+            keep = offsets >= 0
+            np.add.at(votes, offsets[keep], 1)
+            np.add.at(dists, offsets[keep], frame_dists[rows[keep], cols[keep]])
+        self.n_frames += len(frames)
+
+    def scores(self):
+        """
+        gets (song_id, score, votes) for the best offset of every song that
+        is still long enough to hold the snippet, best first
+        """
+        results = []
+        if (self.n_frames == 0):
+            return results
+        for (song_id, sig), votes, dists in zip(self.songs, self.votes, self.dists):
+            n_offsets = len(sig) - self.n_frames + 1
+            if (n_offsets <= 0):
+                continue
+            song_votes = votes[:n_offsets]
+            mean_dist = dists[:n_offsets] / np.maximum(song_votes, 1)
+            scores = (song_votes - mean_dist / self.epsilon) / self.n_frames
+            best = np.argmax(scores)
+            results.append((song_id, float(scores[best]), int(song_votes[best])))
+        results.sort(key=lambda result: -result[1])
+        return results
+
+    def ranking(self, num_matches=1, min_fraction=1.0):
+        """
+        gets the best num_matches (song_id, score) matches so far, like 
+        batch_match would for the snippet read so far
+        """
+        needed = required_votes(self.n_frames, min_fraction)
+        return [(song_id, score) for song_id, score, votes in self.scores()
+                if votes >= needed][:num_matches]
+
+    def confident(self, margin=3, min_fraction=1.0):
+        """
+        checks if the best song is a match and beats the runner-up by at 
+        least margin votes
+        """
+        results = self.scores()
+        if (not results or results[0][2] < required_votes(self.n_frames, min_fraction)):
+            return False
+        runner_up = results[1][2] if len(results) > 1 else 0
+        return results[0][2] - runner_up >= margin
@@ -3,26 +3,506 @@
 
 import os
 import sys
+import json
+import time
+import zlib
+import queue
+import heapq
+import hashlib
+import collections
+import contextlib
+import bisect
+import itertools
 import logging
-import shutil
 import pickle
-import tabulate
+import sqlite3
+import concurrent.futures
 import psycopg2
+import psycopg2.extras
 import numpy as np
+# the file system library locks its manifest where it can
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 import fzcomp
+import fzio
 
 logger = logging.getLogger('fz.db')
 
 # directory constants
 ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 TEMP_DIR = os.path.join(ROOT_DIR, "temp")
+# files of uncommitted songs younger than this (in seconds) may still be 
+# committed by another process, so recovery leaves them alone
+ORPHAN_GRACE = 60 * 60
+
+def matches_filter(song, text):
+    """
+    checks if a library row (song) has text in its title, artist or album
+    """
+    text = text.lower()
+    return any(text in str(field).lower() for field in song[1:4])
+
+def page_rows(query_page, limit=None, offset=0, after=None, page_size=1000):
+    """
+    yields library rows page by page, using keyset pagination on song_id. 
+    query_page(after, offset, count) returns up to count rows in song_id order
+    with song_id greater than after (if given), skipping the first offset
+    """
+    while (limit is None or limit > 0):
+        count = page_size if limit is None else min(page_size, limit)
+        rows = query_page(after, offset, count)
+        for row in rows:
+            yield row
+        if (len(rows) < count):
+            return
+        # the next page starts after the last key seen, so no more offset
+        after = rows[-1][0]
+        offset = 0
+        if limit is not None:
+            limit -= len(rows)
+
+def search_signatures(databaser, snippet_sigs, epsilon=1000, num_matches=1, min_fraction=1.0):
+    """
+    searches a databaser for many maxpow snippet signatures from coarse to
+    fine. the coarse stage compares snippets against every song's envelope 
+    and throws out songs that cannot match, and only the songs left are 
+    loaded for the full voting match. songs without a stored envelope are 
+    always kept. yields (snippet name, list of (song id, score) pairs) like 
+    batch_match
+    """
+    candidates = {}
+    for song_id, envelope in databaser.iterate_envelopes():
+        names = [name for name, sig in snippet_sigs.items()
+                 if envelope is None or
+                 fzcomp.envelope_may_match(sig, envelope, epsilon, min_fraction)]
+        if names:
+            candidates[song_id] = names
+    logger.info("%d songs left after the coarse search", len(candidates))
+    for result in fzcomp.batch_match(databaser.iterate_signatures("maxpow", list(candidates)),
+                                     snippet_sigs, epsilon=epsilon, num_matches=num_matches,
+                                     candidates=candidates, min_fraction=min_fraction):
+        yield result
+
+def identify(databaser, snippet, num_matches=1, sig_type="maxpow"):
+    """
+    searches a databaser for an analysed snippet by signature type: posfreq
+    uses the databaser's lsh search, and maxpow its linear voting search
+    """
+    if (sig_type == "posfreq"):
+        return databaser.search(snippet, num_matches=num_matches)
+    return databaser.slow_search(snippet, num_matches=num_matches)
+
+def progressive_search(databaser, sig_blocks, num_matches=1, epsilon=1000, 
+                       min_fraction=1.0, margin=3):
+    """
+    searches a databaser with a snippet signature that grows as it is read.
+    sig_blocks yields (seconds read, new signature frames) pairs, and only 
+    the new frames are voted against the library each time. the first 
+    frames are compared against every song's envelope, like the coarse 
+    stage of search_signatures, and only the songs left are loaded. stops 
+    reading as soon as the best match beats the runner-up by margin votes. 
+    returns (list of (song id, score) pairs, seconds of audio read)
+    """
+    counter = None
+    read = 0
+    for read, frames in sig_blocks:
+        if (len(frames) == 0):
+            continue
+        if counter is None:
+            candidates = [song_id for song_id, envelope in databaser.iterate_envelopes()
+                          if envelope is None or 
+                          fzcomp.envelope_may_match(frames, envelope, epsilon, min_fraction)]
+            logger.info("%d songs left after the coarse search", len(candidates))
+            counter = fzcomp.VoteCounter(databaser.iterate_signatures("maxpow", candidates), 
+                                         epsilon)
+        counter.add_frames(frames)
+        if counter.confident(margin, min_fraction):
+            logger.info("confident after %s seconds of audio", read)
+            break
+    if counter is None:
+        return [], read
+    return counter.ranking(num_matches, min_fraction), read
+
+def lsh_settings(params):
+    """
+    gets the keyword arguments of fzcomp.compute_lsh_hashes from the 
+    parameters. hashes stored under other settings can't be searched
+    """
+    posfreq = params["posfreq"]
+    return {"bins": posfreq.get("bins", 1024), "n_hashes": posfreq.get("hashes", 24),
+            "bands": posfreq.get("bands", 8)}
+
+def hash_settings(params):
+    """
+    gets the settings that a sql library records with its hash table: the 
+    lsh settings, and the peaks per window of the posfreq signatures hashed
+    """
+    return dict(lsh_settings(params), peaks=params["posfreq"].get("peaks"))
+
+def check_hash_settings(stored, params):
+    """
+    refuses a hash table made with other settings than the parameters, 
+    since the snippet's hashes would never collide with it. stored is the 
+    recorded (bins, n_hashes, bands, peaks) row, or None if there is none
+    """
+    settings = hash_settings(params)
+    if (stored is not None and dict(zip(settings, stored)) != settings):
+        raise ValueError("the library was hashed with the posfreq settings " + 
+                         str(dict(zip(settings, stored))) + ", not " + str(settings) + 
+                         ", restore them to use it")
+
+def lsh_search(databaser, sig_snippet, num_matches=1, params=None):
+    """
+    searches a databaser for a posfreq snippet signature with lsh. the
+    snippet's buckets are looked up in the databaser's hash table, and every
+    colliding window votes for its song at the offset it implies. only the
+    songs with the most votes are loaded and verified by peak similarity, so
+    a search costs as much as its collisions, not as much as the library.
+    returns a list of (song id, score) pairs, best first
+    """
+    settings = lsh_settings(params)
+    hashes, frames = fzcomp.compute_lsh_hashes(sig_snippet, **settings)
+    query = {}
+    for h, frame in zip(hashes.tolist(), frames.tolist()):
+        query.setdefault(h, []).append(frame)
+    votes = collections.Counter()
+    for h, song_id, frame in databaser.find_hashes(list(query)):
+        for snippet_frame in query[h]:
+            votes[(song_id, frame - snippet_frame)] += 1
+    # every song is verified at the offset with the most votes
+    best = {}
+    for (song_id, offset), count in votes.items():
+        if (count > best.get(song_id, (0, 0))[0]):
+            best[song_id] = (count, offset)
+    n_candidates = max(num_matches, params["posfreq"].get("candidates", 10))
+    candidates = heapq.nlargest(n_candidates, best, key=lambda song_id: best[song_id])
+    logger.info("%d songs collided with the snippet, verifying %d", len(best), len(candidates))
+
+    min_similarity = params["posfreq"].get("min_similarity", 0.2)
+    matches = []
+    for song_id, sig_full in databaser.iterate_signatures("posfreq", candidates):
+        score = fzcomp.peak_similarity(sig_snippet, sig_full, best[song_id][1], 
+                                       settings["bins"])
+        if (score >= min_similarity):
+            matches.append((song_id, score))
+    matches.sort(key=lambda match: (-match[1], match[0]))
+    return matches[:num_matches]
+
+def snippet_posfreq(snippet, params):
+    """
+    computes the posfreq signature of a snippet, keeping as many peaks per
+    window as the library does
+    """
+    return fzcomp.compute_sig_posfreq(snippet.freq, snippet.l_pdgrams, 
+                                      params["posfreq"].get("peaks"))
+
+def hash_rows(record, settings):
+    """
+    gets the (hash, song_id, frame) hash table rows of a library record,
+    hashed with the lsh settings (see lsh_settings)
+    """
+    hashes, frames = fzcomp.compute_lsh_hashes(record["sigs"]["posfreq"], **settings)
+    song_id = record["song"][0]
+    return [(h, song_id, frame) for h, frame in zip(hashes.tolist(), frames.tolist())]
+
+def write_batch(insert, records):
+    """
+    writes library records with insert, a function that writes a list of 
+    records in one transaction. the records are written in a single batch 
+    if they can be, and if the batch fails (on a song that is already in 
+    the library, say) each is written in its own transaction instead, so 
+    that one bad song doesn't hold back the rest. returns the ids of the 
+    songs written
+    """
+    try:
+        insert(records)
+        return [record["song"][0] for record in records]
+    except Exception:
+        if (len(records) == 1):
+            logger.error("there was a problem writing song %s to the library", 
+                         records[0]["song"][0], exc_info=True)
+            return []
+        logger.warning("could not write %d songs in one transaction, writing them one at a time",
+                       len(records), exc_info=True)
+    written = []
+    for record in records:
+        written.extend(write_batch(insert, [record]))
+    return written
+
+def song_record(song_entry, storage, peaks=None):
+    """
+    turns an analysed song into a library record: its library row, its 
+    signatures and its audio in the compact storage format (or None). the
+    databasers write records in bulk, and exports are made of them. peaks
+    is the number of peaks kept per window of the posfreq signature
+    """
+    s = song_entry
+    return {
+        "song": [s.song_id, s.title, s.artist, s.album, s.date, s.length],
+        "sigs": {"maxpow": s.signature("maxpow"),
+                 "posfreq": fzcomp.compute_sig_posfreq(s.freq, s.l_pdgrams, peaks)},
+        "audio": fzio.encode_audio(s.data, s.samp_rate, **storage)
+    }
+
+def audio_rate(audio):
+    """
+    gets the sampling rate of audio in the compact storage format
+    """
+    return fzio.read_audio_header(fzio.bytes_range_reader(audio))["samp_rate"]
+
+def search_settings(params):
+    """
+    gets the keyword arguments of search_signatures from the parameters
+    """
+    return {"epsilon": params["search"]["threshold_epsilon"],
+            "min_fraction": params["search"].get("min_fraction", 1.0)}
+
+def match_rows(databaser, matches):
+    """
+    turns (song id, score) matches into library rows with the score appended.
+    songs that are no longer in the library are left out
+    """
+    rows = []
+    for song_id, score in matches:
+        info = databaser.get_info(song_id)
+        if info is not None:
+            rows.append(tuple(info) + (round(score, 3),))
+    return rows
+
+class ResultCache(object):
+    """
+    a bounded least recently used cache of search results, keyed by a 
+    quantized fingerprint of the snippet signature, so repeated queries for
+    the same audio skip the library scan. every entry belongs to a library 
+    version, and the whole cache is dropped when the library changes
+    """
+
+    def __init__(self, size=1024, quantum=100):
+        """
+        makes an empty cache of at most size results. signature values are 
+        rounded to multiples of quantum before they are fingerprinted
+        """
+        self.size = size
+        self.quantum = quantum
+        self.entries = collections.OrderedDict()
+        self.library_version = None
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, sig, *settings):
+        """
+        fingerprints a signature along with any search settings that change
+        the results, like the number of matches
+        """
+        sig = np.asarray(sig)
+        quantized = np.round(sig / self.quantum).astype(np.int64)
+        digest = hashlib.blake2b(quantized.tobytes(), digest_size=16)
+        digest.update(repr((sig.shape,) + settings).encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key, library_version):
+        """
+        gets the cached results for key, or None if there are none for this
+        library version
+        """
+        if (library_version != self.library_version):
+            self.entries.clear()
+            self.library_version = library_version
+        results = self.entries.get(key)
+        if results is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return results
+
+    def put(self, key, library_version, results):
+        """
+        caches the results for key, evicting the least recently used entry if
+        the cache is full
+        """
+        if (library_version != self.library_version):
+            self.entries.clear()
+            self.library_version = library_version
+        self.entries[key] = results
+        self.entries.move_to_end(key)
+        while (len(self.entries) > self.size):
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        """
+        gets the hit and miss counters of the cache
+        """
+        lookups = self.hits + self.misses
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0}
+
+class MetadataIndex(object):
+    """
+    an in-memory index of library rows by title, artist and album, which
+    supports exact and prefix lookups
+    """
+
+    FIELDS = {"title": 1, "artist": 2, "album": 3}
+
+    def __init__(self, rows):
+        """
+        builds the index from library rows
+        """
+        # exact lookups go through a dictionary, prefix lookups bisect 
+        # a sorted list of (value, song_id) pairs
+        self.exact = dict((field, {}) for field in MetadataIndex.FIELDS)
+        self.sorted = dict((field, []) for field in MetadataIndex.FIELDS)
+        for field, col in MetadataIndex.FIELDS.items():
+            for row in rows:
+                self.exact[field].setdefault(row[col], set()).add(row[0])
+            self.sorted[field] = sorted((row[col], row[0]) for row in rows)
+
+    def add(self, row):
+        """
+        adds a library row to the index
+        """
+        for field, col in MetadataIndex.FIELDS.items():
+            self.exact[field].setdefault(row[col], set()).add(row[0])
+            bisect.insort(self.sorted[field], (row[col], row[0]))
+
+    def remove(self, row):
+        """
+        removes a library row from the index
+        """
+        for field, col in MetadataIndex.FIELDS.items():
+            self.exact[field].get(row[col], set()).discard(row[0])
+            pairs = self.sorted[field]
+            i = bisect.bisect_left(pairs, (row[col], row[0]))
+            if (i < len(pairs) and pairs[i] == (row[col], row[0])):
+                del pairs[i]
+
+    def lookup(self, song_info, prefix=False):
+        """
+        returns the sorted song_ids of songs matching every field in song_info,
+        either exactly or by prefix
+        """
+        found = None
+        for field, value in song_info.items():
+            value = value.lower()
+            if prefix:
+                pairs = self.sorted[field]
+                ids = set()
+                i = bisect.bisect_left(pairs, (value,))
+                while (i < len(pairs) and pairs[i][0].startswith(value)):
+                    ids.add(pairs[i][1])
+                    i += 1
+            else:
+                ids = self.exact[field].get(value, set())
+            found = ids if found is None else found & ids
+        return sorted(found or [])
+
+class HashTable(object):
+    """
+    an lsh hash table of (hash, song, frame) entries, held in numpy arrays
+    sorted by hash so that buckets are found by binary search. it is saved
+    between runs with the settings it was hashed with and the library
+    version it is up to date with
+    """
+
+    def __init__(self, settings, version=None, songs=None, hashes=None, song_idx=None,
+                 frames=None):
+        self.settings = settings
+        self.version = version
+        # song ids, indexed by song_idx. dropped songs are left as None
+        self.songs = songs or []
+        self.hashes = np.zeros(0, dtype=np.int64) if hashes is None else hashes
+        self.song_idx = np.zeros(0, dtype=np.int32) if song_idx is None else song_idx
+        self.frames = np.zeros(0, dtype=np.int32) if frames is None else frames
+
+    def song_ids(self):
+        """
+        returns the set of song ids in the table
+        """
+        return set(song_id for song_id in self.songs if song_id is not None)
+
+    def add(self, entries):
+        """
+        adds (song_id, hashes, frames) entries to the table
+        """
+        hashes, song_idx, frames = [self.hashes], [self.song_idx], [self.frames]
+        for song_id, song_hashes, song_frames in entries:
+            hashes.append(song_hashes)
+            song_idx.append(np.full(len(song_hashes), len(self.songs), dtype=np.int32))
+            frames.append(song_frames)
+            self.songs.append(song_id)
+        order = np.argsort(np.concatenate(hashes), kind="stable")
+        self.hashes = np.concatenate(hashes)[order]
+        self.song_idx = np.concatenate(song_idx)[order]
+        self.frames = np.concatenate(frames)[order]
+
+    def drop(self, song_ids):
+        """
+        drops every entry of the songs in song_ids from the table
+        """
+        dropped = [i for i, song_id in enumerate(self.songs) if song_id in song_ids]
+        if not dropped:
+            return
+        keep = ~np.isin(self.song_idx, dropped)
+        self.hashes, self.song_idx, self.frames = (
+            self.hashes[keep], self.song_idx[keep], self.frames[keep])
+        for i in dropped:
+            self.songs[i] = None
+
+    def compact(self):
+        """
+        forgets the songs that were dropped, renumbering the rest
+        """
+        kept = [i for i, song_id in enumerate(self.songs) if song_id is not None]
+        renumber = np.zeros(len(self.songs), dtype=np.int32)
+        renumber[kept] = np.arange(len(kept), dtype=np.int32)
+        self.song_idx = renumber[self.song_idx]
+        self.songs = [self.songs[i] for i in kept]
+
+    def find(self, hashes):
+        """
+        creates a generator of (hash, song_id, frame) entries for every hash
+        in hashes
+        """
+        hashes = np.unique(np.asarray(hashes, dtype=np.int64))
+        starts = np.searchsorted(self.hashes, hashes, side="left")
+        stops = np.searchsorted(self.hashes, hashes, side="right")
+        for h, start, stop in zip(hashes.tolist(), starts, stops):
+            for k in range(start, stop):
+                yield h, self.songs[self.song_idx[k]], int(self.frames[k])
+
+def like_escape(value):
+    """
+    escapes the LIKE wildcards in value, for patterns with ESCAPE '\\'
+    """
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def prefix_pattern(value):
+    """
+    turns value into a LIKE pattern matching strings that start with it
+    """
+    return like_escape(value) + "%"
+
+def contains_pattern(value):
+    """
+    turns value into a LIKE pattern matching strings that contain it, like
+    the plain substring test of matches_filter
+    """
+    return "%" + like_escape(value) + "%"
 
 # TODO: test this
 class FileSystemDB(object):
     """
     provides functions for reading and writing to a database
-    represented as a file system
+    represented as a file system. the library rows and envelopes live in an
+    append-only manifest of json lines, which is the commit point of every
+    change: a song's files are written first and it is only in the library
+    once its record is in the manifest, and it is only out of the library
+    once its remove record (its tombstone) is. the files of removed songs 
+    are left until compact rewrites the manifest without them
     """
 
     def __init__(self, db_settings, param_settings):
@@ -34,21 +514,29 @@ class FileSystemDB(object):
         self.fz_song_lib = os.path.join(db_root, "fz_song_lib")
         self.fz_song_sigs = os.path.join(db_root, "fz_song_sigs")
         self.fz_song_data = os.path.join(db_root, "fz_song_data")
+        self.fz_song_index = os.path.join(db_root, "fz_song_index.pkl")
+        self.fz_song_envs = os.path.join(db_root, "fz_song_envelopes.pkl")
+        self.fz_song_manifest = os.path.join(db_root, "fz_song_manifest.jsonl")
+        self.fz_song_hashes = os.path.join(db_root, "fz_song_hashes.pkl")
+        self.fz_song_lock = os.path.join(db_root, "fz_song_manifest.lock")
         # if these paths don't exist, make them
         try:
-            if (not os.path.exists(self.fz_song_lib)):
-                logger.warn(self.fz_song_lib + " does not exist, creating...")
-                os.makedirs(self.fz_song_lib)
-                logger.info("home directory created")
             if (not os.path.exists(self.fz_song_sigs)):
-                logger.warn(self.fz_song_sigs + " does not exist, creating...")
+                logger.warning("%s does not exist, creating...", self.fz_song_sigs)
                 os.makedirs(self.fz_song_sigs)
                 logger.info("home directory created")
             if (not os.path.exists(self.fz_song_data)):
-                logger.warn(self.fz_song_data + " does not exist, creating...")
+                logger.warning("%s does not exist, creating...", self.fz_song_data)
                 os.makedirs(self.fz_song_data)
                 logger.info("home directory created")
+            # libraries written before the manifest existed are moved into it once
+            if (not os.path.exists(self.fz_song_manifest)):
+                self.__migrate()
             self.params = param_settings
+            self.metadata_index = None
+            self.hash_table = None
+            self.__reset()
+            self.__recover()
             logger.info("file databaser initialized!")
         except:
             logger.error("error in file database setup", exc_info=True)
@@ -56,64 +544,363 @@ class FileSystemDB(object):
 
     def write(self, song_entry):
         """
-        writes a song_entry to the database, including moving files if necessary
-        """
-        s = song_entry
-        lib_file = os.path.join(self.fz_song_lib, song_entry.song_id + ".pkl")
-        sig_file = os.path.join(self.fz_song_sigs, song_entry.song_id + ".pkl")
-        song_file = os.path.join(self.fz_song_data, song_entry.song_id + ".wav")
-        # use pickle to dump the song entry object into the various files
-        try:
-            logger.info("writing " + s.song_id + " to the library...")
-            # write in the metadata
-            with open(lib_file, 'wb') as output:
-                lib_info = [s.song_id, s.title, s.artist, s.album, s.date]
-                pickle.dump(lib_info, output, pickle.HIGHEST_PROTOCOL)
-            # write in the signatures
-            with open(sig_file, "wb") as output:
-                sigs = {"maxpow":fzcomp.compute_sig_maxpow(s.l_pdgrams, s.samp_rate), 
-                        "posfreq":fzcomp.compute_sig_posfreq(s.freq, s.l_pdgrams)}
-                pickle.dump(sigs, output, pickle.HIGHEST_PROTOCOL)
-            # write in the files
-            # if the file is in temp, we move it to the db
-            if ("temp" in s.address):
-                shutil.move(s.address, song_file)
-            # otherwise, copy it from its initial location
-            else:
-                shutil.copyfile(s.address, song_file)
-            logger.info("song " + s.song_id + " has been written to the database!")
+        writes a song_entry to the database, including moving files if necessary.
+        returns the ids of the songs written
+        """
+        return self.write_many([song_entry])
+
+    def write_many(self, song_entries):
+        """
+        writes many song entries to the database, committing all of them with
+        a single manifest append and fsync. returns the ids of the songs written
+        """
+        records = []
+        for s in song_entries:
+            try:
+                records.append(song_record(s, self.params["storage"],
+                                           self.params["posfreq"].get("peaks")))
+            except:
+                logger.error("failed to write song %s to the database", s.song_id,
+                             exc_info=True)
+        written = self.write_records(records)
+        for s in song_entries:
+            # if the file was downloaded to temp, it is no longer needed
+            if (s.song_id in written and fzio.is_download(s.address)):
+                os.remove(s.address)
+        return written
+
+    def write_records(self, records):
+        """
+        writes library records (see song_record) to the database, committing
+        all of them with a single manifest append and fsync. returns the ids 
+        of the songs written
+        """
+        added = []
+        for record in records:
+            song_id = record["song"][0]
+            sig_file = os.path.join(self.fz_song_sigs, song_id + ".pkl")
+            song_file = os.path.join(self.fz_song_data, song_id + ".fza")
+            try:
+                logger.info("writing %s to the library...", song_id)
+                # write in the signatures
+                self.__write_file(sig_file, pickle.dumps(record["sigs"], pickle.HIGHEST_PROTOCOL))
+                # write in the audio, in the compact storage format
+                if record["audio"] is not None:
+                    self.__write_file(song_file, record["audio"])
+                # the metadata and envelope are committed through the manifest
+                added.append({
+                    "op": "add",
+                    "song": list(record["song"]),
+                    "envelope": fzcomp.compute_sig_envelope(record["sigs"]["maxpow"]).tolist()
+                })
+            except:
+                logger.error("failed to write song %s to the database", song_id, exc_info=True)
+        if not added:
+            return []
+        try:
+            self.__sync_dirs()
+            self.__append(added)
         except:
-            logger.error("failed to write song " + s.song_id + " to the database",
-                         exc_info = True)
+            logger.error("failed to commit %d songs to the database", len(added),
+                         exc_info=True)
+            return []
+        logger.info("%d songs have been written to the database!", len(added))
+        return [record["song"][0] for record in added]
 
     def remove(self, song_id):
+        """
+        removes a song with a given song_id from the library, by committing
+        its tombstone. its files are left for compact to purge
+        """
         try:
-            os.remove(os.path.join(self.fz_song_lib, song_id + ".pkl"))
-            os.remove(os.path.join(self.fz_song_sigs, song_id + ".pkl"))
-            os.remove(os.path.join(self.fz_song_data, song_id + ".wav"))
+            self.__append([{"op": "remove", "id": song_id, "at": time.time()}])
         except:
-            logger.error("failed to remove song " + song_id + " from the database", 
-                         exc_info = True)
+            logger.error("failed to remove song %s from the database", song_id, exc_info=True)
 
-    def lookup(self, song_info):
+    def compact(self):
         """
-        looks up a song given some metadata song_info, returns song_id. not to be 
-        confused with search, which matches signatures
+        purges removed songs: rewrites the manifest with only the songs in
+        the library, then removes the files of the songs it no longer 
+        mentions and drops them from the hash table for good. readers never
+        wait, they pick up the rewritten manifest on their next read. 
+        returns the number of songs purged
         """
-        pass
+        logger.info("compacting the library...")
+        try:
+            with self.__lock():
+                self.__replay()
+                purged = len(self.tombstones)
+                self.__rewrite([{"op": "add", "song": list(song),
+                                 "envelope": None if self.envelopes.get(song[0]) is None
+                                             else self.envelopes[song[0]].tolist()}
+                                for song in self.index])
+                self.__purge_files(time.time() - ORPHAN_GRACE, purge_removed=True)
+                self.__replay()
+            table = self.__sync_hashes()
+            table.compact()
+            self.__save_hashes()
+        except:
+            logger.error("compacting the library failed", exc_info=True)
+            return 0
+        logger.info("%d removed songs purged!", purged)
+        return purged
 
-    def get_info(self, song_id):
+    def __purge_files(self, cutoff, purge_removed=False):
+        """
+        removes the files of songs that are not in the library if they were
+        last modified before cutoff. the files of removed songs are kept, 
+        unless purge_removed, when they go if they were last modified before
+        the song was removed. newer files may be about to be committed by 
+        another process
+        """
+        for directory in [self.fz_song_sigs, self.fz_song_data]:
+            for name in os.listdir(directory):
+                location = os.path.join(directory, name)
+                song_id = name.split(".", 1)[0]
+                removed = song_id in self.tombstones and not name.endswith(".tmp")
+                if ((song_id in self.rows and not name.endswith(".tmp")) or 
+                        (removed and not purge_removed)):
+                    continue
+                removed_at = self.tombstones[song_id] if removed else 0
+                if (os.path.getmtime(location) < max(cutoff, removed_at)):
+                    if removed:
+                        logger.debug("removing file %s", location)
+                    else:
+                        logger.warning("removing orphaned file %s", location)
+                    os.remove(location)
+
+    def __write_file(self, location, data):
+        """
+        atomically writes data to location, through a temp file and a rename
+        """
+        temp_file = location + ".tmp"
+        with open(temp_file, "wb") as output:
+            output.write(data)
+            output.flush()
+            os.fsync(output.fileno())
+        os.replace(temp_file, location)
+
+    def __sync_dirs(self):
+        """
+        flushes renames in the song directories to disk, where supported
+        """
+        if not hasattr(os, "O_DIRECTORY"):
+            return
+        for directory in [self.fz_song_sigs, self.fz_song_data]:
+            fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    @contextlib.contextmanager
+    def __lock(self):
+        """
+        holds the manifest lock, which keeps appends from landing in a 
+        manifest that compact is replacing. readers don't take it
+        """
+        with open(self.fz_song_lock, "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            yield
+
+    def __append(self, records):
+        """
+        commits records to the manifest with a single write and fsync, then
+        applies them
+        """
+        lines = "".join(json.dumps(record) + "\n" for record in records)
+        with self.__lock():
+            self.__replay()
+            with open(self.fz_song_manifest, "a", encoding="utf-8") as manifest:
+                manifest.write(lines)
+                manifest.flush()
+                os.fsync(manifest.fileno())
+            self.__replay()
+
+    def __rewrite(self, records):
+        """
+        atomically replaces the whole manifest with records
+        """
+        self.__write_file(self.fz_song_manifest, 
+                          "".join(json.dumps(record) + "\n" for record in records).encode("utf-8"))
+
+    def __reset(self):
+        """
+        forgets every song, so the manifest is replayed from its start
+        """
+        self.rows = {}
+        self.index = []
+        self.envelopes = {}
+        # removed song ids, to the time they were removed
+        self.tombstones = {}
+        self.manifest_id = None
+        self.manifest_offset = 0
+        self.metadata_index = None
+
+    def __replay(self):
+        """
+        applies the records appended to the manifest since it was last read,
+        by this or any other process. a rewritten manifest is read from the 
+        start. returns the number of bytes at the end of the manifest that 
+        are not a whole record yet
+        """
+        stat = os.stat(self.fz_song_manifest)
+        manifest_id = (stat.st_dev, stat.st_ino)
+        if (manifest_id != self.manifest_id or stat.st_size < self.manifest_offset):
+            self.__reset()
+            self.manifest_id = manifest_id
+        if (stat.st_size == self.manifest_offset):
+            return 0
+        with open(self.fz_song_manifest, "rb") as manifest:
+            manifest.seek(self.manifest_offset)
+            data = manifest.read()
+        complete = data.rfind(b"\n") + 1
+        # a manifest read from the start is sorted into the index once, 
+        # rather than a song at a time
+        rebuild = (self.manifest_offset == 0)
+        for line in data[:complete].splitlines():
+            try:
+                self.__apply(json.loads(line), update_index=not rebuild)
+            except ValueError:
+                logger.warning("skipping a corrupt manifest record")
+        if rebuild:
+            self.index = sorted(self.rows.values())
+        self.manifest_offset += complete
+        return len(data) - complete
+
+    def __apply(self, record, update_index=True):
+        """
+        applies one manifest record to the in-memory library, keeping the 
+        sorted index up to date unless it will be rebuilt
+        """
+        if (record["op"] == "add"):
+            song = record["song"]
+            if song[0] in self.rows:
+                self.__apply({"op": "remove", "id": song[0]}, update_index)
+            self.tombstones.pop(song[0], None)
+            self.rows[song[0]] = song
+            if update_index:
+                bisect.insort(self.index, song)
+            if record.get("envelope") is not None:
+                # envelopes are float32, as the sql databasers and the index store them
+                self.envelopes[song[0]] = np.array(record["envelope"], dtype=np.float32)
+            if self.metadata_index is not None:
+                self.metadata_index.add(song)
+        elif (record["op"] == "remove"):
+            song = self.rows.pop(record["id"], None)
+            if song is None:
+                return
+            self.tombstones[song[0]] = record.get("at", 0)
+            if update_index:
+                del self.index[bisect.bisect_left(self.index, song)]
+            self.envelopes.pop(song[0], None)
+            if self.metadata_index is not None:
+                self.metadata_index.remove(song)
+
+    def __recover(self):
+        """
+        recovers from a crash: drops a torn record at the end of the manifest
+        and removes the files of songs that were never committed, or were 
+        purged by a compaction that didn't finish. recently modified files 
+        are left alone, since another process may be about to commit them
+        """
+        torn = self.__replay()
+        if torn:
+            logger.warning("dropping a torn record at the end of the manifest")
+            with open(self.fz_song_manifest, "r+b") as manifest:
+                manifest.truncate(self.manifest_offset)
+        self.__purge_files(time.time() - ORPHAN_GRACE)
+
+    def __migrate(self):
+        """
+        builds the manifest of a library written before it existed, from the
+        old library index or song files and the old envelopes
         """
-        load a SongEntry object into memory from its id
+        rows = []
+        if os.path.exists(self.fz_song_index):
+            rows = self.__load_pickle(self.fz_song_index)
+        elif os.path.exists(self.fz_song_lib):
+            rows = [self.__load_pickle(os.path.join(self.fz_song_lib, song))
+                    for song in os.listdir(self.fz_song_lib)]
+        envelopes = {}
+        if os.path.exists(self.fz_song_envs):
+            envelopes = self.__load_pickle(self.fz_song_envs)
+        if rows:
+            logger.warning("moving %d songs into the manifest...", len(rows))
+        self.__rewrite([{"op": "add", "song": list(row), 
+                         "envelope": None if envelopes.get(row[0]) is None 
+                                     else envelopes[row[0]].tolist()}
+                        for row in sorted(rows)])
+        for location in [self.fz_song_index, self.fz_song_envs]:
+            if os.path.exists(location):
+                os.remove(location)
+
+    def __load_pickle(self, location):
+        with open(location, "rb") as input_file:
+            return pickle.load(input_file)
+
+    def lookup(self, song_info, prefix=False):
+        """
+        looks up a song given some metadata song_info, returns song_id. not to be 
+        confused with search, which matches signatures. song_info is a dictionary
+        of title, artist and/or album, matched exactly or by prefix, and the ids
+        of every matching song are returned
         """
-        data = os.path.join(self.fz_song_lib, song_id + ".pkl")
         try:
-            with open(data, "rb") as song_file:
-                song = pickle.load(song_file)
-            return song
+            # the index is built from the library once, then kept up to date
+            self.__replay()
+            if self.metadata_index is None:
+                self.metadata_index = MetadataIndex(self.index)
+            return self.metadata_index.lookup(song_info, prefix)
         except:
-            logger.error("song " + song_id + " not found in database")
-        
+            logger.error("there was a problem looking up songs", exc_info=True)
+            return []
+
+    def get_info(self, song_id):
+        """
+        gets the library information of a song from its id
+        """
+        self.__replay()
+        if song_id not in self.rows:
+            logger.error("song %s not found in database", song_id)
+            return None
+        return self.rows[song_id]
+
+    def version(self):
+        """
+        gets the library version, which changes with every committed write,
+        remove or clear
+        """
+        self.__replay()
+        return self.manifest_id + (self.manifest_offset,)
+
+    def get_audio(self, song_id, start=None, end=None):
+        """
+        reads the stored audio of a song between start and end (in seconds), 
+        returns the sampling rate and the audio
+        """
+        # a removed song's file is left for compact, but it isn't readable
+        self.__replay()
+        if song_id not in self.rows:
+            raise KeyError(song_id)
+        song_file = os.path.join(self.fz_song_data, song_id + ".fza")
+        return fzio.decode_audio(fzio.file_range_reader(song_file), start, end)
+
+    def iterate_audio(self, song_ids):
+        """
+        creates a generator of (song_id, stored audio) pairs for the songs in
+        song_ids, where the audio is in the compact storage format, or None 
+        if it was never stored or the song was removed
+        """
+        self.__replay()
+        for song_id in song_ids:
+            song_file = os.path.join(self.fz_song_data, song_id + ".fza")
+            if (song_id not in self.rows or not os.path.exists(song_file)):
+                yield song_id, None
+                continue
+            with open(song_file, "rb") as audio:
+                yield song_id, audio.read()
 
     def update_record(self, song_id, new_info):
         """
@@ -121,23 +908,27 @@ class FileSystemDB(object):
         """
         pass
 
-    def iterate(self):
+    def iterate(self, limit=None, offset=0, filter=None, after=None):
         """
-        creates a generator for the database that can be iterated through
+        creates a generator for the database that can be iterated through, 
+        in song_id order. skips offset songs, then yields at most limit songs 
+        with song_id greater than after, and with filter in their title, 
+        artist or album
         """
-        for song in os.listdir(self.fz_song_lib):
-            song_id = song.rsplit(".", 1)[0]
-            yield self.get_info(song_id)
+        self.__replay()
+        index = list(self.index)
+        start = 0 if after is None else bisect.bisect_right(index, after, key=lambda song: song[0])
+        songs = (song for song in index[start:] 
+                 if filter is None or matches_filter(song, filter))
+        stop = None if limit is None else offset + limit
+        for song in itertools.islice(songs, offset, stop):
+            yield song
         
-    def list_db(self):
+    def list_db(self, limit=None, offset=0, filter=None, after=None):
         """
-        list the entire database
+        list the entire database, or a page of it
         """
-        headers = ["id", "title", "artist", "album", "date"]
-        rows = []
-        for song in self.iterate():
-            rows.append(song)
-        return rows
+        return list(self.iterate(limit, offset, filter, after))
 
     def update_db(self, new_func):
         """
@@ -150,33 +941,143 @@ class FileSystemDB(object):
         """
         linearly searches the database for a snippet of the data 
         """
-        matches = []
-        
-        sig_snippet = fzcomp.compute_sig_maxpow(snippet.l_pdgrams, snippet.samp_rate)
+        sig_snippet = snippet.signature("maxpow")
 
         logger.info("slow searching through the database...")
-        for song in os.listdir(self.fz_song_sigs):
-            # get the appropriate signature from the file
-            sig_full = pickle.load(os.path.join(self.fz_song_sigs, song + ".pkl"))["maxpow"]
-            # if a song matches, then add it's info to our list of matches
-            if (fzcomp.match_signature(sig_snippet, sig_full,
-                                       epsilon=self.params["search"]["threshold_epsilon"])):
-                matches.append(self.get_info(song))
-                logger.info("result " + str(len(matches)) + " found!")
-            # if we have enough matches, stop looking
-            if (len(matches) == num_matches):
-                break
-        return None if len(matches) == 0 else matches
+        for _, matches in search_signatures(self, {"snippet": sig_snippet},
+                                            num_matches=num_matches,
+                                            **search_settings(self.params)):
+            logger.info("%d results found!", len(matches))
+            return None if len(matches) == 0 else match_rows(self, matches)
+
+    def iterate_envelopes(self):
+        """
+        creates a generator of (song_id, envelope) pairs for every song in the
+        database, where the envelope is None if it was never computed
+        """
+        self.__replay()
+        for song in list(self.index):
+            yield song[0], self.envelopes.get(song[0])
+
+    def iterate_signatures(self, sig_type, song_ids=None):
+        """
+        creates a generator of (song_id, signature) pairs for every song in the 
+        database, or only the songs in song_ids, for signatures of type sig_type.
+        songs without a signature of that type are left out, like the sql 
+        databasers do
+        """
+        if song_ids is None:
+            self.__replay()
+            song_ids = [song[0] for song in self.index]
+        for song_id in song_ids:
+            sig_file = os.path.join(self.fz_song_sigs, song_id + ".pkl")
+            # a compacted song's files are gone
+            if not os.path.exists(sig_file):
+                continue
+            with open(sig_file, "rb") as sigs:
+                sigs = pickle.load(sigs)
+            if sig_type in sigs:
+                yield song_id, sigs[sig_type]
+
+    def batch_search(self, snippet_sigs, num_matches=1):
+        """
+        searches the database for many snippets at once with a single pass over
+        the library. snippet_sigs is a dictionary of snippet name to maxpow 
+        signature, and (snippet name, matches) pairs are yielded as they finish
+        """
+        logger.info("batch searching %d snippets...", len(snippet_sigs))
+        for name, matches in search_signatures(self, snippet_sigs, num_matches=num_matches,
+                                               **search_settings(self.params)):
+            yield name, match_rows(self, matches)
+
+    def __sync_hashes(self):
+        """
+        brings the lsh hash table up to date with the library, hashing only 
+        the songs added since it was last saved, and saves it if it changed
+        """
+        version = self.version()
+        settings = lsh_settings(self.params)
+        if (self.hash_table is None and os.path.exists(self.fz_song_hashes)):
+            try:
+                saved = self.__load_pickle(self.fz_song_hashes)
+                if (saved["settings"] == settings):
+                    self.hash_table = HashTable(**saved)
+            except:
+                logger.warning("could not load the hash table, rebuilding it")
+        if self.hash_table is None:
+            self.hash_table = HashTable(settings)
+        if (self.hash_table.version == version):
+            return self.hash_table
+
+        known = self.hash_table.song_ids()
+        self.hash_table.drop(known - set(self.rows))
+        added = [song_id for song_id in self.rows if song_id not in known]
+        logger.info("hashing %d songs into the hash table...", len(added))
+        self.hash_table.add((song_id,) + fzcomp.compute_lsh_hashes(sig, **settings)
+                            for song_id, sig in self.iterate_signatures("posfreq", added))
+        self.hash_table.version = version
+        self.__save_hashes()
+        return self.hash_table
+
+    def __save_hashes(self):
+        try:
+            self.__write_file(self.fz_song_hashes, 
+                              pickle.dumps(vars(self.hash_table), pickle.HIGHEST_PROTOCOL))
+        except:
+            logger.warning("could not save the hash table", exc_info=True)
+
+    def find_hashes(self, hashes):
+        """
+        creates a generator of (hash, song_id, frame) entries of the lsh hash
+        table for every hash in hashes
+        """
+        return self.__sync_hashes().find(hashes)
+
+    def search(self, snippet, num_matches=1):
+        """
+        searches the database for a snippet using locality sensitive hashing
+        of its posfreq signature
+        """
+        logger.info("searching the database with lsh...")
+        matches = lsh_search(self, snippet_posfreq(snippet, self.params), num_matches, 
+                             self.params)
+        logger.info("%d results found!", len(matches))
+        return None if len(matches) == 0 else match_rows(self, matches)
+
+    def plot(self, song_id, save_location=None, start=None, end=None, max_bins=512):
+        """
+        plots the spectrogram of a song in the library, between start and end
+        (in seconds), with at most max_bins frequency bins. returns whether it
+        was plotted
+        """
+        try:
+            logger.info("plotting song %s...", song_id)
+            title = self.get_info(song_id)[1]
+            # only read the audio in the region being plotted
+            samp_rate, data = self.get_audio(song_id, start, end)
+            fzcomp.plot_spectrogram(
+                data, samp_rate,
+                title=title,
+                save_location=save_location,
+                offset=start or 0,
+                max_bins=max_bins
+            )
+            return True
+        except:
+            logger.error("there was an error trying to plot song %s", song_id, exc_info=True)
+            return False
 
     def clear(self):
         """
-        clears the entire database, for testing purposes
+        clears the entire database, for testing purposes, by tombstoning 
+        every song
         """
         logger.info("clearing library...")
         try:
-            for data in os.listdir(self.fz_song_lib):
-                song_id = data.rsplit(".", 1)[0]
-                self.remove(song_id)
+            self.__replay()
+            removed_at = time.time()
+            self.__append([{"op": "remove", "id": song_id, "at": removed_at} 
+                           for song_id in list(self.rows)])
         except:
             logger.error("clearing the library failed", exc_info=True)
         logger.info("library empty!")
@@ -196,6 +1097,9 @@ class PostgreSQLDB:
         self.pw = db_settings["password"]
         # store parameters
         self.params = param_settings
+        # the library version whose hash table was last checked for songs 
+        # missing from it
+        self.hashes_checked = None
 
         conn = None
         logger.info("initializing postgresql databaser...")
@@ -210,7 +1114,7 @@ class PostgreSQLDB:
             params = cur.fetchone()
 
             if (False):
-                logger.warn("specified settings do not match, defaulting to database parameters")
+                logger.warning("specified settings do not match, defaulting to database parameters")
             cur.close()
             logger.info("postgresql databaser initialized!")
         except:
@@ -221,204 +1125,504 @@ class PostgreSQLDB:
                 conn.close()
 
     @staticmethod
-    def __list_to_arr(l):
-        arr = str(l.tolist())
-        arr = arr.replace("[", "{")
-        arr = arr.replace("]", "}")
-        arr = arr.replace("\n", ",")
-        return arr
+    def __pack(sig):
+        buf, n_frames, n_dims = fzio.pack_signature(sig)
+        return (n_frames, n_dims, psycopg2.Binary(buf))
+
+    @staticmethod
+    def __sig_rows(record):
+        """
+        gets the signature table rows of a library record
+        """
+        song_id, maxpow = record["song"][0], record["sigs"]["maxpow"]
+        return [(song_id, "maxpow") + PostgreSQLDB.__pack(maxpow),
+                (song_id, "maxpow_env") + PostgreSQLDB.__pack(fzcomp.compute_sig_envelope(maxpow)),
+                (song_id, "posfreq") + PostgreSQLDB.__pack(record["sigs"]["posfreq"])]
 
     def write(self, song_entry):
         """
-        writes a song_entry to the database, including moving files if necessary
+        writes a song_entry to the database, including moving files if necessary.
+        returns the ids of the songs written
+        """
+        return self.write_many([song_entry])
+
+    def write_many(self, song_entries):
+        """
+        writes a list of song_entries to the database in a single transaction.
+        returns the ids of the songs written
+        """
+        try:
+            records = [song_record(s, self.params["storage"], self.params["posfreq"].get("peaks"))
+                       for s in song_entries]
+        except:
+            logger.error("there was a problem analysing songs for the library", exc_info=True)
+            return []
+        written = self.write_records(records)
+        # if the files were downloaded to temp, they are no longer needed
+        for s in song_entries:
+            if (s.song_id in written and fzio.is_download(s.address)):
+                os.remove(s.address)
+        return written
+
+    def write_records(self, records):
+        """
+        writes library records (see song_record) to the database in a single
+        transaction, with multi-row inserts, falling back to a transaction per
+        song if that fails (see write_batch). returns the ids of the songs 
+        written
         """
         conn = None
-    
-        logger.info("writing song " + song_entry.song_id + " into the library")
-        # sql commands
+        purge_lib = """
+                    DELETE FROM fz_song_library WHERE song_id = ANY(%s) 
+                    AND song_id IN (SELECT song_id FROM fz_song_tombstones);
+                    """
         insert_lib = """
                      INSERT INTO fz_song_library (
                         song_id, title, artist, album, 
                         release_date, length
-                     ) VALUES (%s, %s, %s, %s, %s, %s);
+                     ) VALUES %s;
                      """
         insert_sig = """
-                     INSERT INTO fz_song_signatures (song_id, sig_type, sig_)
-                     VALUES (%s, %s, %s);
+                     INSERT INTO fz_song_signatures (
+                        song_id, sig_type, n_frames, n_dims, sig_
+                     ) VALUES %s;
                      """
         insert_dat = """
                      INSERT INTO fz_song_data (song_id, samp_rate, data)
-                     VALUES (%s, %s, %s);
+                     VALUES %s;
                      """
+        insert_hash = """
+                      INSERT INTO fz_song_hashes (hash, song_id, frame)
+                      VALUES %s;
+                      """
         try:
-            # connect to db
+            logger.info("writing %d songs into the library", len(records))
             conn = psycopg2.connect(host=self.host, database=self.db, 
                                     user=self.user, password=self.pw)
-            cur = conn.cursor()
-            # insert metadata
-            s = song_entry
-            logger.info("inserting song metadata...")
-            cur.execute(insert_lib, (s.song_id, s.title, s.artist, 
-                                     s.album, s.date, s.length))
-            # insert song signature
-            logger.info("inserting song signatures...")
-            # cur.execute(insert_sig, (song_id, "pdgram", PostgreSQLDB.__list_to_arr(s.l_pdgrams)))
-            cur.execute(insert_sig, 
-                        (s.song_id, "maxpow", 
-                         PostgreSQLDB.__list_to_arr(fzcomp.compute_sig_maxpow(s.l_pdgrams, s.samp_rate))))
-            cur.execute(insert_sig,
-                        (s.song_id, "posfreq",
-                        PostgreSQLDB.__list_to_arr(fzcomp.compute_sig_posfreq(s.freq, s.l_pdgrams))))
-            # insert song data
-            logger.info("inserting song file...")
-            cur.execute(insert_dat, (s.song_id, s.samp_rate, psycopg2.Binary(pickle.dumps(s.data))))
-            # commit and clean up
-            conn.commit()
-            cur.close()
-            logger.info("song " + s.song_id + " has been written to the library!")
+            self.__record_hash_settings(conn)
+            settings = lsh_settings(self.params)
+            def insert(records):
+                # commits, or rolls back if anything fails
+                with conn, conn.cursor() as cur:
+                    # removed songs that are added again are purged first
+                    cur.execute(purge_lib, ([record["song"][0] for record in records],))
+                    # rows are generated as they are sent, a page at a time
+                    psycopg2.extras.execute_values(cur, insert_lib, 
+                                                   [tuple(record["song"]) for record in records])
+                    psycopg2.extras.execute_values(cur, insert_sig, 
+                                                   (row for record in records 
+                                                    for row in PostgreSQLDB.__sig_rows(record)))
+                    psycopg2.extras.execute_values(cur, insert_dat, 
+                                                   ((record["song"][0], 
+                                                     audio_rate(record["audio"]),
+                                                     psycopg2.Binary(record["audio"]))
+                                                    for record in records 
+                                                    if record["audio"] is not None))
+                    psycopg2.extras.execute_values(cur, insert_hash, 
+                                                   (row for record in records 
+                                                    for row in hash_rows(record, settings)),
+                                                   page_size=1000)
+            written = write_batch(insert, records)
+            logger.info("%d songs have been written to the library!", len(written))
+            return written
         except:
-            logger.error("there was a problem writing " + s.song_id + " to the libary", exc_info=True)
+            logger.error("there was a problem writing songs to the library", exc_info=True)
+            return []
         finally:
             if conn is not None:
                 conn.close()
         
     def remove(self, song_id):
         """
-        removes a song with a given song_id from the library
+        removes a song with a given song_id from the library, by tombstoning
+        it. its rows are left for compact to purge
         """
         conn = None
 
-        delete_sql = """
-                     DELETE FROM fz_song_library WHERE song_id = %s;
+        remove_sql = """
+                     INSERT INTO fz_song_tombstones (song_id)
+                     SELECT song_id FROM fz_song_library WHERE song_id = %s
+                     ON CONFLICT DO NOTHING;
                      """
         try:
             # connect to db
             conn = psycopg2.connect(host=self.host, database=self.db, 
                                     user=self.user, password=self.pw)
             cur = conn.cursor()
-            # run delete commands
-            cur.execute(delete_sql, song_id)
+            # tombstone the song
+            cur.execute(remove_sql, (song_id,))
             conn.commit()
             cur.close()
-            logger.info("song " + song_id + " has been removed from the library!")
+            logger.info("song %s has been removed from the library!", song_id)
         except:
-            logger.error("there was a problem removing " + song_id + " from the library")
+            logger.error("there was a problem removing %s from the library", song_id, exc_info=True)
         finally:
             if conn is not None:
                 conn.close()
 
-    def lookup(self, song_info):
-        # TODO: set this up, probably need some preprocessing on song entry
+    def lookup(self, song_info, prefix=False):
         """
         looks up a song given some metadata song_info, returns song_id. not to be 
-        confused with search, which matches signatures
-        """
-        pass
-
-    def update_record(self, song_id, new_info):
-        # TODO: set this up
-        """
-        updates a certain song_id with new_info
-        """
-        pass
-
-    def list_db(self):
-        """
-        list the entire database
+        confused with search, which matches signatures. song_info is a dictionary
+        of title, artist and/or album, matched exactly or by prefix, and the ids
+        of every matching song are returned
         """
-        logger.info("listing the database")
-        headers = ["id", "title", "artist", "album", "date", "length"]
-        rows = []
         conn = None
-        list_sql = """
-                   SELECT song_id, title, artist, album, release_date, length
-                   FROM fz_song_library;
-                   """
+        # metadata is stored in lower case, and the text_pattern_ops indexes 
+        # serve both the exact and the prefix comparisons
+        fields = [field for field in ["title", "artist", "album"] if field in song_info]
+        if not fields:
+            return []
+        op = "LIKE %s ESCAPE '\\'" if prefix else "= %s"
+        lookup_sql = "SELECT song_id FROM fz_song_library WHERE " + \
+                     " AND ".join(field + " " + op for field in fields) + \
+                     " AND song_id NOT IN (SELECT song_id FROM fz_song_tombstones)" + \
+                     " ORDER BY song_id;"
+        values = [song_info[field].lower() for field in fields]
+        if prefix:
+            values = [prefix_pattern(value) for value in values]
         try:
-            # connect to db
             conn = psycopg2.connect(host=self.host, database=self.db, 
                                     user=self.user, password=self.pw)
             cur = conn.cursor()
-            # run the list command
-            cur.execute(list_sql)
-            rows = cur.fetchall()
-            # clean up
+            cur.execute(lookup_sql, values)
+            song_ids = [row[0] for row in cur.fetchall()]
             cur.close()
+            return song_ids
         except:
-            logger.error("there was an error in listing the database")
+            logger.error("there was a problem looking up songs", exc_info=True)
+            return []
         finally:
             if conn is not None:
                 conn.close()
 
-        return rows
-
-    def slow_search(self, snippet, num_matches=1):
+    def get_audio(self, song_id, start=None, end=None):
         """
-        linearly searches the database for a snippet of the data 
+        reads the stored audio of a song between start and end (in seconds), 
+        only fetching the byte ranges of the blob that are needed. returns 
+        the sampling rate and the audio
         """
         conn = None
-        matches = []
-        results = []
-        sig_sql = """
-                  SELECT song_id, sig_ 
-                  FROM fz_song_signatures WHERE sig_type = maxpow;
-                  """
-        inf_sql = """
-                  SELECT song_id, title, artist, album, release_date, length
-                  FROM fz_song_library WHERE song_id = %s;
-                  """
-        sig_snippet = fzcomp.compute_sig_maxpow(snippet.l_pdgrams, snippet.samp_rate)
+        range_sql = """
+                    SELECT substring(data FROM %s FOR %s) FROM fz_song_data
+                    WHERE song_id = %s
+                    AND song_id NOT IN (SELECT song_id FROM fz_song_tombstones);
+                    """
         try:
-            logger.info("slow searching through the database...")
             conn = psycopg2.connect(host=self.host, database=self.db, 
                                     user=self.user, password=self.pw)
             cur = conn.cursor()
-            cur.execute(sig_sql)
-            song = cur.fetchone()
+            def read_at(offset, length):
+                # postgres byte positions start at 1
+                cur.execute(range_sql, (offset + 1, length, song_id))
+                row = cur.fetchone()
+                if row is None:
+                    raise KeyError(song_id)
+                return bytes(row[0])
+            audio = fzio.decode_audio(read_at, start, end)
+            cur.close()
+            return audio
+        finally:
+            if conn is not None:
+                conn.close()
 
-            while song is not None:
-                # pull the signature from the song
-                sig_full = np.array(song[1])
-                # and match it
-                if (fzcomp.match_signature(sig_snippet, sig_full, 
-                                            epsilon=self.params["search"]["threshold_epsilon"])):
-                    matches.append(song[0])
-                    logger.info("result " + str(len(matches)) +" found!")
-                # if we have reached num_matches, break
-                if (len(matches) == num_matches):
-                    logger.info("DONE!")
-                    break
-                # otherwise get the next row
-                song = cur.fetchone()
-            # if there are no matches, return None
-            if matches == []:
-                return None
-            # otherwise, get the song information
-            for match in matches:
-                cur.execute(inf_sql, (match,))
-                results.append(cur.fetchall()[0])
-            return results
+    def iterate_audio(self, song_ids):
+        """
+        creates a generator of (song_id, stored audio) pairs for the songs in
+        song_ids, where the audio is in the compact storage format, or None 
+        if it was never stored or the song was removed
+        """
+        conn = None
+        audio_sql = """
+                    SELECT song_id, data FROM fz_song_data WHERE song_id = ANY(%s)
+                    AND song_id NOT IN (SELECT song_id FROM fz_song_tombstones);
+                    """
+        try:
+            conn = psycopg2.connect(host=self.host, database=self.db, 
+                                    user=self.user, password=self.pw)
+            cur = conn.cursor()
+            # fetch a chunk of songs per round trip
+            for k in range(0, len(song_ids), 500):
+                chunk = list(song_ids[k:k + 500])
+                cur.execute(audio_sql, (chunk,))
+                found = dict((song_id, bytes(data)) for song_id, data in cur.fetchall())
+                for song_id in chunk:
+                    yield song_id, found.get(song_id)
+            cur.close()
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def update_record(self, song_id, new_info):
+        # TODO: set this up
+        """
+        updates a certain song_id with new_info
+        """
+        pass
+
+    def iterate(self, limit=None, offset=0, filter=None, after=None):
+        """
+        creates a generator for the database that can be iterated through, 
+        in song_id order. skips offset songs, then yields at most limit songs 
+        with song_id greater than after, and with filter in their title, 
+        artist or album. rows are fetched a page at a time
+        """
+        conn = None
+        list_sql = """
+                   SELECT song_id, title, artist, album, release_date, length
+                   FROM fz_song_library
+                   WHERE (%(after)s IS NULL OR song_id > %(after)s)
+                   AND (%(filter)s IS NULL OR title ILIKE %(filter)s ESCAPE '\\'
+                        OR artist ILIKE %(filter)s ESCAPE '\\'
+                        OR album ILIKE %(filter)s ESCAPE '\\')
+                   AND song_id NOT IN (SELECT song_id FROM fz_song_tombstones)
+                   ORDER BY song_id
+                   LIMIT %(count)s OFFSET %(offset)s;
+                   """
+        pattern = None if filter is None else contains_pattern(filter)
+        try:
+            # connect to db
+            conn = psycopg2.connect(host=self.host, database=self.db, 
+                                    user=self.user, password=self.pw)
+            cur = conn.cursor()
+            def query_page(after, offset, count):
+                cur.execute(list_sql, {"after": after, "filter": pattern,
+                                       "count": count, "offset": offset})
+                return cur.fetchall()
+            for row in page_rows(query_page, limit, offset, after):
+                yield row
+            cur.close()
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def list_db(self, limit=None, offset=0, filter=None, after=None):
+        """
+        list the entire database, or a page of it
+        """
+        logger.info("listing the database")
+        try:
+            return list(self.iterate(limit, offset, filter, after))
+        except:
+            logger.error("there was an error in listing the database")
+            return []
+
+    def slow_search(self, snippet, num_matches=1):
+        """
+        linearly searches the database for a snippet of the data 
+        """
+        sig_snippet = snippet.signature("maxpow")
+        try:
+            logger.info("slow searching through the database...")
+            for _, matches in search_signatures(self, {"snippet": sig_snippet},
+                                                num_matches=num_matches,
+                                                **search_settings(self.params)):
+                logger.info("%d results found!", len(matches))
+                # if there are no matches, return None
+                return None if len(matches) == 0 else match_rows(self, matches)
         except:
+            # a failed search must not look like one that found nothing
             logger.error("could not search for the provided snippet", exc_info = True)
+            raise
+
+    def get_info(self, song_id):
+        """
+        gets the library information of a song from its id
+        """
+        conn = None
+        inf_sql = """
+                  SELECT song_id, title, artist, album, release_date, length
+                  FROM fz_song_library WHERE song_id = %s
+                  AND song_id NOT IN (SELECT song_id FROM fz_song_tombstones);
+                  """
+        try:
+            conn = psycopg2.connect(host=self.host, database=self.db, 
+                                    user=self.user, password=self.pw)
+            cur = conn.cursor()
+            cur.execute(inf_sql, (song_id,))
+            song = cur.fetchone()
+            cur.close()
+            return song
+        except:
+            logger.error("song %s not found in database", song_id)
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def version(self):
+        """
+        gets the library version, which a trigger bumps with every change to
+        the library
+        """
+        conn = None
+        try:
+            conn = psycopg2.connect(host=self.host, database=self.db, 
+                                    user=self.user, password=self.pw)
+            cur = conn.cursor()
+            cur.execute("SELECT version FROM fz_library_version;")
+            version = cur.fetchone()[0]
+            cur.close()
+            return version
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def iterate_envelopes(self):
+        """
+        creates a generator of (song_id, envelope) pairs for every song in the
+        database, where the envelope is None if it was never computed
+        """
+        conn = None
+        env_sql = """
+                  SELECT l.song_id, s.n_frames, s.n_dims, s.sig_
+                  FROM fz_song_library l LEFT JOIN fz_song_signatures s
+                  ON s.song_id = l.song_id AND s.sig_type = 'maxpow_env'
+                  WHERE l.song_id NOT IN (SELECT song_id FROM fz_song_tombstones);
+                  """
+        try:
+            conn = psycopg2.connect(host=self.host, database=self.db, 
+                                    user=self.user, password=self.pw)
+            cur = conn.cursor(name="fz_iterate_envelopes")
+            cur.execute(env_sql)
+            for song_id, n_frames, n_dims, env in cur:
+                yield song_id, None if env is None else \
+                    fzio.unpack_signature(env, n_frames, n_dims)
+            cur.close()
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def iterate_signatures(self, sig_type, song_ids=None):
+        """
+        creates a generator of (song_id, signature) pairs for every song in the 
+        database, or only the songs in song_ids, for signatures of type sig_type
+        """
+        conn = None
+        sig_sql = """
+                  SELECT song_id, n_frames, n_dims, sig_ 
+                  FROM fz_song_signatures WHERE sig_type = %s
+                  AND (%s OR song_id = ANY(%s))
+                  AND song_id NOT IN (SELECT song_id FROM fz_song_tombstones);
+                  """
+        try:
+            conn = psycopg2.connect(host=self.host, database=self.db, 
+                                    user=self.user, password=self.pw)
+            # stream the signatures with a server side cursor
+            cur = conn.cursor(name="fz_iterate_signatures")
+            cur.execute(sig_sql, (sig_type, song_ids is None, song_ids or []))
+            for song_id, n_frames, n_dims, sig in cur:
+                yield song_id, fzio.unpack_signature(sig, n_frames, n_dims)
+            cur.close()
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def batch_search(self, snippet_sigs, num_matches=1):
+        """
+        searches the database for many snippets at once with a single pass over
+        the library. snippet_sigs is a dictionary of snippet name to maxpow 
+        signature, and (snippet name, matches) pairs are yielded as they finish
+        """
+        logger.info("batch searching %d snippets...", len(snippet_sigs))
+        for name, matches in search_signatures(self, snippet_sigs, num_matches=num_matches,
+                                               **search_settings(self.params)):
+            yield name, match_rows(self, matches)
+
+    def __record_hash_settings(self, conn):
+        """
+        records the settings the hash table is made with when the first songs
+        are written, and refuses to add hashes made with other settings
+        """
+        record_sql = """
+                     INSERT INTO fz_lsh_settings (bins, n_hashes, bands, peaks)
+                     SELECT %s, %s, %s, %s
+                     WHERE NOT EXISTS (SELECT 1 FROM fz_lsh_settings);
+                     """
+        with conn, conn.cursor() as cur:
+            cur.execute(record_sql, tuple(hash_settings(self.params).values()))
+            cur.execute("SELECT bins, n_hashes, bands, peaks FROM fz_lsh_settings;")
+            check_hash_settings(cur.fetchone(), self.params)
+
+    def __check_hashes(self):
+        """
+        refuses to search a hash table made with other settings, and warns 
+        once per library version about songs with no hashes, like the songs 
+        written before the hash table was
+        """
+        conn = None
+        unhashed_sql = """
+                       SELECT count(*) FROM fz_song_library AS l
+                       WHERE NOT EXISTS (SELECT 1 FROM fz_song_hashes AS h 
+                                         WHERE h.song_id = l.song_id)
+                       AND song_id NOT IN (SELECT song_id FROM fz_song_tombstones);
+                       """
+        try:
+            conn = psycopg2.connect(host=self.host, database=self.db, 
+                                    user=self.user, password=self.pw)
+            cur = conn.cursor()
+            cur.execute("SELECT bins, n_hashes, bands, peaks FROM fz_lsh_settings;")
+            check_hash_settings(cur.fetchone(), self.params)
+            cur.execute("SELECT version FROM fz_library_version;")
+            version = cur.fetchone()[0]
+            if (self.hashes_checked != version):
+                cur.execute(unhashed_sql)
+                unhashed = cur.fetchone()[0]
+                if (unhashed > 0):
+                    logger.warning("%d songs have no lsh hashes, so posfreq searches can't "
+                                   "find them. remove and add them again to hash them", unhashed)
+                self.hashes_checked = version
+            cur.close()
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def find_hashes(self, hashes):
+        """
+        creates a generator of (hash, song_id, frame) rows of the hash table
+        for every hash in hashes
+        """
+        conn = None
+        hash_sql = """
+                   SELECT hash, song_id, frame FROM fz_song_hashes WHERE hash = ANY(%s)
+                   AND song_id NOT IN (SELECT song_id FROM fz_song_tombstones);
+                   """
+        try:
+            conn = psycopg2.connect(host=self.host, database=self.db, 
+                                    user=self.user, password=self.pw)
+            cur = conn.cursor()
+            # look up a chunk of hashes per round trip
+            for k in range(0, len(hashes), 500):
+                cur.execute(hash_sql, (list(hashes[k:k + 500]),))
+                for row in cur.fetchall():
+                    yield row
+            cur.close()
         finally:
             if conn is not None:
                 conn.close()
 
     def search(self, snippet, num_matches=1):
-        # TODO: build this
         """
-        searches the database using locality sensitive hashing
+        searches the database for a snippet using locality sensitive hashing
+        of its posfreq signature
         """
-        pass
+        logger.info("searching the database with lsh...")
+        self.__check_hashes()
+        matches = lsh_search(self, snippet_posfreq(snippet, self.params), num_matches, 
+                             self.params)
+        logger.info("%d results found!", len(matches))
+        return None if len(matches) == 0 else match_rows(self, matches)
 
     def clear(self):
         """
-        clears the entire database, for testing purposes
+        clears the entire database, for testing purposes, by tombstoning 
+        every song
         """
         conn = None
 
         delete_sql = """
-                     DELETE FROM fz_song_library;
+                     INSERT INTO fz_song_tombstones (song_id)
+                     SELECT song_id FROM fz_song_library
+                     ON CONFLICT DO NOTHING;
                      """
         try:
             logger.info("clearing the database...")
@@ -430,49 +1634,962 @@ class PostgreSQLDB:
             cur.close()
             logger.info("database cleared!")
         except:
-            logger.error("could not clear database")
+            logger.error("could not clear database", exc_info=True)
         finally:
             if conn is not None:
                 conn.close()
 
-    def plot(self, song_id, save_location=None):
+    def compact(self, batch_size=100):
         """
-        plots the spectrogram of a song in the library
+        purges tombstoned songs from every table, batch_size songs per 
+        transaction so that writers are only ever held up briefly and 
+        readers not at all, then vacuums the tables to reuse their space. 
+        returns the number of songs purged
         """
         conn = None
-        # sql commands
-        data_sql = """
-                   SELECT samp_rate, data FROM fz_song_data
-                   WHERE song_id = %s;
-                   """
-        name_sql = """
-                   SELECT title FROM fz_song_library
-                   WHERE song_id = %s;
-                   """
+        purge_sql = """
+                    DELETE FROM fz_song_library WHERE song_id IN (
+                        SELECT song_id FROM fz_song_tombstones LIMIT %s
+                    );
+                    """
+        purged = 0
         try:
-            logger.info("plotting song " + song_id + "...")
+            logger.info("compacting the database...")
             conn = psycopg2.connect(host=self.host, database=self.db, 
                                     user=self.user, password=self.pw)
             cur = conn.cursor()
-            # get the data
-            cur.execute(data_sql, (song_id,))
-            samp_rate, data = cur.fetchone()
-            data = pickle.loads(data)
-            # get the title
-            cur.execute(name_sql, (song_id,))
-            title = cur.fetchone()[0]
+            while True:
+                # the tombstones go with their songs
+                cur.execute(purge_sql, (batch_size,))
+                conn.commit()
+                if (cur.rowcount == 0):
+                    break
+                purged += cur.rowcount
+            # a plain vacuum runs alongside reads and writes
+            conn.autocommit = True
+            for table in ["fz_song_library", "fz_song_signatures", "fz_song_hashes", 
+                          "fz_song_data"]:
+                cur.execute("VACUUM ANALYZE " + table + ";")
+            cur.close()
+            logger.info("%d removed songs purged!", purged)
+        except:
+            logger.error("could not compact the database", exc_info=True)
+        finally:
+            if conn is not None:
+                conn.close()
+        return purged
+
+    def plot(self, song_id, save_location=None, start=None, end=None, max_bins=512):
+        """
+        plots the spectrogram of a song in the library, between start and end
+        (in seconds), with at most max_bins frequency bins. returns whether it
+        was plotted
+        """
+        try:
+            logger.info("plotting song %s...", song_id)
+            title = self.get_info(song_id)[1]
+            # only fetch the audio in the region being plotted
+            samp_rate, data = self.get_audio(song_id, start, end)
             fzcomp.plot_spectrogram(
                 data, samp_rate,
-                window_fn=self.params["periodograms"]["window_fn"],
-                h=self.params["periodograms"]["window_size"],
                 title=title,
-                save_location=save_location
+                save_location=save_location,
+                offset=start or 0,
+                max_bins=max_bins
             )
+            return True
         except:
-            logger.error("there was an error trying to plot song " + song_id, exc_info=True)
+            logger.error("there was an error trying to plot song %s", song_id, exc_info=True)
+            return False
+        
+
+
+
+
+class SQLiteDB(object):
+    """
+    provides functions for reading and writing to a database
+    represented as a sqlite file, which needs no database server
+    """
+
+    SCHEMA = """
+             CREATE TABLE IF NOT EXISTS fz_song_library (
+                song_id TEXT PRIMARY KEY,
+                title TEXT,
+                artist TEXT,
+                album TEXT,
+                release_date TEXT,
+                length REAL
+             );
+
+             CREATE INDEX IF NOT EXISTS fz_song_library_title ON fz_song_library (title);
+             CREATE INDEX IF NOT EXISTS fz_song_library_artist ON fz_song_library (artist);
+             CREATE INDEX IF NOT EXISTS fz_song_library_album ON fz_song_library (album);
+
+             CREATE TABLE IF NOT EXISTS fz_song_signatures (
+                song_id TEXT NOT NULL,
+                sig_type TEXT NOT NULL,
+                n_frames INTEGER NOT NULL,
+                n_dims INTEGER NOT NULL,
+                sig_ BLOB NOT NULL,
+                PRIMARY KEY (sig_type, song_id),
+                FOREIGN KEY (song_id) REFERENCES fz_song_library (song_id) ON DELETE CASCADE
+             ) WITHOUT ROWID;
+             CREATE INDEX IF NOT EXISTS fz_song_signatures_song_id 
+                ON fz_song_signatures (song_id);
+
+             CREATE TABLE IF NOT EXISTS fz_song_hashes (
+                hash INTEGER NOT NULL,
+                song_id TEXT NOT NULL,
+                frame INTEGER NOT NULL,
+                FOREIGN KEY (song_id) REFERENCES fz_song_library (song_id) ON DELETE CASCADE
+             );
+             CREATE INDEX IF NOT EXISTS fz_song_hashes_hash ON fz_song_hashes (hash);
+             CREATE INDEX IF NOT EXISTS fz_song_hashes_song_id ON fz_song_hashes (song_id);
+
+             CREATE TABLE IF NOT EXISTS fz_lsh_settings (
+                bins INTEGER NOT NULL,
+                n_hashes INTEGER NOT NULL,
+                bands INTEGER NOT NULL,
+                peaks INTEGER
+             );
+
+             CREATE TABLE IF NOT EXISTS fz_song_data (
+                song_id TEXT PRIMARY KEY,
+                samp_rate INTEGER,
+                data BLOB,
+                FOREIGN KEY (song_id) REFERENCES fz_song_library (song_id) ON DELETE CASCADE
+             );
+
+             CREATE TABLE IF NOT EXISTS fz_library_version (
+                version INTEGER NOT NULL
+             );
+             INSERT INTO fz_library_version (version) 
+                SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM fz_library_version);
+             CREATE TRIGGER IF NOT EXISTS fz_song_library_added 
+                AFTER INSERT ON fz_song_library
+                BEGIN UPDATE fz_library_version SET version = version + 1; END;
+             CREATE TRIGGER IF NOT EXISTS fz_song_library_updated 
+                AFTER UPDATE ON fz_song_library
+                BEGIN UPDATE fz_library_version SET version = version + 1; END;
+             CREATE TRIGGER IF NOT EXISTS fz_song_library_removed 
+                AFTER DELETE ON fz_song_library
+                BEGIN UPDATE fz_library_version SET version = version + 1; END;
+
+             CREATE TABLE IF NOT EXISTS fz_song_tombstones (
+                song_id TEXT PRIMARY KEY,
+                removed_at REAL NOT NULL,
+                FOREIGN KEY (song_id) REFERENCES fz_song_library (song_id) ON DELETE CASCADE
+             ) WITHOUT ROWID;
+             CREATE TRIGGER IF NOT EXISTS fz_song_tombstones_added 
+                AFTER INSERT ON fz_song_tombstones
+                BEGIN UPDATE fz_library_version SET version = version + 1; END;
+             CREATE TRIGGER IF NOT EXISTS fz_song_tombstones_removed 
+                AFTER DELETE ON fz_song_tombstones
+                BEGIN UPDATE fz_library_version SET version = version + 1; END;
+             """
+
+    def __init__(self, db_settings, param_settings):
+        """
+        initializes a sqlite databaser, creating the database if needed
+        """
+        logger.info("initializing sqlite databaser...")
+        self.address = db_settings["address"]
+        self.params = param_settings
+        # the library version whose hash table was last checked for songs 
+        # missing from it
+        self.hashes_checked = None
+        conn = None
+        try:
+            conn = self.__connect()
+            # write ahead logging lets searches read while songs are written
+            conn.execute("PRAGMA journal_mode = WAL;")
+            conn.executescript(SQLiteDB.SCHEMA)
+            conn.commit()
+            logger.info("sqlite databaser initialized!")
+        except:
+            logger.error("database setup failed, aborting...", exc_info=True)
+            sys.exit()
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def __connect(self):
+        conn = sqlite3.connect(self.address, timeout=30)
+        conn.execute("PRAGMA foreign_keys = ON;")
+        conn.execute("PRAGMA synchronous = NORMAL;")
+        return conn
+
+    @staticmethod
+    def __pack(sig):
+        buf, n_frames, n_dims = fzio.pack_signature(sig)
+        return (n_frames, n_dims, buf)
+
+    def write(self, song_entry):
+        """
+        writes a song_entry to the database, returns the ids of the songs written
+        """
+        return self.write_many([song_entry])
+
+    @staticmethod
+    def __sig_rows(record):
+        """
+        gets the signature table rows of a library record
+        """
+        song_id, maxpow = record["song"][0], record["sigs"]["maxpow"]
+        return [(song_id, "maxpow") + SQLiteDB.__pack(maxpow),
+                (song_id, "maxpow_env") + SQLiteDB.__pack(fzcomp.compute_sig_envelope(maxpow)),
+                (song_id, "posfreq") + SQLiteDB.__pack(record["sigs"]["posfreq"])]
+
+    def write_many(self, song_entries):
+        """
+        writes a list of song_entries to the database in a single transaction.
+        returns the ids of the songs written
+        """
+        try:
+            records = [song_record(s, self.params["storage"], self.params["posfreq"].get("peaks"))
+                       for s in song_entries]
+        except:
+            logger.error("there was a problem analysing songs for the library", exc_info=True)
+            return []
+        written = self.write_records(records)
+        # if the files were downloaded to temp, they are no longer needed
+        for s in song_entries:
+            if (s.song_id in written and fzio.is_download(s.address)):
+                os.remove(s.address)
+        return written
+
+    def write_records(self, records):
+        """
+        writes library records (see song_record) to the database in a single
+        transaction, falling back to a transaction per song if that fails 
+        (see write_batch). returns the ids of the songs written
+        """
+        conn = None
+        purge_lib = """
+                    DELETE FROM fz_song_library WHERE song_id = ?
+                    AND song_id IN (SELECT song_id FROM fz_song_tombstones);
+                    """
+        insert_lib = """
+                     INSERT INTO fz_song_library (
+                        song_id, title, artist, album, release_date, length
+                     ) VALUES (?, ?, ?, ?, ?, ?);
+                     """
+        insert_sig = """
+                     INSERT INTO fz_song_signatures (
+                        song_id, sig_type, n_frames, n_dims, sig_
+                     ) VALUES (?, ?, ?, ?, ?);
+                     """
+        insert_dat = """
+                     INSERT INTO fz_song_data (song_id, samp_rate, data)
+                     VALUES (?, ?, ?);
+                     """
+        insert_hash = """
+                      INSERT INTO fz_song_hashes (hash, song_id, frame)
+                      VALUES (?, ?, ?);
+                      """
+        try:
+            logger.info("writing %d songs into the library", len(records))
+            conn = self.__connect()
+            self.__record_hash_settings(conn)
+            settings = lsh_settings(self.params)
+            def insert(records):
+                # commits, or rolls back if anything fails
+                with conn:
+                    # removed songs that are added again are purged first
+                    conn.executemany(purge_lib, ((record["song"][0],) for record in records))
+                    conn.executemany(insert_lib, (tuple(record["song"]) for record in records))
+                    conn.executemany(insert_sig, (row for record in records 
+                                                  for row in SQLiteDB.__sig_rows(record)))
+                    conn.executemany(insert_dat, ((record["song"][0], 
+                                                   audio_rate(record["audio"]),
+                                                   record["audio"])
+                                                  for record in records 
+                                                  if record["audio"] is not None))
+                    conn.executemany(insert_hash, (row for record in records 
+                                                   for row in hash_rows(record, settings)))
+            written = write_batch(insert, records)
+            logger.info("%d songs have been written to the library!", len(written))
+            return written
+        except:
+            logger.error("there was a problem writing songs to the library", exc_info=True)
+            return []
         finally:
             if conn is not None:
                 conn.close()
-        
 
+    def remove(self, song_id):
+        """
+        removes a song with a given song_id from the library, by tombstoning
+        it. its rows are left for compact to purge
+        """
+        conn = None
+        remove_sql = """
+                     INSERT OR IGNORE INTO fz_song_tombstones (song_id, removed_at)
+                     SELECT song_id, ? FROM fz_song_library WHERE song_id = ?;
+                     """
+        try:
+            conn = self.__connect()
+            with conn:
+                conn.execute(remove_sql, (time.time(), song_id))
+            logger.info("song %s has been removed from the library!", song_id)
+        except:
+            logger.error("there was a problem removing %s from the library", song_id, exc_info=True)
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def lookup(self, song_info, prefix=False):
+        """
+        looks up a song given some metadata song_info, returns song_id. not to be 
+        confused with search, which matches signatures. song_info is a dictionary
+        of title, artist and/or album, matched exactly or by prefix, and the ids
+        of every matching song are returned
+        """
+        conn = None
+        fields = [field for field in ["title", "artist", "album"] if field in song_info]
+        if not fields:
+            return []
+        values = [song_info[field].lower() for field in fields]
+        # prefixes are looked up as ranges, so they can use the indexes
+        if prefix:
+            clauses = ["(" + field + " >= ? AND " + field + " < ?)" for field in fields]
+            values = [bound for value in values 
+                      for bound in (value, value + chr(0x10FFFF))]
+        else:
+            clauses = [field + " = ?" for field in fields]
+        lookup_sql = "SELECT song_id FROM fz_song_library WHERE " + \
+                     " AND ".join(clauses + ["song_id NOT IN (SELECT song_id FROM fz_song_tombstones)"]) + \
+                     " ORDER BY song_id;"
+        try:
+            conn = self.__connect()
+            return [row[0] for row in conn.execute(lookup_sql, values)]
+        except:
+            logger.error("there was a problem looking up songs", exc_info=True)
+            return []
+        finally:
+            if conn is not None:
+                conn.close()
 
+    def get_info(self, song_id):
+        """
+        gets the library information of a song from its id
+        """
+        conn = None
+        inf_sql = """
+                  SELECT song_id, title, artist, album, release_date, length
+                  FROM fz_song_library WHERE song_id = ?
+                  AND song_id NOT IN (SELECT song_id FROM fz_song_tombstones);
+                  """
+        try:
+            conn = self.__connect()
+            return conn.execute(inf_sql, (song_id,)).fetchone()
+        except:
+            logger.error("song %s not found in database", song_id)
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def version(self):
+        """
+        gets the library version, which triggers bump with every change to 
+        the library
+        """
+        conn = None
+        try:
+            conn = self.__connect()
+            return conn.execute("SELECT version FROM fz_library_version;").fetchone()[0]
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def get_audio(self, song_id, start=None, end=None):
+        """
+        reads the stored audio of a song between start and end (in seconds), 
+        reading only the needed byte ranges of the blob. returns the sampling 
+        rate and the audio
+        """
+        conn = None
+        try:
+            conn = self.__connect()
+            row = conn.execute("""
+                               SELECT rowid FROM fz_song_data WHERE song_id = ?
+                               AND song_id NOT IN (SELECT song_id FROM fz_song_tombstones);
+                               """, (song_id,)).fetchone()
+            if row is None:
+                raise KeyError(song_id)
+            with conn.blobopen("fz_song_data", "data", row[0], readonly=True) as blob:
+                def read_at(offset, length):
+                    blob.seek(offset)
+                    return blob.read(length)
+                return fzio.decode_audio(read_at, start, end)
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def iterate_audio(self, song_ids):
+        """
+        creates a generator of (song_id, stored audio) pairs for the songs in
+        song_ids, where the audio is in the compact storage format, or None 
+        if it was never stored or the song was removed
+        """
+        conn = None
+        try:
+            conn = self.__connect()
+            # fetch a chunk of songs per query, under sqlite's variable limit
+            for k in range(0, len(song_ids), 500):
+                chunk = list(song_ids[k:k + 500])
+                found = dict(conn.execute(
+                    "SELECT song_id, data FROM fz_song_data WHERE song_id IN (" +
+                    ", ".join("?" * len(chunk)) + ") " +
+                    "AND song_id NOT IN (SELECT song_id FROM fz_song_tombstones);", chunk))
+                for song_id in chunk:
+                    yield song_id, found.get(song_id)
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def update_record(self, song_id, new_info):
+        """
+        updates a certain song_id with new_info
+        """
+        pass
+
+    def iterate(self, limit=None, offset=0, filter=None, after=None):
+        """
+        creates a generator for the database that can be iterated through, 
+        in song_id order. skips offset songs, then yields at most limit songs 
+        with song_id greater than after, and with filter in their title, 
+        artist or album. rows are fetched a page at a time
+        """
+        conn = None
+        list_sql = """
+                   SELECT song_id, title, artist, album, release_date, length
+                   FROM fz_song_library
+                   WHERE (:after IS NULL OR song_id > :after)
+                   AND (:filter IS NULL OR title LIKE :filter ESCAPE '\\'
+                        OR artist LIKE :filter ESCAPE '\\'
+                        OR album LIKE :filter ESCAPE '\\')
+                   AND song_id NOT IN (SELECT song_id FROM fz_song_tombstones)
+                   ORDER BY song_id
+                   LIMIT :count OFFSET :offset;
+                   """
+        pattern = None if filter is None else contains_pattern(filter)
+        try:
+            conn = self.__connect()
+            def query_page(after, offset, count):
+                return conn.execute(list_sql, {"after": after, "filter": pattern,
+                                               "count": count, "offset": offset}).fetchall()
+            for row in page_rows(query_page, limit, offset, after):
+                yield row
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def list_db(self, limit=None, offset=0, filter=None, after=None):
+        """
+        list the entire database, or a page of it
+        """
+        logger.info("listing the database")
+        try:
+            return list(self.iterate(limit, offset, filter, after))
+        except:
+            logger.error("there was an error in listing the database")
+            return []
+
+    def iterate_envelopes(self):
+        """
+        creates a generator of (song_id, envelope) pairs for every song in the
+        database, where the envelope is None if it was never computed
+        """
+        conn = None
+        env_sql = """
+                  SELECT l.song_id, s.n_frames, s.n_dims, s.sig_
+                  FROM fz_song_library l LEFT JOIN fz_song_signatures s
+                  ON s.song_id = l.song_id AND s.sig_type = 'maxpow_env'
+                  WHERE l.song_id NOT IN (SELECT song_id FROM fz_song_tombstones);
+                  """
+        try:
+            conn = self.__connect()
+            for song_id, n_frames, n_dims, env in conn.execute(env_sql):
+                yield song_id, None if env is None else \
+                    fzio.unpack_signature(env, n_frames, n_dims)
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def iterate_signatures(self, sig_type, song_ids=None):
+        """
+        creates a generator of (song_id, signature) pairs for every song in the 
+        database, or only the songs in song_ids, for signatures of type sig_type
+        """
+        conn = None
+        sig_sql = """
+                  SELECT song_id, n_frames, n_dims, sig_ 
+                  FROM fz_song_signatures WHERE sig_type = ?
+                  AND song_id NOT IN (SELECT song_id FROM fz_song_tombstones)
+                  """
+        try:
+            conn = self.__connect()
+            if song_ids is None:
+                rows = conn.execute(sig_sql, (sig_type,))
+            else:
+                # look the songs up in chunks, under sqlite's variable limit
+                rows = (row for k in range(0, len(song_ids), 500)
+                        for row in conn.execute(
+                            sig_sql + " AND song_id IN (" + 
+                            ", ".join("?" * len(song_ids[k:k + 500])) + ")",
+                            [sig_type] + song_ids[k:k + 500]))
+            for song_id, n_frames, n_dims, sig in rows:
+                yield song_id, fzio.unpack_signature(sig, n_frames, n_dims)
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def slow_search(self, snippet, num_matches=1):
+        """
+        linearly searches the database for a snippet of the data 
+        """
+        sig_snippet = snippet.signature("maxpow")
+        try:
+            logger.info("slow searching through the database...")
+            for _, matches in search_signatures(self, {"snippet": sig_snippet},
+                                                num_matches=num_matches,
+                                                **search_settings(self.params)):
+                logger.info("%d results found!", len(matches))
+                return None if len(matches) == 0 else match_rows(self, matches)
+        except:
+            # a failed search must not look like one that found nothing
+            logger.error("could not search for the provided snippet", exc_info=True)
+            raise
+
+    def batch_search(self, snippet_sigs, num_matches=1):
+        """
+        searches the database for many snippets at once with a single pass over
+        the library. snippet_sigs is a dictionary of snippet name to maxpow 
+        signature, and (snippet name, matches) pairs are yielded as they finish
+        """
+        logger.info("batch searching %d snippets...", len(snippet_sigs))
+        for name, matches in search_signatures(self, snippet_sigs, num_matches=num_matches,
+                                               **search_settings(self.params)):
+            yield name, match_rows(self, matches)
+
+    def __record_hash_settings(self, conn):
+        """
+        records the settings the hash table is made with when the first songs
+        are written, and refuses to add hashes made with other settings
+        """
+        record_sql = """
+                     INSERT INTO fz_lsh_settings (bins, n_hashes, bands, peaks)
+                     SELECT ?, ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM fz_lsh_settings);
+                     """
+        with conn:
+            conn.execute(record_sql, tuple(hash_settings(self.params).values()))
+        check_hash_settings(conn.execute(
+            "SELECT bins, n_hashes, bands, peaks FROM fz_lsh_settings;").fetchone(), self.params)
+
+    def __check_hashes(self):
+        """
+        refuses to search a hash table made with other settings, and warns
+        once per library version about songs with no hashes, like the songs
+        written before the hash table was
+        """
+        conn = None
+        unhashed_sql = """
+                       SELECT count(*) FROM fz_song_library AS l
+                       WHERE NOT EXISTS (SELECT 1 FROM fz_song_hashes AS h
+                                         WHERE h.song_id = l.song_id)
+                       AND song_id NOT IN (SELECT song_id FROM fz_song_tombstones);
+                       """
+        try:
+            conn = self.__connect()
+            check_hash_settings(conn.execute(
+                "SELECT bins, n_hashes, bands, peaks FROM fz_lsh_settings;").fetchone(),
+                self.params)
+            version = conn.execute("SELECT version FROM fz_library_version;").fetchone()[0]
+            if (self.hashes_checked != version):
+                unhashed = conn.execute(unhashed_sql).fetchone()[0]
+                if (unhashed > 0):
+                    logger.warning("%d songs have no lsh hashes, so posfreq searches can't "
+                                   "find them. remove and add them again to hash them", unhashed)
+                self.hashes_checked = version
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def find_hashes(self, hashes):
+        """
+        creates a generator of (hash, song_id, frame) rows of the hash table
+        for every hash in hashes
+        """
+        conn = None
+        try:
+            conn = self.__connect()
+            # look up a chunk of hashes per query, under sqlite's variable limit
+            for k in range(0, len(hashes), 500):
+                chunk = list(hashes[k:k + 500])
+                for row in conn.execute(
+                        "SELECT hash, song_id, frame FROM fz_song_hashes WHERE hash IN (" +
+                        ", ".join("?" * len(chunk)) + ") AND " +
+                        "song_id NOT IN (SELECT song_id FROM fz_song_tombstones);", chunk):
+                    yield row
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def search(self, snippet, num_matches=1):
+        """
+        searches the database for a snippet using locality sensitive hashing
+        of its posfreq signature
+        """
+        logger.info("searching the database with lsh...")
+        self.__check_hashes()
+        matches = lsh_search(self, snippet_posfreq(snippet, self.params), num_matches, 
+                             self.params)
+        logger.info("%d results found!", len(matches))
+        return None if len(matches) == 0 else match_rows(self, matches)
+
+    def clear(self):
+        """
+        clears the entire database, for testing purposes, by tombstoning 
+        every song
+        """
+        conn = None
+        clear_sql = """
+                    INSERT OR IGNORE INTO fz_song_tombstones (song_id, removed_at)
+                    SELECT song_id, ? FROM fz_song_library;
+                    """
+        try:
+            logger.info("clearing the database...")
+            conn = self.__connect()
+            with conn:
+                conn.execute(clear_sql, (time.time(),))
+            logger.info("database cleared!")
+        except:
+            logger.error("could not clear database", exc_info=True)
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def compact(self, batch_size=100):
+        """
+        purges tombstoned songs from every table, batch_size songs per 
+        transaction so that writers are only ever held up briefly (readers 
+        never are, under write ahead logging), then checkpoints the log. 
+        returns the number of songs purged
+        """
+        conn = None
+        purge_sql = """
+                    DELETE FROM fz_song_library WHERE song_id IN (
+                        SELECT song_id FROM fz_song_tombstones LIMIT ?
+                    );
+                    """
+        purged = 0
+        try:
+            logger.info("compacting the database...")
+            conn = self.__connect()
+            while True:
+                # the tombstones go with their songs
+                with conn:
+                    deleted = conn.execute(purge_sql, (batch_size,)).rowcount
+                if (deleted == 0):
+                    break
+                purged += deleted
+            # a passive checkpoint doesn't wait on readers
+            conn.execute("PRAGMA wal_checkpoint(PASSIVE);")
+            logger.info("%d removed songs purged!", purged)
+        except:
+            logger.error("could not compact the database", exc_info=True)
+        finally:
+            if conn is not None:
+                conn.close()
+        return purged
+
+    def plot(self, song_id, save_location=None, start=None, end=None, max_bins=512):
+        """
+        plots the spectrogram of a song in the library, between start and end
+        (in seconds), with at most max_bins frequency bins. returns whether it
+        was plotted
+        """
+        try:
+            logger.info("plotting song %s...", song_id)
+            title = self.get_info(song_id)[1]
+            # only fetch the audio in the region being plotted
+            samp_rate, data = self.get_audio(song_id, start, end)
+            fzcomp.plot_spectrogram(
+                data, samp_rate,
+                title=title,
+                save_location=save_location,
+                offset=start or 0,
+                max_bins=max_bins
+            )
+            return True
+        except:
+            logger.error("there was an error trying to plot song %s", song_id, exc_info=True)
+            return False
+
+class ShardedDB(object):
+    """
+    provides functions for reading and writing to a library split across 
+    several databasers (shards). songs are routed to a shard by a hash of 
+    their song_id, and searches run on every shard at once
+    """
+
+    def __init__(self, db_settings, param_settings):
+        """
+        initializes a sharded databaser from a list of shard settings, each 
+        of which looks like a db.json with its own db_type
+        """
+        logger.info("initializing sharded databaser...")
+        self.params = param_settings
+        self.shards = [get_databaser(shard, param_settings) 
+                       for shard in db_settings["shards"]]
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.shards))
+        logger.info("sharded databaser initialized with %d shards!", len(self.shards))
+
+    def get_shard(self, song_id):
+        """
+        gets the shard that holds song_id
+        """
+        return self.shards[zlib.crc32(song_id.encode("utf-8")) % len(self.shards)]
+
+    def __scatter(self, method, *args, **kwargs):
+        """
+        calls method on every shard at once, returning the results in shard order
+        """
+        futures = [self.pool.submit(getattr(shard, method), *args, **kwargs) 
+                   for shard in self.shards]
+        return [future.result() for future in futures]
+
+    def write(self, song_entry):
+        """
+        writes a song_entry to its shard, returns the ids of the songs written
+        """
+        return self.get_shard(song_entry.song_id).write(song_entry)
+
+    def write_many(self, song_entries):
+        """
+        writes a list of song_entries, with the shards writing in parallel.
+        returns the ids of the songs written
+        """
+        batches = dict((id(shard), []) for shard in self.shards)
+        for song in song_entries:
+            batches[id(self.get_shard(song.song_id))].append(song)
+        def write_batch(shard):
+            if hasattr(shard, "write_many"):
+                return shard.write_many(batches[id(shard)])
+            return [song_id for song in batches[id(shard)] for song_id in shard.write(song)]
+        return [song_id for written in self.pool.map(write_batch, self.shards) 
+                for song_id in written]
+
+    def write_records(self, records):
+        """
+        writes library records (see song_record) to their shards, with the 
+        shards writing in parallel. returns the ids of the songs written
+        """
+        batches = dict((id(shard), []) for shard in self.shards)
+        for record in records:
+            batches[id(self.get_shard(record["song"][0]))].append(record)
+        return [song_id for written in self.pool.map(
+                    lambda shard: shard.write_records(batches[id(shard)]), self.shards)
+                for song_id in written]
+
+    def remove(self, song_id):
+        """
+        removes a song with a given song_id from its shard
+        """
+        self.get_shard(song_id).remove(song_id)
+
+    def lookup(self, song_info, prefix=False):
+        """
+        looks up a song given some metadata song_info on every shard, returning 
+        the ids of every matching song
+        """
+        return sorted(song_id for song_ids in self.__scatter("lookup", song_info, prefix)
+                      if song_ids is not None for song_id in song_ids)
+
+    def get_info(self, song_id):
+        """
+        gets the library information of a song from its id
+        """
+        return self.get_shard(song_id).get_info(song_id)
+
+    def version(self):
+        """
+        gets the library version, made of the versions of every shard
+        """
+        return tuple(self.__scatter("version"))
+
+    def get_audio(self, song_id, start=None, end=None):
+        """
+        reads the stored audio of a song between start and end (in seconds)
+        """
+        return self.get_shard(song_id).get_audio(song_id, start, end)
+
+    def iterate_audio(self, song_ids):
+        """
+        creates a generator of (song_id, stored audio) pairs for the songs in
+        song_ids, fetched from each shard in turn
+        """
+        for shard in self.shards:
+            shard_ids = [song_id for song_id in song_ids if self.get_shard(song_id) is shard]
+            for song in shard.iterate_audio(shard_ids):
+                yield song
+
+    def iterate(self, limit=None, offset=0, filter=None, after=None):
+        """
+        creates a generator for the database that merges the shards in song_id 
+        order, with the same paging as the shards themselves
+        """
+        # every shard may hold the next rows, so none can skip the offset
+        streams = [shard.iterate(filter=filter, after=after) for shard in self.shards]
+        songs = heapq.merge(*streams, key=lambda song: song[0])
+        stop = None if limit is None else offset + limit
+        for song in itertools.islice(songs, offset, stop):
+            yield song
+
+    def list_db(self, limit=None, offset=0, filter=None, after=None):
+        """
+        list the entire database, or a page of it
+        """
+        return list(self.iterate(limit, offset, filter, after))
+
+    def iterate_envelopes(self):
+        """
+        creates a generator of (song_id, envelope) pairs for every song in 
+        every shard
+        """
+        for shard in self.shards:
+            for song in shard.iterate_envelopes():
+                yield song
+
+    def iterate_signatures(self, sig_type, song_ids=None):
+        """
+        creates a generator of (song_id, signature) pairs for every song in 
+        every shard, or only the songs in song_ids, for signatures of type sig_type
+        """
+        for shard in self.shards:
+            shard_ids = None if song_ids is None else \
+                [song_id for song_id in song_ids if self.get_shard(song_id) is shard]
+            for song in shard.iterate_signatures(sig_type, shard_ids):
+                yield song
+
+    def slow_search(self, snippet, num_matches=1):
+        """
+        linearly searches every shard at once for a snippet of the data, and
+        merges their results by score
+        """
+        results = [song for matches in self.__scatter("slow_search", snippet, num_matches)
+                   if matches is not None for song in matches]
+        results.sort(key=lambda row: -row[-1])
+        return None if len(results) == 0 else results[:num_matches]
+
+    def batch_search(self, snippet_sigs, num_matches=1):
+        """
+        searches every shard at once for many snippets, yielding each snippet's 
+        matches merged by score once all of the shards have finished with it.
+        if a shard fails, the snippets it hadn't finished are never yielded, 
+        and its error is raised once the other shards are done
+        """
+        results = queue.Queue()
+        def search_shard(shard):
+            done = set()
+            try:
+                for name, matches in shard.batch_search(snippet_sigs, num_matches):
+                    done.add(name)
+                    results.put((name, matches))
+            except:
+                logger.error("batch search failed on a shard", exc_info=True)
+                # mark the rest as failed so the merge can still finish
+                for name in snippet_sigs:
+                    if name not in done:
+                        results.put((name, None))
+                raise
+        futures = [self.pool.submit(search_shard, shard) for shard in self.shards]
+
+        merged = dict((name, []) for name in snippet_sigs)
+        reported = dict((name, 0) for name in snippet_sigs)
+        for _ in range(len(snippet_sigs) * len(self.shards)):
+            name, matches = results.get()
+            if (matches is None or merged[name] is None):
+                merged[name] = None
+            else:
+                merged[name].extend(matches)
+            reported[name] += 1
+            if (reported[name] == len(self.shards) and merged[name] is not None):
+                merged[name].sort(key=lambda row: -row[-1])
+                yield name, merged[name][:num_matches]
+        for future in futures:
+            future.result()
+
+    def search(self, snippet, num_matches=1):
+        """
+        searches every shard at once using their indexes, and merges the results
+        """
+        results = [song for matches in self.__scatter("search", snippet, num_matches)
+                   if matches is not None for song in matches]
+        results.sort(key=lambda row: row[-1], reverse=True)
+        return None if len(results) == 0 else results[:num_matches]
+
+    def clear(self):
+        """
+        clears every shard, for testing purposes
+        """
+        self.__scatter("clear")
+
+    def compact(self):
+        """
+        compacts every shard at once, returns the number of songs purged
+        """
+        return sum(self.__scatter("compact"))
+
+    def plot(self, song_id, save_location=None, start=None, end=None, max_bins=512):
+        """
+        plots the spectrogram of a song in the library, returns whether it 
+        was plotted
+        """
+        return self.get_shard(song_id).plot(song_id, save_location, start, end, max_bins)
+
+# worker state for plot_many, one databaser per process
+plot_databaser = None
+
+def init_plot_worker(db_settings, param_settings):
+    global plot_databaser
+    plot_databaser = get_databaser(db_settings, param_settings)
+
+def plot_worker(song_id, save_location, start, end, max_bins):
+    if plot_databaser.plot(song_id, save_location, start, end, max_bins):
+        return save_location
+    return None
+
+def plot_many(db_settings, param_settings, song_ids, out_dir, jobs=None, 
+              start=None, end=None, max_bins=512):
+    """
+    plots the spectrograms of many songs into out_dir in parallel, one png 
+    per song. returns a (song_id, file written) pair for each song, where 
+    the file is None if the song couldn't be plotted
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=init_plot_worker,
+            initargs=(db_settings, param_settings)) as pool:
+        futures = [pool.submit(plot_worker, song_id, os.path.join(out_dir, song_id + ".png"),
+                               start, end, max_bins)
+                   for song_id in song_ids]
+        return [(song_id, future.result()) for song_id, future in zip(song_ids, futures)]
+
+def get_databaser(db_settings, param_settings):
+    """
+    creates the databaser chosen by db_type in the database settings
+    """
+    db_type = db_settings["db_type"]
+    if (db_type == "sql"):
+        return PostgreSQLDB(db_settings["sql"], param_settings)
+    elif (db_type == "file"):
+        return FileSystemDB(db_settings["file"], param_settings)
+    elif (db_type == "sqlite"):
+        return SQLiteDB(db_settings["sqlite"], param_settings)
+    elif (db_type == "sharded"):
+        return ShardedDB(db_settings["sharded"], param_settings)
+    logger.error("invalid database type %s specified", db_type)
+    raise ValueError("invalid database type " + str(db_type) + " specified")
@@ -0,0 +1,149 @@
+# library-wide duplicate detection for the freezam project
+# Graham Arthur (garthur), Carnegie Mellon University
+
+import os
+import logging
+import concurrent.futures
+
+import numpy as np
+
+import fzdb
+
+logger = logging.getLogger("fz.dedupe")
+
+# PROBES
+
+def get_probes(sig, n_probes=3, probe_frames=5):
+    """
+    cuts n_probes short snippets of probe_frames frames, spread evenly over
+    a signature. a song whose probe matches another song shares that audio
+    with it, which catches re-encodes as well as edits of the same track
+    """
+    sig = np.asarray(sig)
+    if (len(sig) <= probe_frames):
+        return [sig] if len(sig) > 0 else []
+    starts = sorted(set(round((len(sig) - probe_frames) * (k + 1) / (n_probes + 1))
+                        for k in range(0, n_probes)))
+    return [np.array(sig[start:start + probe_frames]) for start in starts]
+
+class LibraryPart(object):
+    """
+    a view of a databaser that only holds the songs in song_ids, so that a
+    search can be split between workers
+    """
+
+    def __init__(self, databaser, song_ids):
+        self.databaser = databaser
+        self.song_ids = set(song_ids)
+
+    def iterate_envelopes(self):
+        for song_id, envelope in self.databaser.iterate_envelopes():
+            if song_id in self.song_ids:
+                yield song_id, envelope
+
+    def iterate_signatures(self, sig_type, song_ids=None):
+        song_ids = self.song_ids if song_ids is None else self.song_ids.intersection(song_ids)
+        return self.databaser.iterate_signatures(sig_type, sorted(song_ids))
+
+# CLUSTERING
+
+def cluster_pairs(pairs):
+    """
+    groups songs into clusters with union-find, given pairs of songs that
+    are duplicates of each other. returns the clusters of more than one song
+    """
+    parent = {}
+    def find(song_id):
+        parent.setdefault(song_id, song_id)
+        root = song_id
+        while parent[root] != root:
+            root = parent[root]
+        # point everything on the path straight at the root
+        while parent[song_id] != root:
+            parent[song_id], song_id = root, parent[song_id]
+        return root
+    for a, b in pairs:
+        root_a, root_b = find(a), find(b)
+        if (root_a != root_b):
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    clusters = {}
+    for song_id in parent:
+        clusters.setdefault(find(song_id), []).append(song_id)
+    return sorted(sorted(cluster) for cluster in clusters.values() if len(cluster) > 1)
+
+# SEARCHING
+
+# worker state for find_duplicates, one databaser per process
+dedupe_databaser = None
+
+def init_dedupe_worker(db_settings, param_settings):
+    global dedupe_databaser
+    dedupe_databaser = fzdb.get_databaser(db_settings, param_settings)
+
+def match_probes(databaser, song_ids, probes, epsilon, min_fraction):
+    """
+    matches every probe against the songs in song_ids in one pass, and
+    returns the (song, song) pairs of probes that matched another song
+    """
+    results = fzdb.search_signatures(LibraryPart(databaser, song_ids), probes,
+                                     epsilon=epsilon, num_matches=len(song_ids),
+                                     min_fraction=min_fraction)
+    return [(name[0], song_id) for name, matches in results
+            for song_id, _ in matches if song_id != name[0]]
+
+def dedupe_worker(song_ids, probes, epsilon, min_fraction):
+    return match_probes(dedupe_databaser, song_ids, probes, epsilon, min_fraction)
+
+def find_duplicates(databaser, param_settings, db_settings=None, jobs=1, n_probes=3,
+                    probe_frames=5):
+    """
+    finds clusters of duplicate songs in the library. probes are cut from
+    every song's signature and the library is matched against all of them
+    at once, so every song is only read once per worker. with jobs > 1 the
+    library is split between worker processes, which open their own
+    databasers from db_settings. returns a list of clusters of song ids
+    """
+    logger.info("cutting probes from every song...")
+    song_ids, probes = [], {}
+    for song_id, sig in databaser.iterate_signatures("maxpow"):
+        song_ids.append(song_id)
+        for k, probe in enumerate(get_probes(sig, n_probes, probe_frames)):
+            probes[(song_id, k)] = probe
+    logger.info("%d probes cut from %d songs", len(probes), len(song_ids))
+    settings = fzdb.search_settings(param_settings)
+
+    jobs = max(1, min(jobs or os.cpu_count(), len(song_ids)))
+    if (jobs == 1 or db_settings is None):
+        pairs = match_probes(databaser, song_ids, probes, settings["epsilon"],
+                             settings["min_fraction"])
+    else:
+        parts = [song_ids[k::jobs] for k in range(0, jobs)]
+        pairs = []
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs, initializer=init_dedupe_worker,
+                initargs=(db_settings, param_settings)) as pool:
+            futures = [pool.submit(dedupe_worker, part, probes, settings["epsilon"],
+                                   settings["min_fraction"])
+                       for part in parts]
+            for future in futures:
+                pairs.extend(future.result())
+    logger.info("%d duplicate pairs found", len(pairs))
+    return cluster_pairs(pairs)
+
+def surviving_rows(databaser, cluster):
+    """
+    looks up the library rows of a cluster's songs that are still in the 
+    library, since some may have been removed after probing. returns [] if
+    fewer than two are left, as there is nothing to dedupe then
+    """
+    rows = [row for row in (databaser.get_info(song_id) for song_id in cluster)
+            if row is not None]
+    return rows if len(rows) > 1 else []
+
+def pick_keeper(rows):
+    """
+    picks the library row to keep out of a cluster of duplicates: the
+    longest song, which is the full track rather than an edit of it
+    """
+    return max(rows, key=lambda row: (float(row[5] or 0), row[0]))
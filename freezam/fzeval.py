@@ -0,0 +1,201 @@
+# identify accuracy and latency evaluation for the freezam project
+# Graham Arthur (garthur), Carnegie Mellon University
+
+import os
+import copy
+import time
+import shutil
+import logging
+import tempfile
+import itertools
+import concurrent.futures
+
+import numpy as np
+import scipy.io.wavfile as wav
+
+import fzdb
+import fzio
+import fzsong
+
+logger = logging.getLogger("fz.eval")
+
+# how queries are cut and augmented, unless a configuration says otherwise:
+#   length   snippet length in seconds
+#   snr      signal to noise ratio of added white noise in dB, None for none
+#   gain     largest gain change in dB, drawn uniformly from [-gain, gain]
+#   offset   whether snippets start anywhere, rather than on a whole second
+AUGMENT = {"length": 12, "snr": None, "gain": 0.0, "offset": True}
+
+# LIBRARIES
+
+def synthetic_song(rng, samp_rate=8000, length=40, notes_per_second=2):
+    """
+    generates a synthetic song of length seconds: a sequence of random three
+    note chords over a little white noise
+    """
+    note = np.arange(0, samp_rate // notes_per_second) / samp_rate
+    chords = [np.sum([np.sin(2 * np.pi * f * note)
+                      for f in rng.uniform(100, samp_rate / 4, size=3)], axis=0)
+              for _ in range(0, int(length * notes_per_second))]
+    data = np.concatenate(chords)
+    return (data + rng.normal(scale=0.1, size=data.shape)).astype(np.float32)
+
+def synthetic_library(location, n_songs, seed=0, samp_rate=8000, length=40):
+    """
+    writes n_songs synthetic songs to wav files in location, and returns
+    their locations
+    """
+    rng = np.random.RandomState(seed)
+    os.makedirs(location, exist_ok=True)
+    songs = []
+    for k in range(0, n_songs):
+        songs.append(os.path.join(location, "synthetic_" + str(seed) + "_" + str(k) + ".wav"))
+        wav.write(songs[-1], samp_rate, synthetic_song(rng, samp_rate, length))
+    return songs
+
+def fixture_library(location, length=12):
+    """
+    gets the wav files in location that are long enough to cut snippets of
+    length seconds from
+    """
+    songs = []
+    for name in sorted(os.listdir(location)):
+        if name.endswith(".wav"):
+            samp_rate, data = wav.read(os.path.join(location, name), mmap=True)
+            if (len(data) >= length * samp_rate):
+                songs.append(os.path.join(location, name))
+    return songs
+
+# QUERIES
+
+def make_query(rng, data, samp_rate, length=12, snr=None, gain=0.0, offset=True):
+    """
+    cuts a random snippet of length seconds out of data and augments it with
+    a random gain and white noise. returns the snippet and where it starts
+    (in seconds)
+    """
+    n = int(length * samp_rate)
+    if offset:
+        start = rng.randint(0, len(data) - n + 1)
+    else:
+        start = rng.randint(0, (len(data) - n) // samp_rate + 1) * samp_rate
+    snippet = data[start:start + n] * 10 ** (rng.uniform(-gain, gain) / 20)
+    if snr is not None:
+        power = np.mean(snippet ** 2)
+        snippet = snippet + rng.normal(scale=np.sqrt(power / 10 ** (snr / 10)), size=n)
+    return snippet.astype(np.float32), start / samp_rate
+
+def set_setting(settings, key, value):
+    """
+    sets a setting given by a dotted key (like search.threshold_epsilon) in
+    a nested dictionary of settings
+    """
+    keys = key.split(".")
+    for k in keys[:-1]:
+        settings = settings.setdefault(k, {})
+    settings[keys[-1]] = value
+
+def expand_sweep(sweep):
+    """
+    expands a sweep, a dictionary of dotted keys to lists of values, into
+    every configuration of those values
+    """
+    keys = sorted(sweep)
+    return [dict(zip(keys, values)) for values in itertools.product(*[sweep[k] for k in keys])]
+
+def percentiles(latencies):
+    """
+    gets the p50, p95 and p99 of a list of latencies, in milliseconds
+    """
+    if not latencies:
+        return {"p50": None, "p95": None, "p99": None}
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+    return {"p50": p50, "p95": p95, "p99": p99}
+
+# EVALUATION
+
+def evaluate(params, songs, negatives=None, config=None, augment=None, queries=40, 
+             negative_queries=10, k=3, seed=0, db_type="sqlite"):
+    """
+    evaluates identify on a library of the songs (wav locations) under the
+    parameters, changed by config, a dictionary of dotted keys to values.
+    queries are cut and augmented as augment says (see AUGMENT), and keys
+    of config under augment change that too, while the rest change the 
+    parameters. queries snippets of library songs and
+    negative_queries snippets of the negatives, which aren't in the library,
+    are identified one at a time. returns a report of recall@1, recall@k,
+    the false positive rate and identify latency percentiles (in ms)
+    """
+    config = config or {}
+    settings = {"params": copy.deepcopy(params), "augment": dict(AUGMENT, **(augment or {}))}
+    for key, value in config.items():
+        set_setting(settings, key if key.startswith("augment.") else "params." + key, value)
+    params, augment = settings["params"], settings["augment"]
+    analysis = fzsong.get_analysis(params)
+    sig_type = params["search"].get("sig_type", "maxpow")
+
+    work_dir = tempfile.mkdtemp(prefix="fz_eval_")
+    try:
+        logger.info("building a library of %d songs...", len(songs))
+        databaser = fzdb.get_databaser(
+            {"db_type": db_type, db_type: {"address": os.path.join(work_dir, "library")}}, params)
+        song_ids = []
+        for song in songs:
+            entry = fzsong.SongEntry(song, title=os.path.basename(song), **analysis)
+            databaser.write(entry)
+            song_ids.append(entry.song_id)
+
+        # the same seed cuts the same queries for every configuration
+        rng = np.random.RandomState(seed)
+        plan = [(song, True) for song in rng.randint(0, len(songs), size=queries)]
+        if negatives:
+            plan += [(song, False) for song in rng.randint(0, len(negatives), 
+                                                           size=negative_queries)]
+        hits, hits_k, false_positives, latencies = 0, 0, 0, []
+        for i, (song, positive) in enumerate(plan):
+            samp_rate, data = fzio.read_song((songs if positive else negatives)[song],
+                                             dtype=analysis["dtype"])
+            snippet, _ = make_query(rng, data, samp_rate, **augment)
+            location = os.path.join(work_dir, "query_" + str(i) + ".wav")
+            wav.write(location, samp_rate, snippet)
+
+            start = time.perf_counter()
+            matches = fzdb.identify(databaser, fzsong.SongEntry(location, **analysis), k, 
+                                    sig_type)
+            latencies.append(time.perf_counter() - start)
+            found = [match[0] for match in matches or []]
+            if positive:
+                hits += int(found[:1] == [song_ids[song]])
+                hits_k += int(song_ids[song] in found[:k])
+            else:
+                false_positives += int(len(found) > 0)
+            os.remove(location)
+
+        negative_queries = len(plan) - queries
+        report = {"config": config, "queries": queries, "negative_queries": negative_queries,
+                  "k": k, "recall@1": hits / queries if queries else None,
+                  "recall@k": hits_k / queries if queries else None,
+                  "false_positive_rate": (false_positives / negative_queries 
+                                          if negative_queries else None)}
+        report.update(percentiles(latencies))
+        logger.info("evaluated %s: %s", config, report)
+        return report
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def evaluate_sweep(params, songs, negatives=None, sweep=None, jobs=None, **kwargs):
+    """
+    evaluates every configuration of a sweep (see expand_sweep) with
+    evaluate, in parallel worker processes that each build their own
+    library. kwargs holds any other keyword arguments of evaluate. returns
+    the reports in the order of the configurations
+    """
+    configs = expand_sweep(sweep or {})
+    logger.info("evaluating %d configurations...", len(configs))
+    jobs = max(1, min(jobs or os.cpu_count(), len(configs)))
+    if (jobs == 1):
+        return [evaluate(params, songs, negatives, config, **kwargs) for config in configs]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(evaluate, params, songs, negatives, config, **kwargs)
+                   for config in configs]
+        return [future.result() for future in futures]
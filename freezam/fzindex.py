@@ -0,0 +1,258 @@
+# code for the shared signature index in the freezam project
+# Graham Arthur (garthur), Carnegie Mellon University
+
+import os
+import copy
+import json
+import shutil
+import logging
+import concurrent.futures
+
+import numpy as np
+
+import fzcomp
+import fzdb
+
+logger = logging.getLogger('fz.index')
+
+# BUILDING
+
+def current_generation(location):
+    """
+    gets the generation of the index at location that readers should use,
+    or 0 if no index has been published there
+    """
+    try:
+        with open(os.path.join(location, "CURRENT")) as current:
+            return int(current.read().strip())
+    except (OSError, ValueError):
+        return 0
+
+def is_current(location, version):
+    """
+    checks if the current generation of the index at location was built 
+    from the library at version (see the databasers' version). an index 
+    that is behind the library misses the songs added since it was built
+    """
+    generation = current_generation(location)
+    if (generation == 0):
+        return False
+    try:
+        with open(os.path.join(location, "gen-" + str(generation), "meta.json")) as meta:
+            built = json.load(meta).get("library_version")
+    except (OSError, ValueError):
+        return False
+    # versions are compared as they are stored, as json
+    return built is not None and built == json.loads(json.dumps(version))
+
+def build_index(databaser, location, sig_type="maxpow"):
+    """
+    writes every signature of type sig_type in a databaser to a new
+    generation of the index at location, as flat float32 arrays, then
+    publishes it. readers keep the generation they have open until they
+    refresh. the generation records the library version it was built from,
+    taken before any signature is read. returns the new generation
+    """
+    version = databaser.version()
+    os.makedirs(location, exist_ok=True)
+    generation = current_generation(location) + 1
+    gen_dir = os.path.join(location, "gen-" + str(generation))
+    # a build that failed part way may have left this generation behind
+    if os.path.exists(gen_dir):
+        shutil.rmtree(gen_dir)
+    os.makedirs(gen_dir)
+    logger.info("building generation %d of the index...", generation)
+
+    # signatures are streamed to disk, so the library is never all in memory
+    ids, offsets, envelopes = [], [0], []
+    n_dims = None
+    with open(os.path.join(gen_dir, "signatures.f32"), "wb") as output:
+        for song_id, sig in databaser.iterate_signatures(sig_type):
+            sig = np.asarray(sig, dtype=np.float32)
+            if (n_dims is None and sig.ndim == 2):
+                n_dims = sig.shape[1]
+            if (sig.ndim != 2 or sig.shape[1] != n_dims):
+                logger.warning("skipping song %s with a mismatched signature", song_id)
+                continue
+            output.write(sig.tobytes())
+            ids.append(song_id)
+            offsets.append(offsets[-1] + len(sig))
+            envelopes.append(fzcomp.compute_sig_envelope(sig))
+    n_dims = n_dims or 0
+    ids = np.array(ids, dtype=str)
+    np.save(os.path.join(gen_dir, "ids.npy"), ids)
+    # songs are found by binary search of their sorted ids
+    order = np.argsort(ids, kind="stable")
+    np.save(os.path.join(gen_dir, "sorted_ids.npy"), ids[order])
+    np.save(os.path.join(gen_dir, "sorted_positions.npy"), order.astype(np.int64))
+    np.save(os.path.join(gen_dir, "offsets.npy"), np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(gen_dir, "envelopes.npy"),
+            np.array(envelopes, dtype=np.float32).reshape(len(ids), 2, n_dims))
+    with open(os.path.join(gen_dir, "meta.json"), "w") as meta:
+        json.dump({"sig_type": sig_type, "n_songs": len(ids),
+                   "n_frames": offsets[-1], "n_dims": n_dims, 
+                   "library_version": version}, meta)
+
+    # publish the generation with an atomic rename of the pointer file
+    current = os.path.join(location, "CURRENT")
+    with open(current + ".tmp", "w") as output:
+        output.write(str(generation))
+    os.replace(current + ".tmp", current)
+    # readers may still be on the previous generation, but not on older ones
+    for name in os.listdir(location):
+        if (name.startswith("gen-") and int(name[4:]) < generation - 1):
+            shutil.rmtree(os.path.join(location, name), ignore_errors=True)
+    logger.info("generation %d published with %d songs", generation, len(ids))
+    return generation
+
+# READING
+
+class SignatureIndex(object):
+    """
+    a read-only view of a published index. the arrays are memory mapped, so
+    every process that opens the index shares one copy of the signatures in
+    the page cache. supports iterate_envelopes and iterate_signatures like a
+    databaser, so it can be searched with fzdb.search_signatures
+    """
+
+    def __init__(self, location, generation=None):
+        """
+        opens the given generation of the index at location, or the current one
+        """
+        self.location = location
+        self.generation = None
+        self.open(generation or current_generation(location))
+
+    def open(self, generation):
+        """
+        maps the arrays of a generation of the index
+        """
+        gen_dir = os.path.join(self.location, "gen-" + str(generation))
+        if (generation == 0 or not os.path.exists(gen_dir)):
+            logger.error("no index generation %s at %s", generation, self.location)
+            raise Exception("no index generation " + str(generation) + " at " + self.location)
+        with open(os.path.join(gen_dir, "meta.json")) as meta:
+            self.meta = json.load(meta)
+        self.ids = np.load(os.path.join(gen_dir, "ids.npy"), mmap_mode="r")
+        if os.path.exists(os.path.join(gen_dir, "sorted_ids.npy")):
+            self.sorted_ids = np.load(os.path.join(gen_dir, "sorted_ids.npy"), mmap_mode="r")
+            self.sorted_positions = np.load(os.path.join(gen_dir, "sorted_positions.npy"),
+                                            mmap_mode="r")
+        else:
+            # generations built before the sorted ids were stored
+            self.sorted_positions = np.argsort(self.ids, kind="stable")
+            self.sorted_ids = self.ids[self.sorted_positions]
+        self.offsets = np.load(os.path.join(gen_dir, "offsets.npy"), mmap_mode="r")
+        self.envelopes = np.load(os.path.join(gen_dir, "envelopes.npy"), mmap_mode="r")
+        if (self.meta["n_frames"] == 0):
+            self.sigs = np.zeros((0, self.meta["n_dims"]), dtype=np.float32)
+        else:
+            self.sigs = np.memmap(os.path.join(gen_dir, "signatures.f32"), dtype=np.float32,
+                                  mode="r", shape=(self.meta["n_frames"], self.meta["n_dims"]))
+        self.generation = generation
+        self.start, self.stop = 0, len(self.ids)
+
+    def refresh(self):
+        """
+        switches to the current generation if a newer one has been published,
+        returns whether it did
+        """
+        generation = current_generation(self.location)
+        if (generation == self.generation):
+            return False
+        self.open(generation)
+        return True
+
+    def part(self, start, stop):
+        """
+        gets a view of the index that only holds the songs in [start, stop)
+        """
+        view = copy.copy(self)
+        view.start, view.stop = start, stop
+        return view
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def find(self, song_ids):
+        """
+        gets the sorted positions of the songs in song_ids that are in the 
+        index, by binary search of the sorted ids
+        """
+        wanted = np.asarray(list(song_ids), dtype=str)
+        if (len(self.sorted_ids) == 0 or len(wanted) == 0):
+            return []
+        k = np.minimum(np.searchsorted(self.sorted_ids, wanted), len(self.sorted_ids) - 1)
+        found = self.sorted_ids[k] == wanted
+        return np.sort(self.sorted_positions[k[found]]).tolist()
+
+    def iterate_envelopes(self):
+        """
+        creates a generator of (song_id, envelope) pairs for every song
+        """
+        for k in range(self.start, self.stop):
+            yield str(self.ids[k]), self.envelopes[k]
+
+    def iterate_signatures(self, sig_type="maxpow", song_ids=None):
+        """
+        creates a generator of (song_id, signature) pairs for every song, or
+        only the songs in song_ids. the signatures are views of the mapped
+        arrays, nothing is copied
+        """
+        if (sig_type != self.meta["sig_type"]):
+            logger.error("the index holds %s signatures", self.meta["sig_type"])
+            raise Exception("the index holds " + self.meta["sig_type"] + " signatures")
+        if song_ids is None:
+            positions = range(self.start, self.stop)
+        else:
+            positions = self.find(song_ids)
+        for k in positions:
+            if (self.start <= k < self.stop):
+                yield str(self.ids[k]), self.sigs[self.offsets[k]:self.offsets[k + 1]]
+
+# SEARCHING
+
+# worker state for search, one mapped index per process
+search_index = None
+
+def init_search_worker(location):
+    global search_index
+    search_index = SignatureIndex(location)
+
+def search_worker(snippet_sigs, start, stop, generation, settings):
+    # every part of a search has to come from the same generation
+    if (search_index.generation != generation):
+        search_index.open(generation)
+    return list(fzdb.search_signatures(search_index.part(start, stop), snippet_sigs,
+                                       **settings))
+
+def search(location, snippet_sigs, num_matches=1, jobs=None, epsilon=1000,
+           min_fraction=1.0):
+    """
+    searches the index at location for many snippets, splitting the library
+    between jobs worker processes that all map the same index. yields
+    (snippet name, list of (song id, score) pairs) like batch_match
+    """
+    index = SignatureIndex(location)
+    settings = {"epsilon": epsilon, "num_matches": num_matches,
+                "min_fraction": min_fraction}
+    jobs = max(1, min(jobs or os.cpu_count(), len(index)))
+    if (jobs == 1):
+        for result in fzdb.search_signatures(index, snippet_sigs, **settings):
+            yield result
+        return
+
+    bounds = np.linspace(0, len(index), jobs + 1).astype(int)
+    merged = dict((name, []) for name in snippet_sigs)
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=init_search_worker,
+            initargs=(location,)) as pool:
+        futures = [pool.submit(search_worker, snippet_sigs, bounds[k], bounds[k + 1],
+                               index.generation, settings)
+                   for k in range(0, jobs)]
+        for future in futures:
+            for name, matches in future.result():
+                merged[name].extend(matches)
+    for name, matches in merged.items():
+        matches.sort(key=lambda match: -match[1])
+        yield name, matches[:num_matches]
@@ -0,0 +1,123 @@
+# staged ingest pipeline for the freezam project
+# Graham Arthur (garthur), Carnegie Mellon University
+
+import os
+import asyncio
+import logging
+import concurrent.futures
+
+import fzio
+import fzsong
+
+logger = logging.getLogger("fz.ingest")
+
+# sentinel passed down the queues once a stage has no more work
+DONE = None
+
+def analyse(location, metadata, analysis):
+    """
+    decodes and analyses the song at location, run in a worker process
+    """
+    try:
+        return fzsong.SongEntry(location, **dict(metadata, **analysis))
+    except SystemExit:
+        # fzio.read_song exits on files it can't read, which would take the
+        # whole ingest down with one bad file
+        raise Exception("could not read " + location)
+
+async def fetch_stage(songs, fetched):
+    """
+    downloads songs given by url into temp/data, passing local files through.
+    songs is a queue of (location, metadata) pairs
+    """
+    while True:
+        item = await songs.get()
+        if item is DONE:
+            return
+        location, metadata = item
+        try:
+            if (fzio.get_ltype(location) == fzio.locationtype.URL):
+                location = await asyncio.to_thread(fzio.fetch_url, location)
+            await fetched.put((location, metadata))
+        except Exception:
+            logger.error("could not fetch %s", location, exc_info=True)
+
+async def analyse_stage(fetched, analysed, pool, analysis):
+    """
+    analyses fetched songs in the process pool
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await fetched.get()
+        if item is DONE:
+            await analysed.put(DONE)
+            return
+        location, metadata = item
+        try:
+            song = await loop.run_in_executor(pool, analyse, location, metadata, analysis)
+            await analysed.put(song)
+        except Exception:
+            logger.error("could not analyse %s", location, exc_info=True)
+
+async def write_stage(analysed, databaser, n_producers):
+    """
+    writes analysed songs into the database until every producer is done,
+    batching songs that are ready together when the databaser supports it.
+    returns the ids of the songs the databaser committed
+    """
+    written = []
+    while n_producers > 0:
+        # take every song that is ready, so they can be written in one batch
+        batch = [await analysed.get()]
+        while not analysed.empty():
+            batch.append(analysed.get_nowait())
+        n_producers -= batch.count(DONE)
+        batch = [song for song in batch if song is not DONE]
+        if not batch:
+            continue
+        if hasattr(databaser, "write_many"):
+            written.extend(await asyncio.to_thread(databaser.write_many, batch))
+        else:
+            for song in batch:
+                written.extend(await asyncio.to_thread(databaser.write, song))
+    return written
+
+async def run_pipeline(songs, databaser, jobs=None, fetchers=4, queue_size=8,
+                       analysis=None):
+    """
+    ingests songs, a list of (location, metadata) pairs, into the database. 
+    downloads, analysis and database writes for different songs overlap, and
+    the bounded queues between the stages keep any one stage from running 
+    too far ahead of the next. analysis holds keyword arguments for SongEntry.
+    returns the ids of the songs written
+    """
+    jobs = jobs or os.cpu_count()
+    analysis = analysis or {}
+    pending = asyncio.Queue()
+    fetched = asyncio.Queue(maxsize=queue_size)
+    analysed = asyncio.Queue(maxsize=queue_size)
+    for song in songs:
+        pending.put_nowait(song)
+    for _ in range(fetchers):
+        pending.put_nowait(DONE)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        fetch = [asyncio.create_task(fetch_stage(pending, fetched)) 
+                 for _ in range(fetchers)]
+        analyse = [asyncio.create_task(analyse_stage(fetched, analysed, pool, analysis))
+                   for _ in range(jobs)]
+        write = asyncio.create_task(write_stage(analysed, databaser, jobs))
+        # once everything is fetched, tell each analyser to finish
+        await asyncio.gather(*fetch)
+        for _ in range(jobs):
+            await fetched.put(DONE)
+        await asyncio.gather(*analyse)
+        written = await write
+    logger.info("%d songs ingested!", len(written))
+    return written
+
+def ingest(songs, databaser, **kwargs):
+    """
+    synchronous entry point for run_pipeline
+    """
+    return asyncio.run(run_pipeline(songs, databaser, **kwargs))
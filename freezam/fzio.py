@@ -4,11 +4,16 @@
 import io
 import os
 import sys
+import struct
+import zlib
 import logging
+import tempfile
 import urllib
+import urllib.request
 
 import numpy as np
 import pydub
+from scipy import signal
 from scipy.io import wavfile as wav
 
 # setup logging
@@ -34,28 +39,50 @@ def file_reader(location):
         location = os.path.abspath(location)
 
     extension = location.rsplit(".", 1)[-1].lower()
-    logger.info("data is in file at " + location)
+    logger.debug("data is in file at %s", location)
     # only reads wav files
     if (extension != "wav"):
-        logger.error("cannot read files of type " + extension + "!")
+        logger.error("cannot read files of type %s!", extension)
         raise Exception("cannot read files of type " + extension)
     
     rate, data = wav.read(location)
     return rate, data
 
+def fetch_url(location):
+    """
+    downloads the file at the url location into temp/data, and returns the
+    path of the downloaded file
+    """
+    logger.info("data is in url at %s", location)
+    # get the filename, made unique so concurrent downloads don't collide
+    temp_dir = os.path.join(TEMP_DIR, "data")
+    os.makedirs(temp_dir, exist_ok=True)
+    fd, temp_file = tempfile.mkstemp(suffix="_" + location.rsplit('/', 1)[-1], 
+                                     dir=temp_dir)
+    os.close(fd)
+    # open location with urllib and write to temp/data
+    try:
+        urllib.request.urlretrieve(location, temp_file)
+    except:
+        os.remove(temp_file)
+        raise
+    logger.info("file retrieved to %s", temp_file)
+    return temp_file
+
+def is_download(location):
+    """
+    checks if location is a file that fetch_url downloaded into temp/data, 
+    so it can be deleted once the song is stored
+    """
+    temp_dir = os.path.realpath(os.path.join(TEMP_DIR, "data"))
+    return os.path.commonpath([os.path.realpath(location), temp_dir]) == temp_dir
+
 def url_reader(location):
     """
     reads a function from a url at location
     """
-    logger.info("data is in url at " + location)
-    # get the filename
-    temp_file = location.rsplit('/', 1)[-1]
-    temp_file = os.path.join(TEMP_DIR, "data", temp_file)
-    # open location with urllib and write to temp/data
-    urllib.request.urlretrieve(location, temp_file)
-    logger.info("file retrieved to " + temp_file)
-    # return the file_reader result
-    return file_reader(temp_file)
+    # return the file_reader result on the downloaded file
+    return file_reader(fetch_url(location))
 
 def socket_reader(location):
     """
@@ -87,25 +114,222 @@ def get_ltype(location):
     elif (False):
         ltype = locationtype.SOCKET
     else:
-        logger.error(location + " is not a valid file, url or socket. cannot read.")
+        logger.error("%s is not a valid file, url or socket. cannot read.", location)
         raise Exception(location + " is not a valid file, url or socket. cannot read.")
     return ltype
 
-def read_song(location):
+def read_song(location, dtype="float32"):
     """ 
     takes in a file location (location) gets the appropriate file 
     reader using get_reader, and then returns the result of that 
-    reader on location
+    reader on location, as one-channel audio of type dtype
     """
     try:
         # get the appropriate reader and load the data
-        logger.info("reading data...")
+        logger.debug("reading data...")
         reader = get_reader(get_ltype(location))
         rate, audio = reader(location)
-        # turn into one-channel data
-        audio = np.mean(audio, axis=1)
-        logger.info("read!")
+        audio = to_mono(audio, dtype)
+        logger.debug("read!")
         return rate, audio
     except:
         logger.error("fatal error in read_song ", exc_info = True)
-        sys.exit()
\ No newline at end of file
+        sys.exit()
+
+def read_song_blocks(location, seconds=1, dtype="float32"):
+    """
+    reads the song at location incrementally, yielding (rate, audio) blocks
+    of one-channel audio of type dtype that are each seconds long. wav files
+    are memory mapped, so audio is only read from disk as blocks are taken
+    """
+    if (get_ltype(location) == locationtype.URL):
+        location = fetch_url(location)
+    elif (not os.path.exists(location)):
+        location = os.path.abspath(location)
+    extension = location.rsplit(".", 1)[-1].lower()
+    if (extension != "wav"):
+        logger.error("cannot read files of type %s!", extension)
+        raise Exception("cannot read files of type " + extension)
+
+    logger.info("reading data from %s in blocks...", location)
+    rate, audio = wav.read(location, mmap=True)
+    step = max(1, int(seconds * rate))
+    for start in range(0, len(audio), step):
+        yield rate, to_mono(audio[start:start + step], dtype)
+
+def to_mono(audio, dtype="float32"):
+    """
+    turns audio with any number of channels into one-channel audio of type
+    dtype by averaging the channels
+    """
+    if (audio.ndim == 1):
+        return np.asarray(audio, dtype=dtype)
+    return np.mean(audio, axis=1, dtype=dtype)
+
+# AUDIO STORAGE
+
+# header layout: magic, sampling rate, dtype code, compression flag,
+# number of samples, samples per block, number of blocks, scale factor
+AUDIO_MAGIC = b"FZA1"
+AUDIO_HEADER = struct.Struct("<4sIBB2xQIIf")
+AUDIO_DTYPES = {0: np.dtype("<i2"), 1: np.dtype("<f4")}
+
+def encode_audio(data, samp_rate, dtype="int16", decimate=1, compress=False, 
+                 block_size=65536):
+    """
+    encodes one-channel audio (data) sampled at samp_rate into the compact 
+    freezam storage format. audio is optionally decimated by an integer 
+    factor, stored as int16 pcm or float32 in blocks of block_size samples, 
+    and each block is optionally delta coded and compressed with zlib. a 
+    table of block offsets follows the header so that any range of the 
+    audio can be read without fetching the whole thing
+    """
+    data = np.asarray(data)
+    if (decimate > 1):
+        if (samp_rate % decimate != 0):
+            raise Exception("cannot decimate rate " + str(samp_rate) + 
+                            " by " + str(decimate))
+        data = signal.decimate(data, decimate)
+        samp_rate = samp_rate // decimate
+
+    # cast the audio to the storage type, scaling into pcm range if needed
+    scale = 1.0
+    if (dtype == "int16"):
+        code = 0
+        peak = float(np.max(np.abs(data))) if len(data) > 0 else 0.0
+        # float audio always spans the pcm range, integer audio only if it
+        # would overflow it
+        if (peak > 32767 or (peak > 0 and np.issubdtype(data.dtype, np.floating))):
+            scale = peak / 32767
+        data = np.round(data / scale).astype(AUDIO_DTYPES[code])
+    elif (dtype == "float32"):
+        code = 1
+        data = data.astype(AUDIO_DTYPES[code])
+    else:
+        raise Exception("cannot store audio of type " + str(dtype))
+
+    # encode each block on its own, so they can be decoded independently
+    blocks = []
+    for start in range(0, len(data), block_size):
+        block = data[start:start + block_size]
+        if compress:
+            if (code == 0):
+                # delta code pcm blocks, which wraps around safely in int16
+                block = np.diff(block, prepend=np.zeros(1, block.dtype))
+            blocks.append(zlib.compress(block.tobytes()))
+        else:
+            blocks.append(block.tobytes())
+    offsets = np.cumsum([0] + [len(b) for b in blocks]).astype("<u8")
+
+    header = AUDIO_HEADER.pack(AUDIO_MAGIC, samp_rate, code, int(compress), 
+                               len(data), block_size, len(blocks), scale)
+    return b"".join([header, offsets.tobytes()] + blocks)
+
+def read_audio_header(read_at):
+    """
+    reads the header and block offset table of stored audio, using a function
+    read_at(offset, length) that returns length bytes starting at offset
+    """
+    magic, samp_rate, code, compressed, n_samples, block_size, n_blocks, \
+        scale = AUDIO_HEADER.unpack(read_at(0, AUDIO_HEADER.size))
+    if (magic != AUDIO_MAGIC):
+        logger.error("stored audio has an invalid header")
+        raise Exception("stored audio has an invalid header")
+    offsets = np.frombuffer(read_at(AUDIO_HEADER.size, 8 * (n_blocks + 1)), 
+                            dtype="<u8")
+    return {
+        "samp_rate": samp_rate,
+        "dtype": AUDIO_DTYPES[code],
+        "compressed": bool(compressed),
+        "n_samples": n_samples,
+        "block_size": block_size,
+        "scale": scale,
+        "offsets": offsets,
+        "data_start": AUDIO_HEADER.size + 8 * (n_blocks + 1)
+    }
+
+def decode_audio(read_at, start=None, end=None):
+    """
+    decodes stored audio between start and end (in seconds) using a function
+    read_at(offset, length), fetching only the blocks that cover the range.
+    returns the sampling rate and the audio as floating point data
+    """
+    header = read_audio_header(read_at)
+    samp_rate = header["samp_rate"]
+    block_size = header["block_size"]
+    first = 0 if start is None else max(0, int(start * samp_rate))
+    last = header["n_samples"] if end is None else \
+        min(header["n_samples"], int(end * samp_rate))
+    if (last <= first):
+        return samp_rate, np.zeros(0, dtype=np.float32)
+
+    # fetch the contiguous byte range for all of the blocks needed
+    first_block = first // block_size
+    last_block = (last - 1) // block_size + 1
+    offsets = header["offsets"]
+    base = header["data_start"] + int(offsets[first_block])
+    raw = read_at(base, int(offsets[last_block] - offsets[first_block]))
+
+    blocks = []
+    for b in range(first_block, last_block):
+        chunk = raw[offsets[b] - offsets[first_block]:offsets[b + 1] - offsets[first_block]]
+        if header["compressed"]:
+            block = np.frombuffer(zlib.decompress(chunk), dtype=header["dtype"])
+            if (header["dtype"].kind == "i"):
+                block = np.cumsum(block, dtype=header["dtype"])
+        else:
+            block = np.frombuffer(chunk, dtype=header["dtype"])
+        blocks.append(block)
+    audio = np.concatenate(blocks)[first - first_block * block_size:
+                                   last - first_block * block_size]
+    return samp_rate, audio.astype(np.float32) * header["scale"]
+
+def bytes_range_reader(buf):
+    """
+    returns a read_at(offset, length) function over an in-memory buffer (buf)
+    """
+    return lambda offset, length: bytes(buf[offset:offset + length])
+
+def file_range_reader(location):
+    """
+    returns a read_at(offset, length) function over a stored audio file, 
+    which only reads the requested bytes from disk
+    """
+    def read_at(offset, length):
+        with open(location, "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+    return read_at
+
+
+# SIGNATURE STORAGE
+
+def pack_signature(sig):
+    """
+    packs a signature (sig) into little-endian float32 bytes, returning the
+    bytes, the number of frames and the number of dimensions per frame. 
+    ragged signatures (one array per frame, like posfreq) have zero 
+    dimensions, and are stored as int32 frame lengths followed by the values
+    """
+    sig = np.asarray(sig)
+    if (sig.dtype != object and sig.ndim == 2):
+        n_frames, n_dims = sig.shape
+        return sig.astype("<f4").tobytes(), n_frames, n_dims
+    lengths = np.array([len(frame) for frame in sig], dtype="<i4")
+    values = np.concatenate([np.asarray(frame, dtype="<f4") for frame in sig]) \
+        if len(sig) > 0 else np.zeros(0, dtype="<f4")
+    return lengths.tobytes() + values.astype("<f4").tobytes(), len(sig), 0
+
+def unpack_signature(buf, n_frames, n_dims):
+    """
+    unpacks a signature stored by pack_signature without copying or parsing
+    for fixed-width signatures
+    """
+    if (n_dims > 0):
+        return np.frombuffer(buf, dtype="<f4").reshape(n_frames, n_dims)
+    lengths = np.frombuffer(buf, dtype="<i4", count=n_frames)
+    values = np.frombuffer(buf, dtype="<f4", offset=4 * n_frames)
+    sig = np.empty(n_frames, dtype=object)
+    for i, frame in enumerate(np.split(values, np.cumsum(lengths)[:-1])):
+        sig[i] = frame
+    return sig
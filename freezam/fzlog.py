@@ -0,0 +1,60 @@
+# logging setup for the freezam project
+# Graham Arthur (garthur), Carnegie Mellon University
+
+import sys
+import atexit
+import logging
+import logging.handlers
+import multiprocessing
+
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+def get_level(level):
+    """
+    gets a logging level from its name (like INFO) or number
+    """
+    if isinstance(level, int):
+        return level
+    number = logging.getLevelName(str(level).upper())
+    if not isinstance(number, int):
+        raise ValueError("unknown logging level " + str(level))
+    return number
+
+def setup_logging(log_file, level="INFO", verbose=False, max_bytes=10485760, backups=3):
+    """
+    sends log records through a queue to a background thread, which writes
+    them to log_file, rotated once it grows past max_bytes with backups old
+    logs kept, and to the console. the console only shows errors, unless
+    verbose. records below level are dropped where they are logged, before
+    their messages are formatted. worker processes forked afterwards log
+    through the same queue. the queue is drained at exit, and the listener
+    thread is returned
+    """
+    level = get_level(level)
+    formatter = logging.Formatter(LOG_FORMAT)
+    file_handler = logging.handlers.RotatingFileHandler(
+        log_file, maxBytes=max_bytes, backupCount=backups, delay=True)
+    file_handler.setFormatter(formatter)
+    console = logging.StreamHandler(sys.stdout)
+    console.setLevel(level if verbose else max(level, logging.ERROR))
+    console.setFormatter(formatter)
+
+    records = multiprocessing.Queue(-1)
+    listener = logging.handlers.QueueListener(records, file_handler, console,
+                                              respect_handler_level=True)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+def stop_logging(listener):
+    """
+    drains the queue of a listener from setup_logging and stops it, before
+    exit rather than at it
+    """
+    atexit.unregister(listener.stop)
+    listener.stop()
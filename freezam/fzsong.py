@@ -4,6 +4,8 @@
 import logging
 import uuid
 
+import numpy as np
+
 import fzcomp
 import fzio
 
@@ -17,10 +19,13 @@ class SongEntry(object):
     """
 
     def __init__(self, address, title="", artist="", album="", date="", 
-                 window_fn="hamming"):
+                 window_fn="hamming", kernel=None, kernel_width=5, dtype="float32",
+                 h=10, delta=1, octaves=8):
         """
         initializes a songEntry from a song object returned by the
-        io package, including populating all the fields above
+        io package, including populating all the fields above. h and delta
+        are the window size and shift of the periodograms (in seconds), and
+        octaves is the number of octaves of the maxpow signature
         """
         # required argument
         self.address = address
@@ -29,19 +34,80 @@ class SongEntry(object):
         self.artist = artist.lower()
         self.album = album.lower()
         self.date = date
+        self.octaves = octaves
         
         # computed on initialization
         self.song_id = str(uuid.uuid4())
-        logger.info("all metadata added for song " + self.song_id)
+        logger.debug("all metadata added for song %s", self.song_id)
         # read data
-        logger.info("creating SongEntry from address at " + address)
-        self.samp_rate, self.data = fzio.read_song(address)
+        logger.info("creating SongEntry from address at %s", address)
+        self.samp_rate, self.data = fzio.read_song(address, dtype=dtype)
         self.length = round(len(self.data) / self.samp_rate, 2)
         
         # perform spectral analysis
         self.freq, self.l_pdgrams = fzcomp.compute_periodogram(
             self.data,
             self.samp_rate,
-            window_fn = window_fn
+            h = h,
+            delta = delta,
+            window_fn = window_fn,
+            dtype = dtype
         )
-        logger.info("spectral analysis complete!")
\ No newline at end of file
+        self.l_pdgrams = fzcomp.smooth_periodogram(self.l_pdgrams, kernel, kernel_width)
+        logger.debug("spectral analysis complete!")
+    def signature(self, sig_type="maxpow"):
+        """
+        computes the signature of type sig_type (maxpow or posfreq) for the song
+        """
+        if (sig_type == "maxpow"):
+            return fzcomp.compute_sig_maxpow(self.l_pdgrams, self.samp_rate, self.octaves)
+        elif (sig_type == "posfreq"):
+            return fzcomp.compute_sig_posfreq(self.freq, self.l_pdgrams)
+        logger.error("unknown signature type %s", sig_type)
+        raise Exception("unknown signature type " + sig_type)
+
+# HELPERS
+
+def compute_signature(address, sig_type="maxpow", **analysis):
+    """
+    reads and analyses the song at address and returns only its signature,
+    so that worker processes don't have to send back the whole SongEntry.
+    analysis holds any keyword arguments for SongEntry, like window_fn
+    """
+    return SongEntry(address, **analysis).signature(sig_type)
+
+def stream_signature(address, seconds=1, h=10, delta=1, window_fn="hamming", 
+                     kernel=None, kernel_width=5, dtype="float32", octaves=8):
+    """
+    reads the song at address a few seconds at a time and yields (seconds 
+    read, new maxpow signature frames) pairs, so a signature can be grown 
+    window by window. the frames match those of SongEntry(address).signature()
+    """
+    buffer = None
+    read = 0
+    for samp_rate, block in fzio.read_song_blocks(address, seconds, dtype):
+        read += len(block) / samp_rate
+        buffer = block if buffer is None else np.concatenate([buffer, block])
+        if (len(buffer) < h * samp_rate):
+            continue
+        # analyse every window that is now complete, then drop the audio 
+        # that no later window starts in
+        _, l_pdgrams = fzcomp.compute_periodogram(buffer, samp_rate, h=h, delta=delta,
+                                                  window_fn=window_fn, dtype=dtype)
+        l_pdgrams = fzcomp.smooth_periodogram(l_pdgrams, kernel, kernel_width)
+        buffer = buffer[len(l_pdgrams) * delta * samp_rate:]
+        yield read, fzcomp.compute_sig_maxpow(l_pdgrams, samp_rate, octaves)
+
+def get_analysis(params):
+    """
+    gets the SongEntry analysis keyword arguments from the parameter settings
+    """
+    return {
+        "h": params["periodograms"]["window_size"],
+        "delta": params["periodograms"]["window_shift"],
+        "octaves": params["maxpow"]["octaves"],
+        "window_fn": params["periodograms"]["window_fn"],
+        "kernel": params["periodograms"]["kernel"],
+        "kernel_width": params["periodograms"]["kernel_width"],
+        "dtype": params["numeric"]["dtype"]
+    }
@@ -0,0 +1,224 @@
+# migrates an existing freezam postgresql database to the current schema
+# Graham Arthur (garthur), Carnegie Mellon University
+
+import os
+import json
+import pickle
+
+import numpy as np
+import psycopg2
+import psycopg2.extras
+
+from context import freezam
+from freezam import fzio
+
+SCHEMA_VERSION = 7
+
+# schema version 2: signatures move from REAL[][] text arrays into packed
+# float32 bytea columns, with indexes and a fingerprint hash table
+MIGRATE_2 = """
+ALTER TABLE fz_song_signatures RENAME TO fz_song_signatures_v1;
+
+CREATE TABLE fz_song_signatures (
+    song_id TEXT NOT NULL,
+    sig_type TEXT NOT NULL,
+    n_frames INTEGER NOT NULL,
+    n_dims INTEGER NOT NULL,
+    sig_ BYTEA NOT NULL,
+    PRIMARY KEY (sig_type, song_id),
+    FOREIGN KEY (song_id) REFERENCES fz_song_library (song_id) ON DELETE CASCADE
+);
+ALTER TABLE fz_song_signatures ALTER COLUMN sig_ SET STORAGE EXTERNAL;
+CREATE INDEX fz_song_signatures_song_id ON fz_song_signatures (song_id);
+
+CREATE TABLE fz_song_hashes (
+    hash BIGINT NOT NULL,
+    song_id TEXT NOT NULL,
+    frame INTEGER NOT NULL,
+    FOREIGN KEY (song_id) REFERENCES fz_song_library (song_id) ON DELETE CASCADE
+);
+CREATE INDEX fz_song_hashes_hash ON fz_song_hashes USING HASH (hash);
+CREATE INDEX fz_song_hashes_song_id ON fz_song_hashes (song_id);
+
+CREATE INDEX IF NOT EXISTS fz_song_data_song_id ON fz_song_data (song_id);
+
+CREATE TABLE fz_schema_version (
+    version INTEGER NOT NULL
+);
+INSERT INTO fz_schema_version (version) VALUES (2);
+"""
+
+# schema version 3: indexes for metadata lookups and filters
+MIGRATE_3 = """
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX fz_song_library_title ON fz_song_library (title text_pattern_ops);
+CREATE INDEX fz_song_library_artist ON fz_song_library (artist text_pattern_ops);
+CREATE INDEX fz_song_library_album ON fz_song_library (album text_pattern_ops);
+CREATE INDEX fz_song_library_title_trgm ON fz_song_library USING GIN (title gin_trgm_ops);
+CREATE INDEX fz_song_library_artist_trgm ON fz_song_library USING GIN (artist gin_trgm_ops);
+CREATE INDEX fz_song_library_album_trgm ON fz_song_library USING GIN (album gin_trgm_ops);
+UPDATE fz_schema_version SET version = 3;
+"""
+
+# schema version 4: a library version counter for cached search results
+MIGRATE_4 = """
+CREATE TABLE fz_library_version (
+    version BIGINT NOT NULL
+);
+INSERT INTO fz_library_version (version) VALUES (0);
+CREATE FUNCTION fz_bump_library_version() RETURNS trigger AS $$
+BEGIN
+    UPDATE fz_library_version SET version = version + 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER fz_song_library_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON fz_song_library
+    FOR EACH STATEMENT EXECUTE PROCEDURE fz_bump_library_version();
+UPDATE fz_schema_version SET version = 4;
+"""
+
+# schema version 5: tombstones for removed songs, purged by fz compact.
+# also drops the partial signature indexes that version 2 created, which
+# only duplicated the primary key and the song_id index
+MIGRATE_5 = """
+DROP INDEX IF EXISTS fz_song_signatures_maxpow;
+DROP INDEX IF EXISTS fz_song_signatures_posfreq;
+CREATE TABLE fz_song_tombstones (
+    song_id TEXT PRIMARY KEY,
+    removed_at TIMESTAMP NOT NULL DEFAULT now(),
+    FOREIGN KEY (song_id) REFERENCES fz_song_library (song_id) ON DELETE CASCADE
+);
+CREATE TRIGGER fz_song_tombstones_changed
+    AFTER INSERT OR DELETE ON fz_song_tombstones
+    FOR EACH STATEMENT EXECUTE PROCEDURE fz_bump_library_version();
+UPDATE fz_schema_version SET version = 5;
+"""
+
+# schema version 6: the posfreq settings the hashes were made with. the 
+# settings of existing hashes aren't known, so the next write records them
+MIGRATE_6 = """
+CREATE TABLE fz_lsh_settings (
+    bins INTEGER NOT NULL,
+    n_hashes INTEGER NOT NULL,
+    bands INTEGER NOT NULL,
+    peaks INTEGER
+);
+UPDATE fz_schema_version SET version = 6;
+"""
+
+# schema version 7: stored audio moves from pickled float64 arrays into the
+# freezam block format (see fzio.encode_audio), which the audio reads need
+MIGRATE_7 = """
+UPDATE fz_schema_version SET version = 7;
+"""
+
+def get_version(cur):
+    """
+    returns the schema version of the database, 1 for databases created
+    before the version table existed
+    """
+    cur.execute("SELECT to_regclass('fz_schema_version');")
+    if cur.fetchone()[0] is None:
+        return 1
+    cur.execute("SELECT max(version) FROM fz_schema_version;")
+    return cur.fetchone()[0]
+
+def migrate_2(conn):
+    """
+    moves the signatures from the version 1 table into packed bytea rows
+    """
+    cur = conn.cursor()
+    cur.execute(MIGRATE_2)
+    # stream the old signatures, they can be much larger than memory
+    old = conn.cursor(name="fz_migrate_2")
+    old.execute("SELECT song_id, sig_type, sig_ FROM fz_song_signatures_v1;")
+    insert_sig = """
+                 INSERT INTO fz_song_signatures (
+                    song_id, sig_type, n_frames, n_dims, sig_
+                 ) VALUES %s ON CONFLICT DO NOTHING;
+                 """
+    while True:
+        rows = old.fetchmany(1000)
+        if not rows:
+            break
+        packed = []
+        for song_id, sig_type, sig in rows:
+            if sig is None:
+                continue
+            buf, n_frames, n_dims = fzio.pack_signature(np.array(sig, dtype=np.float32))
+            packed.append((song_id, sig_type, n_frames, n_dims, psycopg2.Binary(buf)))
+        psycopg2.extras.execute_values(cur, insert_sig, packed)
+    old.close()
+    cur.execute("DROP TABLE fz_song_signatures_v1;")
+    cur.close()
+
+def migrate_7(conn, storage):
+    """
+    rewrites the pickled audio of the version 1 rows in the freezam block 
+    format, stored as the storage parameters say
+    """
+    cur = conn.cursor()
+    # stream the old audio, rows that are already converted are left alone
+    old = conn.cursor(name="fz_migrate_7")
+    old.execute("""
+                SELECT id, samp_rate, data FROM fz_song_data
+                WHERE substring(data FROM 1 FOR 4) <> %s;
+                """, (psycopg2.Binary(fzio.AUDIO_MAGIC),))
+    while True:
+        rows = old.fetchmany(100)
+        if not rows:
+            break
+        for row_id, samp_rate, data in rows:
+            audio = fzio.encode_audio(pickle.loads(bytes(data)), samp_rate, **storage)
+            cur.execute("UPDATE fz_song_data SET data = %s WHERE id = %s;",
+                        (psycopg2.Binary(audio), row_id))
+    old.close()
+    cur.execute(MIGRATE_7)
+    cur.close()
+
+if __name__ == "__main__":
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    with open(os.path.join(root, "settings", "db.json")) as d:
+        settings = json.load(d)["sql"]
+    with open(os.path.join(root, "settings", "param.json")) as p:
+        storage = json.load(p)["storage"]
+
+    conn = psycopg2.connect(host=settings["address"], database=settings["db"],
+                            user=settings["username"], password=settings["password"])
+    try:
+        cur = conn.cursor()
+        version = get_version(cur)
+        cur.close()
+        if (version < 2):
+            print("migrating to schema version 2...")
+            migrate_2(conn)
+        if (version < 3):
+            print("migrating to schema version 3...")
+            cur = conn.cursor()
+            cur.execute(MIGRATE_3)
+            cur.close()
+        if (version < 4):
+            print("migrating to schema version 4...")
+            cur = conn.cursor()
+            cur.execute(MIGRATE_4)
+            cur.close()
+        if (version < 5):
+            print("migrating to schema version 5...")
+            cur = conn.cursor()
+            cur.execute(MIGRATE_5)
+            cur.close()
+        if (version < 6):
+            print("migrating to schema version 6...")
+            cur = conn.cursor()
+            cur.execute(MIGRATE_6)
+            cur.close()
+        if (version < 7):
+            print("migrating to schema version 7...")
+            migrate_7(conn, storage)
+        # everything happens in one transaction, so a failure leaves the
+        # database as it was
+        conn.commit()
+        print("database is at schema version " + str(SCHEMA_VERSION))
+    finally:
+        conn.close()
@@ -1,8 +1,19 @@
+DROP TABLE IF EXISTS fz_schema_version;
+DROP TABLE IF EXISTS fz_library_version;
+DROP FUNCTION IF EXISTS fz_bump_library_version() CASCADE;
 DROP TABLE IF EXISTS fz_parameters;
+DROP TABLE IF EXISTS fz_song_tombstones;
+DROP TABLE IF EXISTS fz_lsh_settings;
+DROP TABLE IF EXISTS fz_song_hashes;
 DROP TABLE IF EXISTS fz_song_signatures;
 DROP TABLE IF EXISTS fz_song_data;
 DROP TABLE IF EXISTS fz_song_library;
 
+CREATE TABLE fz_schema_version (
+    version INTEGER NOT NULL
+);
+INSERT INTO fz_schema_version (version) VALUES (7);
+
 CREATE TABLE fz_parameters (
     window_fn TEXT,
     window_size INTEGER,
@@ -23,13 +34,64 @@ CREATE TABLE fz_song_library (
     length NUMERIC
 );
 
+-- the library version goes up with every change to the library, so that
+-- cached search results can tell when they are stale
+CREATE TABLE fz_library_version (
+    version BIGINT NOT NULL
+);
+INSERT INTO fz_library_version (version) VALUES (0);
+CREATE FUNCTION fz_bump_library_version() RETURNS trigger AS $$
+BEGIN
+    UPDATE fz_library_version SET version = version + 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER fz_song_library_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON fz_song_library
+    FOR EACH STATEMENT EXECUTE PROCEDURE fz_bump_library_version();
+
+-- metadata lookups: text_pattern_ops b-trees serve exact and prefix
+-- matches, trigram indexes serve substring filters
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX fz_song_library_title ON fz_song_library (title text_pattern_ops);
+CREATE INDEX fz_song_library_artist ON fz_song_library (artist text_pattern_ops);
+CREATE INDEX fz_song_library_album ON fz_song_library (album text_pattern_ops);
+CREATE INDEX fz_song_library_title_trgm ON fz_song_library USING GIN (title gin_trgm_ops);
+CREATE INDEX fz_song_library_artist_trgm ON fz_song_library USING GIN (artist gin_trgm_ops);
+CREATE INDEX fz_song_library_album_trgm ON fz_song_library USING GIN (album gin_trgm_ops);
+
+-- signatures are packed little-endian float32 (see fzio.pack_signature),
+-- n_dims = 0 marks a ragged signature like posfreq
 CREATE TABLE fz_song_signatures (
-    id SERIAL PRIMARY KEY,
-    song_id TEXT,
-    sig_type TEXT,
-    sig_ REAL[][],
+    song_id TEXT NOT NULL,
+    sig_type TEXT NOT NULL,
+    n_frames INTEGER NOT NULL,
+    n_dims INTEGER NOT NULL,
+    sig_ BYTEA NOT NULL,
+    PRIMARY KEY (sig_type, song_id),
+    FOREIGN KEY (song_id) REFERENCES fz_song_library (song_id) ON DELETE CASCADE
+);
+ALTER TABLE fz_song_signatures ALTER COLUMN sig_ SET STORAGE EXTERNAL;
+CREATE INDEX fz_song_signatures_song_id ON fz_song_signatures (song_id);
+
+-- fingerprint hashes, one row per hash per frame of a song
+CREATE TABLE fz_song_hashes (
+    hash BIGINT NOT NULL,
+    song_id TEXT NOT NULL,
+    frame INTEGER NOT NULL,
     FOREIGN KEY (song_id) REFERENCES fz_song_library (song_id) ON DELETE CASCADE
 );
+CREATE INDEX fz_song_hashes_hash ON fz_song_hashes USING HASH (hash);
+CREATE INDEX fz_song_hashes_song_id ON fz_song_hashes (song_id);
+
+-- the posfreq settings the hashes were made with (see fzdb.hash_settings),
+-- recorded by the first write. searches with other settings are refused
+CREATE TABLE fz_lsh_settings (
+    bins INTEGER NOT NULL,
+    n_hashes INTEGER NOT NULL,
+    bands INTEGER NOT NULL,
+    peaks INTEGER
+);
 
 CREATE TABLE fz_song_data (
     id SERIAL PRIMARY KEY,
@@ -37,4 +99,20 @@ CREATE TABLE fz_song_data (
     samp_rate INTEGER,
     data BYTEA,
     FOREIGN KEY (song_id) REFERENCES fz_song_library (song_id) ON DELETE CASCADE
-);
\ No newline at end of file
+);
+CREATE INDEX fz_song_data_song_id ON fz_song_data (song_id);
+
+-- audio is stored in the freezam block format, which is already compressed
+-- and read by byte range, so keep it out of toast compression
+ALTER TABLE fz_song_data ALTER COLUMN data SET STORAGE EXTERNAL;
+
+-- removed songs are tombstoned, and left in the tables until fz compact
+-- purges them. every read of the library leaves tombstoned songs out
+CREATE TABLE fz_song_tombstones (
+    song_id TEXT PRIMARY KEY,
+    removed_at TIMESTAMP NOT NULL DEFAULT now(),
+    FOREIGN KEY (song_id) REFERENCES fz_song_library (song_id) ON DELETE CASCADE
+);
+CREATE TRIGGER fz_song_tombstones_changed
+    AFTER INSERT OR DELETE ON fz_song_tombstones
+    FOR EACH STATEMENT EXECUTE PROCEDURE fz_bump_library_version();
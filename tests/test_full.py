@@ -2,15 +2,33 @@
 # Graham Arthur (garthur), Carnegie Mellon University
 
 import os
+import json
+import logging
+import shutil
+import sqlite3
+import tempfile
+import threading
+import functools
+import http.server
 import unittest
 import random
 import math
 import numpy as np
+import scipy.io.wavfile as wav
 
 from .context import freezam
 from freezam import fzsong
 from freezam import fzcomp
 from freezam import fzio
+from freezam import fzdb
+from freezam import fzingest
+from freezam import fzindex
+from freezam import fzdedupe
+from freezam import fzarchive
+from freezam import fzeval
+from freezam import fzlog
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
 
 class TestHelpers(object):
 
@@ -39,6 +57,13 @@ class TestHelpers(object):
         test_snippet = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test", "wn_snip{0}.wav".format(random.randint(1,4)))
         return fzsong.SongEntry(test_snippet, title="SNIPPET", artist="TEST")
     
+    @staticmethod
+    def get_test_params():
+        param_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                                  "..", "settings", "param.json")
+        with open(param_file) as p:
+            return json.load(p)
+
     @staticmethod
     def get_test_filesystem_databaser():
         return fzdb.FileSystemDB(None)
@@ -128,6 +153,135 @@ class TestFreezamComp(unittest.TestCase):
             # and itself
             self.assertTrue(fzcomp.match_signature(snip_sig, snip_sig))
 
+    def test_smooth_pdgram(self):
+        samp_rate = 40000
+        audio = TestHelpers.sample_audio(samp_rate)
+        _, pdgrams = fzcomp.compute_periodogram(audio, samp_rate, h=10, delta=1)
+
+        self.assertIs(fzcomp.smooth_periodogram(pdgrams, "None"), pdgrams)
+        for kernel in ["daniell", "modified_daniell", "hamming"]:
+            smoothed = fzcomp.smooth_periodogram(pdgrams, kernel, 5)
+            self.assertEqual(smoothed.shape, pdgrams.shape)
+            # smoothing keeps the total power, and reduces the variance
+            self.assertTrue(np.allclose(np.sum(smoothed, axis=1), np.sum(pdgrams, axis=1), 
+                                        rtol=1e-3))
+            self.assertLess(np.var(smoothed), np.var(pdgrams))
+
+        # the daniell kernel is a moving average over frequencies
+        smoothed = fzcomp.smooth_periodogram(pdgrams, "daniell", 3)
+        self.assertTrue(np.allclose(smoothed[:, 1:-1], 
+                                    (pdgrams[:, :-2] + pdgrams[:, 1:-1] + pdgrams[:, 2:]) / 3))
+
+    def test_envelope(self):
+        samp_rate = 40000
+        sigs = []
+        for scale in [1, 100]:
+            audio = TestHelpers.sample_audio(samp_rate) * scale
+            _, pdgrams = fzcomp.compute_periodogram(audio, samp_rate, h=10, delta=1)
+            sigs.append(fzcomp.compute_sig_maxpow(pdgrams, samp_rate))
+        envelope = fzcomp.compute_sig_envelope(sigs[0])
+        self.assertEqual(envelope.shape, (2, sigs[0].shape[1]))
+
+        # a true match is never pruned, even with no slack at all
+        for k in range(0, 10):
+            start = random.randint(0, len(sigs[0]) - 2)
+            snip_sig = sigs[0][start:start + 2]
+            self.assertTrue(fzcomp.envelope_may_match(snip_sig, envelope, epsilon=1e-12))
+        # a much louder song is
+        self.assertFalse(fzcomp.envelope_may_match(sigs[1][0:2], envelope, epsilon=1))
+
+    def test_batch_match(self):
+        # two distinct songs, and snippets cut from each
+        samp_rate = 40000
+        library = []
+        for k in range(0, 2):
+            audio = TestHelpers.sample_audio(samp_rate) * (k + 1)
+            _, pdgrams = fzcomp.compute_periodogram(audio, samp_rate, h=10, delta=1)
+            library.append(("song" + str(k), fzcomp.compute_sig_maxpow(pdgrams, samp_rate)))
+        snippets = {"snip0": library[0][1][3:8], "snip1": library[1][1][5:12]}
+
+        results = dict(fzcomp.batch_match(iter(library), snippets, epsilon=1e-6))
+        self.assertEqual(dict((name, [m[0] for m in matches]) 
+                              for name, matches in results.items()),
+                         {"snip0": ["song0"], "snip1": ["song1"]})
+        # exact matches get a perfect score
+        self.assertAlmostEqual(results["snip0"][0][1], 1.0)
+
+    def test_voting_match(self):
+        samp_rate = 40000
+        audio = TestHelpers.sample_audio(samp_rate)
+        _, pdgrams = fzcomp.compute_periodogram(audio, samp_rate, h=10, delta=1)
+        sig_full = fzcomp.compute_sig_maxpow(pdgrams, samp_rate)
+
+        # corrupt one frame of a ten frame snippet from the end of the song
+        start = len(sig_full) - 10
+        snippet = np.array(sig_full[start:], copy=True)
+        snippet[4] += 1e6
+        self.assertFalse(fzcomp.match_signature(snippet, sig_full, epsilon=1e-6))
+        self.assertIsNone(fzcomp.score_signature(snippet, sig_full, epsilon=1e-6))
+
+        # but nine of ten frames still vote for the right offset
+        score = fzcomp.score_signature(snippet, sig_full, epsilon=1e-6, min_fraction=0.8)
+        self.assertAlmostEqual(score, 0.9)
+        envelope = fzcomp.compute_sig_envelope(sig_full)
+        self.assertTrue(fzcomp.envelope_may_match(snippet, envelope, 1e-6, min_fraction=0.8))
+        self.assertFalse(fzcomp.envelope_may_match(snippet, envelope, 1e-6))
+
+        # and the better of two candidates ranks first
+        library = [("noisy", sig_full * 1.5), ("song", sig_full)]
+        results = dict(fzcomp.batch_match(iter(library), {"snip": snippet}, epsilon=1e-6, 
+                                          num_matches=2, min_fraction=0.8))
+        self.assertEqual([m[0] for m in results["snip"]], ["song"])
+
+    def test_vote_counter(self):
+        samp_rate = 40000
+        library = []
+        for k in range(0, 2):
+            audio = TestHelpers.sample_audio(samp_rate) * (k + 1)
+            _, pdgrams = fzcomp.compute_periodogram(audio, samp_rate, h=10, delta=1)
+            library.append(("song" + str(k), fzcomp.compute_sig_maxpow(pdgrams, samp_rate)))
+        snippet = library[0][1][2:9]
+
+        # growing the snippet frame by frame scores like the whole snippet
+        counter = fzcomp.VoteCounter(iter(library), epsilon=1e-6)
+        for k in range(0, len(snippet)):
+            counter.add_frames(snippet[k:k + 1])
+            self.assertEqual([m[0] for m in counter.ranking(2)], ["song0"])
+            self.assertAlmostEqual(counter.ranking()[0][1], 
+                                   fzcomp.score_signature(snippet[:k + 1], library[0][1], 1e-6))
+            self.assertEqual(counter.confident(margin=3), k >= 2)
+
+    def test_float32(self):
+        songs = {}
+        for dtype in ["float64", "float32"]:
+            songs[dtype] = [fzsong.SongEntry(os.path.join(DATA_DIR, f), dtype=dtype) 
+                            for f in ["wn_snip1.wav", "wn_snip2.wav"]]
+        for song64, song32 in zip(songs["float64"], songs["float32"]):
+            self.assertEqual(song32.data.dtype, np.float32)
+            self.assertEqual(song32.l_pdgrams.dtype, np.float32)
+            sig64, sig32 = song64.signature("maxpow"), song32.signature("maxpow")
+            self.assertEqual(sig32.dtype, np.float32)
+            # float32 only rounds the float64 pipeline
+            self.assertTrue(np.allclose(song32.l_pdgrams, song64.l_pdgrams, rtol=1e-5,
+                                        atol=1e-6 * np.max(song64.l_pdgrams)))
+            self.assertTrue(np.allclose(sig32, sig64, rtol=1e-6, atol=0))
+
+        # float32 snippets match the float64 library within a tiny epsilon
+        library = [("song" + str(k), song.signature("maxpow")) 
+                   for k, song in enumerate(songs["float64"])]
+        snippets = dict((("song" + str(k), start), song.signature("maxpow")[start:start + 2])
+                        for k, song in enumerate(songs["float32"]) 
+                        for start in range(0, len(song.signature("maxpow")) - 1))
+        for (song_id, _), matches in fzcomp.batch_match(iter(library), snippets, epsilon=0.1, 
+                                                        num_matches=2):
+            self.assertIn(song_id, [m[0] for m in matches])
+
+        # and nothing at the edges upcasts them again
+        self.assertEqual(fzio.read_song(os.path.join(DATA_DIR, "wn_snip1.wav"))[1].dtype, 
+                         np.float32)
+        for sig in [songs["float32"][0].signature("maxpow"), np.zeros((0, 8), np.float32)]:
+            self.assertEqual(fzcomp.compute_sig_envelope(sig).dtype, np.float32)
+
 class TestFreezamIO(unittest.TestCase):
 
     def test_get_reader(self):
@@ -137,6 +291,54 @@ class TestFreezamIO(unittest.TestCase):
         with self.assertRaises(IndexError):
             fzio.get_reader(79)
 
+    def test_read_song_blocks(self):
+        location = os.path.join(DATA_DIR, "wn_snip2.wav")
+        rate, audio = fzio.read_song(location)
+        blocks = list(fzio.read_song_blocks(location, seconds=2))
+        self.assertEqual(len(blocks), math.ceil(len(audio) / (2 * rate)))
+        self.assertTrue(all(block_rate == rate for block_rate, _ in blocks))
+        self.assertTrue(np.array_equal(np.concatenate([b for _, b in blocks]), audio))
+
+    def test_audio_storage(self):
+        samp_rate = 40000
+        audio = np.round(TestHelpers.sample_audio(samp_rate) * 1000).astype(np.int16)
+
+        for compress in [False, True]:
+            buf = fzio.encode_audio(audio, samp_rate, compress=compress, block_size=4096)
+            read_at = fzio.bytes_range_reader(buf)
+            # pcm storage is lossless for pcm-valued audio
+            rate, full = fzio.decode_audio(read_at)
+            self.assertEqual(rate, samp_rate)
+            self.assertTrue(np.array_equal(full, audio))
+            # ranges line up with the full audio
+            _, part = fzio.decode_audio(read_at, start=2.5, end=3.25)
+            self.assertTrue(np.array_equal(part, audio[100000:130000]))
+
+        # float audio is scaled into pcm range, whatever its peak
+        for peak in [0.5, 2.5, 1e6]:
+            signal = TestHelpers.sample_audio(samp_rate, length=2)
+            signal = signal * peak / np.max(np.abs(signal))
+            _, decoded = fzio.decode_audio(fzio.bytes_range_reader(
+                fzio.encode_audio(signal, samp_rate)))
+            self.assertTrue(np.allclose(decoded, signal, atol=peak / 32767))
+
+    def test_signature_storage(self):
+        samp_rate = 40000
+        audio = TestHelpers.sample_audio(samp_rate)
+        freq, pdgrams = fzcomp.compute_periodogram(audio, samp_rate, h=10, delta=1)
+
+        sig = fzcomp.compute_sig_maxpow(pdgrams, samp_rate)
+        unpacked = fzio.unpack_signature(*fzio.pack_signature(sig))
+        self.assertEqual(unpacked.shape, sig.shape)
+        self.assertTrue(np.allclose(unpacked, sig, rtol=1e-6))
+
+        # posfreq signatures are ragged
+        sig = fzcomp.compute_sig_posfreq(freq, pdgrams)
+        unpacked = fzio.unpack_signature(*fzio.pack_signature(sig))
+        self.assertEqual(len(unpacked), len(sig))
+        for x, y in zip(unpacked, sig):
+            self.assertTrue(np.allclose(x, y, rtol=1e-6))
+
 class TestFreezamDB(unittest.TestCase):
 
     def test_filesystem_db(self):
@@ -167,5 +369,709 @@ class TestFreezamDB(unittest.TestCase):
         self.assertIsNotNone(databaser.slow_search(test_snippet))
         databaser.remove(test_song.song_id)
 
+    def test_sqlite_db(self):
+        db_root = tempfile.mkdtemp()
+        try:
+            databaser = fzdb.SQLiteDB({"address": os.path.join(db_root, "fz.db")}, 
+                                      TestHelpers.get_test_params())
+            songs = [fzsong.SongEntry(os.path.join(DATA_DIR, "wn_snip1.wav"), title="one"),
+                     fzsong.SongEntry(os.path.join(DATA_DIR, "wn_snip2.wav"), title="two")]
+
+            # test adding, where a song that is already in the library doesn't
+            # hold back the rest of its batch
+            self.assertEqual(databaser.write(songs[0]), [songs[0].song_id])
+            self.assertEqual(databaser.write_many(songs), [songs[1].song_id])
+            self.assertEqual(sorted(song[1] for song in databaser.list_db()), ["one", "two"])
+            rate, audio = databaser.get_audio(songs[0].song_id, start=1, end=2)
+            self.assertEqual(rate, songs[0].samp_rate)
+            self.assertTrue(np.allclose(audio, songs[0].data[rate:2 * rate], atol=1))
+
+            # test slow search
+            result = databaser.slow_search(songs[1])
+            self.assertEqual(result[0][0], songs[1].song_id)
+
+            # test remove
+            databaser.remove(songs[1].song_id)
+            self.assertEqual([song[1] for song in databaser.list_db()], ["one"])
+            self.assertIsNone(databaser.slow_search(songs[1]))
+
+            # test clear
+            databaser.clear()
+            self.assertEqual(databaser.list_db(), [])
+        finally:
+            shutil.rmtree(db_root)
+
+    def test_progressive_search(self):
+        db_root = tempfile.mkdtemp()
+        try:
+            params = TestHelpers.get_test_params()
+            databaser = fzdb.SQLiteDB({"address": os.path.join(db_root, "fz.db")}, params)
+            locations = [os.path.join(DATA_DIR, f) for f in ["wn_snip1.wav", "wn_snip2.wav"]]
+            songs = [fzsong.SongEntry(location) for location in locations]
+            databaser.write_many(songs)
+
+            # the streamed signature is the same as the whole song's
+            frames = [sig for _, sig in fzsong.stream_signature(locations[0])]
+            self.assertTrue(np.allclose(np.concatenate(frames), songs[0].signature("maxpow")))
+
+            # and the search stops well before the end of the snippet
+            matches, read = fzdb.progressive_search(
+                databaser, fzsong.stream_signature(locations[0]), margin=3,
+                **fzdb.search_settings(params))
+            self.assertEqual(matches[0][0], songs[0].song_id)
+            self.assertEqual(read, 12)
+
+            # songs whose envelopes rule out the first frames are never loaded
+            loaded = []
+            iterate_signatures = databaser.iterate_signatures
+            def record_loads(sig_type, song_ids=None):
+                loaded.append(song_ids)
+                return iterate_signatures(sig_type, song_ids)
+            databaser.iterate_signatures = record_loads
+            louder = os.path.join(db_root, "louder.wav")
+            samp_rate, data = fzio.read_song(locations[1])
+            wav.write(louder, samp_rate, (data * 100).astype(np.float32))
+            matches, _ = fzdb.progressive_search(
+                databaser, fzsong.stream_signature(louder), **fzdb.search_settings(params))
+            self.assertEqual(matches, [])
+            self.assertEqual(loaded, [[]])
+        finally:
+            shutil.rmtree(db_root)
+
+    def test_filesystem_recovery(self):
+        db_root = tempfile.mkdtemp()
+        try:
+            params = TestHelpers.get_test_params()
+            settings = {"address": db_root}
+            databaser = fzdb.FileSystemDB(settings, params)
+            songs = [fzsong.SongEntry(os.path.join(DATA_DIR, "wn_snip2.wav"), title="one"),
+                     fzsong.SongEntry(os.path.join(DATA_DIR, "wn_snip2.wav"), title="two")]
+            databaser.write_many(songs)
+            # other databasers see committed changes
+            reader = fzdb.FileSystemDB(settings, params)
+            self.assertEqual(sorted(song[1] for song in reader.list_db()), ["one", "two"])
+
+            # crash after writing a song's files but before committing it, 
+            # and in the middle of appending a record
+            orphans = [os.path.join(db_root, "fz_song_sigs", "ghost.pkl"),
+                       os.path.join(db_root, "fz_song_data", "ghost.fza.tmp")]
+            for orphan in orphans:
+                with open(orphan, "wb") as f:
+                    f.write(b"partial")
+                os.utime(orphan, (0, 0))
+            manifest = os.path.join(db_root, "fz_song_manifest.jsonl")
+            with open(manifest, "a") as f:
+                f.write('{"op": "remove", "id": "' + songs[1].song_id)
+
+            # the torn record and the orphans are dropped on startup
+            databaser = fzdb.FileSystemDB(settings, params)
+            self.assertEqual(sorted(song[1] for song in databaser.list_db()), ["one", "two"])
+            self.assertFalse(any(os.path.exists(orphan) for orphan in orphans))
+            with open(manifest, "rb") as f:
+                self.assertTrue(f.read().endswith(b"\n"))
+
+            # removes are visible to other databasers, and survive a restart
+            databaser.remove(songs[1].song_id)
+            self.assertEqual([song[1] for song in reader.list_db()], ["one"])
+            self.assertIsNone(reader.get_info(songs[1].song_id))
+            databaser = fzdb.FileSystemDB(settings, params)
+            self.assertEqual([song[1] for song in databaser.list_db()], ["one"])
+            self.assertEqual(databaser.slow_search(songs[0])[0][0], songs[0].song_id)
+        finally:
+            shutil.rmtree(db_root)
+
+    def test_signature_index(self):
+        db_root = tempfile.mkdtemp()
+        try:
+            params = TestHelpers.get_test_params()
+            databaser = fzdb.SQLiteDB({"address": os.path.join(db_root, "fz.db")}, params)
+            songs = [fzsong.SongEntry(os.path.join(DATA_DIR, f), title=f)
+                     for f in ["wn_snip1.wav", "wn_snip2.wav"]]
+            databaser.write(songs[0])
+            location = os.path.join(db_root, "index")
+            self.assertEqual(fzindex.build_index(databaser, location), 1)
+
+            # the index holds the same signatures as the library
+            index = fzindex.SignatureIndex(location)
+            self.assertEqual(len(index), 1)
+            stored = dict(databaser.iterate_signatures("maxpow"))
+            for song_id, sig in index.iterate_signatures("maxpow"):
+                self.assertTrue(np.array_equal(sig, stored[song_id]))
+
+            self.assertEqual([song_id for song_id, _ in index.iterate_signatures(
+                "maxpow", ["missing", songs[0].song_id])], [songs[0].song_id])
+            self.assertTrue(fzindex.is_current(location, databaser.version()))
+
+            # readers pick up a rebuilt index when they refresh, and an index
+            # that is behind the library knows it
+            databaser.write(songs[1])
+            self.assertFalse(fzindex.is_current(location, databaser.version()))
+            self.assertEqual(fzindex.build_index(databaser, location), 2)
+            self.assertTrue(fzindex.is_current(location, databaser.version()))
+            self.assertEqual(len(index), 1)
+            self.assertTrue(index.refresh())
+            self.assertEqual(len(index), 2)
+            self.assertFalse(index.refresh())
+
+            # searching in worker processes finds the same songs
+            sigs = dict((song.title, song.signature("maxpow")) for song in songs)
+            for jobs in [1, 2]:
+                results = dict(fzindex.search(location, sigs, jobs=jobs,
+                                              **fzdb.search_settings(params)))
+                for song in songs:
+                    self.assertEqual(results[song.title][0][0], song.song_id)
+        finally:
+            shutil.rmtree(db_root)
+
+    def test_result_cache(self):
+        cache = fzdb.ResultCache(size=2, quantum=100)
+        sig = np.array([[1000.0, 2000.0], [3000.0, 4000.0]])
+        # nearly identical signatures share a key, different settings don't
+        self.assertEqual(cache.key(sig, 1), cache.key(sig + 10, 1))
+        self.assertNotEqual(cache.key(sig, 1), cache.key(sig, 2))
+        self.assertNotEqual(cache.key(sig, 1), cache.key(sig + 1000, 1))
+
+        self.assertIsNone(cache.get("a", 0))
+        cache.put("a", 0, ["song a"])
+        cache.put("b", 0, [])
+        self.assertEqual(cache.get("a", 0), ["song a"])
+        self.assertEqual(cache.get("b", 0), [])
+        # the least recently used entry goes first
+        cache.get("a", 0)
+        cache.put("c", 0, ["song c"])
+        self.assertIsNone(cache.get("b", 0))
+        self.assertEqual(cache.get("a", 0), ["song a"])
+        # and everything goes when the library changes
+        self.assertIsNone(cache.get("a", 1))
+        self.assertEqual(cache.stats(), {"entries": 0, "hits": 4, "misses": 3, 
+                                         "hit_rate": 4 / 7})
+
+        # every change to the library changes its version
+        db_root = tempfile.mkdtemp()
+        try:
+            params = TestHelpers.get_test_params()
+            song = fzsong.SongEntry(os.path.join(DATA_DIR, "wn_snip2.wav"))
+            for databaser in [fzdb.FileSystemDB({"address": os.path.join(db_root, "fs")}, params),
+                              fzdb.SQLiteDB({"address": os.path.join(db_root, "fz.db")}, params)]:
+                versions = [databaser.version()]
+                self.assertEqual(databaser.version(), versions[0])
+                databaser.write(song)
+                versions.append(databaser.version())
+                databaser.remove(song.song_id)
+                versions.append(databaser.version())
+                databaser.write(song)
+                databaser.clear()
+                versions.append(databaser.version())
+                self.assertEqual(len(set(versions)), len(versions))
+        finally:
+            shutil.rmtree(db_root)
+
+    def test_dedupe(self):
+        self.assertEqual(fzdedupe.cluster_pairs([("b", "a"), ("c", "d"), ("a", "e"), ("b", "e")]),
+                         [["a", "b", "e"], ["c", "d"]])
+        self.assertEqual([len(p) for p in fzdedupe.get_probes(np.zeros((20, 8)))], [5, 5, 5])
+        self.assertEqual([len(p) for p in fzdedupe.get_probes(np.zeros((3, 8)))], [3])
+
+        db_root = tempfile.mkdtemp()
+        try:
+            params = TestHelpers.get_test_params()
+            db_settings = {"db_type": "sqlite", 
+                           "sqlite": {"address": os.path.join(db_root, "fz.db")}}
+            databaser = fzdb.get_databaser(db_settings, params)
+            # the same track twice, a radio edit cut from it, and another song
+            full = fzsong.SongEntry(os.path.join(DATA_DIR, "wn_snip1.wav"), title="full")
+            copy = fzsong.SongEntry(os.path.join(DATA_DIR, "wn_snip1.wav"), title="copy")
+            edit = fzsong.SongEntry(os.path.join(DATA_DIR, "wn_snip1.wav"), title="edit")
+            edit.data = edit.data[:15 * edit.samp_rate]
+            edit.length = 15.0
+            edit.l_pdgrams = edit.l_pdgrams[:6]
+            other = fzsong.SongEntry(os.path.join(DATA_DIR, "wn_snip2.wav"), title="other")
+            databaser.write_many([full, copy, edit, other])
+
+            expected = [sorted([full.song_id, copy.song_id, edit.song_id])]
+            for jobs in [1, 2]:
+                self.assertEqual(fzdedupe.find_duplicates(databaser, params, db_settings, 
+                                                          jobs=jobs), expected)
+            rows = fzdedupe.surviving_rows(databaser, expected[0])
+            self.assertEqual(len(rows), 3)
+            self.assertIn(fzdedupe.pick_keeper(rows)[1], ["full", "copy"])
+
+            # clusters that lost their duplicates after probing are skipped
+            databaser.remove(copy.song_id)
+            databaser.remove(edit.song_id)
+            self.assertEqual(fzdedupe.surviving_rows(databaser, expected[0]), [])
+        finally:
+            shutil.rmtree(db_root)
+
+    def test_archive(self):
+        db_root = tempfile.mkdtemp()
+        try:
+            params = TestHelpers.get_test_params()
+            source = fzdb.FileSystemDB({"address": os.path.join(db_root, "fs")}, params)
+            songs = [fzsong.SongEntry(os.path.join(DATA_DIR, f), title=f, artist="test")
+                     for f in ["wn_snip1.wav", "wn_snip2.wav"]]
+            source.write_many(songs)
+            archive = os.path.join(db_root, "library.zip")
+            self.assertEqual(fzarchive.export_library(source, archive, chunk_size=1), 2)
+
+            # import into another backend, twice to check songs aren't doubled
+            target = fzdb.SQLiteDB({"address": os.path.join(db_root, "fz.db")}, params)
+            self.assertEqual(fzarchive.import_library(target, archive), 2)
+            self.assertEqual(fzarchive.import_library(target, archive), 0)
+            self.assertEqual([tuple(row) for row in target.list_db()], 
+                             [tuple(row) for row in source.list_db()])
+            for sig_type in ["maxpow", "posfreq"]:
+                expected = dict(source.iterate_signatures(sig_type))
+                for song_id, sig in target.iterate_signatures(sig_type):
+                    for frame, expected_frame in zip(sig, expected[song_id]):
+                        self.assertTrue(np.allclose(frame, expected_frame))
+            self.assertTrue(np.array_equal(target.get_audio(songs[0].song_id)[1],
+                                           source.get_audio(songs[0].song_id)[1]))
+            self.assertEqual(target.slow_search(songs[1])[0][0], songs[1].song_id)
+
+            # and back again, without the audio
+            fzarchive.export_library(target, archive, audio=False)
+            copy = fzdb.FileSystemDB({"address": os.path.join(db_root, "copy")}, params)
+            self.assertEqual(fzarchive.import_library(copy, archive), 2)
+            self.assertEqual(copy.slow_search(songs[0])[0][0], songs[0].song_id)
+
+            # songs without a signature are left out, rather than ending the export
+            conn = sqlite3.connect(os.path.join(db_root, "fz.db"))
+            conn.execute("DELETE FROM fz_song_signatures WHERE song_id = ? AND sig_type = ?;",
+                         (songs[0].song_id, "posfreq"))
+            conn.commit()
+            conn.close()
+            self.assertEqual(fzarchive.export_library(target, archive), 1)
+            partial = fzdb.FileSystemDB({"address": os.path.join(db_root, "partial")}, params)
+            self.assertEqual(fzarchive.import_library(partial, archive), 1)
+            self.assertEqual([row[0] for row in partial.list_db()], [songs[1].song_id])
+
+            # and archives made with other posfreq settings are refused
+            other = json.loads(json.dumps(params))
+            other["posfreq"]["peaks"] = params["posfreq"]["peaks"] // 2
+            with self.assertRaises(ValueError):
+                fzarchive.import_library(
+                    fzdb.FileSystemDB({"address": os.path.join(db_root, "other")}, other), archive)
+        finally:
+            shutil.rmtree(db_root)
+
+    def test_lsh_search(self):
+        db_root = tempfile.mkdtemp()
+        try:
+            params = TestHelpers.get_test_params()
+            songs = [fzsong.SongEntry(os.path.join(DATA_DIR, f))
+                     for f in ["wn_snip1.wav", "wn_snip2.wav"]]
+            # a snippet from 3 seconds into the first song, quieter and noisier
+            data = songs[0].data[3 * songs[0].samp_rate:] * 0.5
+            data = data + np.random.normal(scale=0.01 * np.std(data), size=data.shape)
+            snippet = fzsong.SongEntry(os.path.join(DATA_DIR, "wn_snip1.wav"))
+            snippet.freq, snippet.l_pdgrams = fzcomp.compute_periodogram(data, snippet.samp_rate)
+
+            sig = fzdb.snippet_posfreq(snippet, params)
+            self.assertTrue(all(len(frame) <= params["posfreq"]["peaks"] for frame in sig))
+            settings = fzdb.lsh_settings(params)
+            hashes, frames = fzcomp.compute_lsh_hashes(sig, **settings)
+            self.assertEqual(len(hashes), len(sig) * settings["bands"])
+            self.assertTrue(np.array_equal(hashes, fzcomp.compute_lsh_hashes(sig, **settings)[0]))
+
+            databasers = [fzdb.FileSystemDB({"address": os.path.join(db_root, "fs")}, params),
+                          fzdb.SQLiteDB({"address": os.path.join(db_root, "fz.db")}, params)]
+            for databaser in databasers:
+                databaser.write_many(songs)
+                matches = databaser.search(snippet, num_matches=2)
+                self.assertEqual(len(matches), 1)
+                self.assertEqual(matches[0][0], songs[0].song_id)
+                self.assertGreater(matches[0][-1], 0.5)
+                databaser.remove(songs[0].song_id)
+                self.assertIsNone(databaser.search(snippet))
+
+            # the sql hash table records its settings, and refuses any others
+            conn = sqlite3.connect(os.path.join(db_root, "fz.db"))
+            self.assertEqual(conn.execute("SELECT * FROM fz_lsh_settings;").fetchall(),
+                             [tuple(fzdb.hash_settings(params).values())])
+            other = json.loads(json.dumps(params))
+            other["posfreq"]["bins"] = params["posfreq"].get("bins", 1024) // 2
+            databaser = fzdb.SQLiteDB({"address": os.path.join(db_root, "fz.db")}, other)
+            with self.assertRaises(ValueError):
+                databaser.search(snippet)
+            self.assertEqual(databaser.write(songs[0]), [])
+
+            # songs written before the hash table are warned about
+            conn.execute("DELETE FROM fz_song_hashes;")
+            conn.commit()
+            conn.close()
+            databaser = fzdb.SQLiteDB({"address": os.path.join(db_root, "fz.db")}, params)
+            with self.assertLogs("fz.db", logging.WARNING):
+                self.assertIsNone(databaser.search(snippet))
+
+            # the file hash table is saved, and kept up to date by other processes
+            databaser = fzdb.FileSystemDB({"address": os.path.join(db_root, "fs")}, params)
+            databaser.write(songs[0])
+            self.assertEqual(databaser.search(snippet)[0][0], songs[0].song_id)
+        finally:
+            shutil.rmtree(db_root)
+
+    def test_compact(self):
+        db_root = tempfile.mkdtemp()
+        try:
+            params = TestHelpers.get_test_params()
+            songs = [fzsong.SongEntry(os.path.join(DATA_DIR, f))
+                     for f in ["wn_snip1.wav", "wn_snip2.wav"]]
+            snippet = fzsong.SongEntry(os.path.join(DATA_DIR, "wn_snip1.wav"))
+            fs_root = os.path.join(db_root, "fs")
+            databasers = [fzdb.FileSystemDB({"address": fs_root}, params),
+                          fzdb.SQLiteDB({"address": os.path.join(db_root, "fz.db")}, params)]
+            sig_file = os.path.join(fs_root, "fz_song_sigs", songs[0].song_id + ".pkl")
+            for databaser in databasers:
+                databaser.write_many(songs)
+                self.assertEqual(databaser.search(snippet)[0][0], songs[0].song_id)
+                version = databaser.version()
+
+                # a removed song is skipped straight away, but not purged
+                databaser.remove(songs[0].song_id)
+                self.assertNotEqual(databaser.version(), version)
+                self.assertIsNone(databaser.search(snippet))
+                self.assertIsNone(databaser.get_info(songs[0].song_id))
+                self.assertEqual([song[0] for song in databaser.list_db()], [songs[1].song_id])
+                self.assertEqual([song_id for song_id, _ in databaser.iterate_envelopes()],
+                                 [songs[1].song_id])
+                # nor is its stored audio readable
+                with self.assertRaises(KeyError):
+                    databaser.get_audio(songs[0].song_id)
+                self.assertEqual([audio is None for _, audio in databaser.iterate_audio(
+                                  [song.song_id for song in songs])], [True, False])
+                if isinstance(databaser, fzdb.FileSystemDB):
+                    self.assertTrue(os.path.exists(sig_file))
+                    # reopening the library doesn't take the files as orphans
+                    databaser = fzdb.FileSystemDB({"address": fs_root}, params)
+                    self.assertTrue(os.path.exists(sig_file))
+                else:
+                    conn = sqlite3.connect(os.path.join(db_root, "fz.db"))
+                    self.assertGreater(conn.execute(
+                        "SELECT count(*) FROM fz_song_hashes WHERE song_id = ?;",
+                        (songs[0].song_id,)).fetchone()[0], 0)
+
+                self.assertEqual(databaser.compact(), 1)
+                self.assertEqual(databaser.compact(), 0)
+                self.assertEqual([song[0] for song in databaser.list_db()], [songs[1].song_id])
+                if isinstance(databaser, fzdb.FileSystemDB):
+                    self.assertFalse(os.path.exists(sig_file))
+                else:
+                    for table in ["fz_song_library", "fz_song_signatures", "fz_song_hashes",
+                                  "fz_song_data", "fz_song_tombstones"]:
+                        self.assertEqual(conn.execute(
+                            "SELECT count(*) FROM " + table + " WHERE song_id = ?;",
+                            (songs[0].song_id,)).fetchone()[0], 0)
+                    conn.close()
+
+                # removed songs can be added again, before or after compaction
+                databaser.write(songs[0])
+                self.assertEqual(databaser.search(snippet)[0][0], songs[0].song_id)
+                databaser.remove(songs[0].song_id)
+                databaser.write(songs[0])
+                self.assertEqual(databaser.search(snippet)[0][0], songs[0].song_id)
+                self.assertEqual(databaser.compact(), 0)
+                self.assertEqual(len(databaser.list_db()), 2)
+        finally:
+            shutil.rmtree(db_root)
+
+    def test_paging(self):
+        db_root = tempfile.mkdtemp()
+        try:
+            params = TestHelpers.get_test_params()
+            song = fzsong.SongEntry(os.path.join(DATA_DIR, "wn_snip2.wav"))
+            databasers = [fzdb.FileSystemDB({"address": os.path.join(db_root, "fs")}, params),
+                          fzdb.SQLiteDB({"address": os.path.join(db_root, "fz.db")}, params)]
+            for databaser in databasers:
+                # the same analysis can be written under many ids
+                for k in range(0, 7):
+                    song.song_id = "song" + str(k)
+                    song.title = "even" if k % 2 == 0 else "odd"
+                    databaser.write(song)
+
+                ids = [row[0] for row in databaser.iterate()]
+                self.assertEqual(ids, ["song" + str(k) for k in range(0, 7)])
+                ids = [row[0] for row in databaser.list_db(limit=3, offset=2)]
+                self.assertEqual(ids, ["song2", "song3", "song4"])
+                ids = [row[0] for row in databaser.list_db(limit=2, after="song4")]
+                self.assertEqual(ids, ["song5", "song6"])
+                ids = [row[0] for row in databaser.list_db(filter="ODD", offset=1)]
+                self.assertEqual(ids, ["song3", "song5"])
+
+                # filters are plain substrings, wildcards and all
+                for k, title in enumerate(["100% pure", "1000 pure", "a_b", "axb", "c\\d"]):
+                    song.song_id = "tricky" + str(k)
+                    song.title = title
+                    databaser.write(song)
+                for text, expected in [("100%", ["tricky0"]), ("a_b", ["tricky2"]),
+                                       ("c\\d", ["tricky4"])]:
+                    ids = [row[0] for row in databaser.list_db(filter=text)]
+                    self.assertEqual(ids, expected)
+        finally:
+            shutil.rmtree(db_root)
+
+    def test_lookup(self):
+        db_root = tempfile.mkdtemp()
+        try:
+            params = TestHelpers.get_test_params()
+            song = fzsong.SongEntry(os.path.join(DATA_DIR, "wn_snip2.wav"))
+            databasers = [fzdb.FileSystemDB({"address": os.path.join(db_root, "fs")}, params),
+                          fzdb.SQLiteDB({"address": os.path.join(db_root, "fz.db")}, params)]
+            catalog = [("song0", "hey jude", "the beatles"), ("song1", "hey ya", "outkast"),
+                       ("song2", "help", "the beatles"), ("song3", "hey_jude", "cover band")]
+            for databaser in databasers:
+                self.assertEqual(databaser.lookup({"title": "hey jude"}), [])
+                for song.song_id, song.title, song.artist in catalog:
+                    databaser.write(song)
+
+                self.assertEqual(databaser.lookup({"title": "Hey Jude"}), ["song0"])
+                self.assertEqual(databaser.lookup({"title": "hey"}, prefix=True), 
+                                 ["song0", "song1", "song3"])
+                self.assertEqual(databaser.lookup({"title": "he", "artist": "the"}, prefix=True),
+                                 ["song0", "song2"])
+                databaser.remove("song0")
+                self.assertEqual(databaser.lookup({"artist": "the beatles"}), ["song2"])
+
+            # a lookup that fails finds nothing, rather than returning None
+            conn = sqlite3.connect(os.path.join(db_root, "fz.db"))
+            conn.execute("DROP TABLE fz_song_tombstones;")
+            conn.close()
+            self.assertEqual(databasers[1].lookup({"title": "help"}), [])
+        finally:
+            shutil.rmtree(db_root)
+
+    def test_plot(self):
+        db_root = tempfile.mkdtemp()
+        try:
+            params = TestHelpers.get_test_params()
+            db_settings = {"db_type": "sqlite", 
+                           "sqlite": {"address": os.path.join(db_root, "fz.db")}}
+            databaser = fzdb.get_databaser(db_settings, params)
+            song = fzsong.SongEntry(os.path.join(DATA_DIR, "wn_snip1.wav"), title="one")
+            databaser.write(song)
+
+            # a region of a song
+            plot_file = os.path.join(db_root, "region.png")
+            databaser.plot(song.song_id, plot_file, start=5, end=7.5, max_bins=64)
+            self.assertTrue(os.path.exists(plot_file))
+            freq, times, spec = fzcomp.compute_spectrogram(song.data, song.samp_rate, 
+                                                           max_bins=64, max_frames=100)
+            self.assertEqual(spec.shape, (65, len(times)))
+            self.assertLessEqual(len(times), 100)
+
+            # and many songs at once
+            plots = fzdb.plot_many(db_settings, params, [song.song_id, "missing"], 
+                                   os.path.join(db_root, "plots"), jobs=2)
+            self.assertEqual([song_id for song_id, _ in plots], [song.song_id, "missing"])
+            self.assertTrue(os.path.exists(plots[0][1]))
+            # a song that can't be plotted is reported, not written
+            self.assertIsNone(plots[1][1])
+            self.assertFalse(databaser.plot("missing", plot_file))
+        finally:
+            shutil.rmtree(db_root)
+
+    def test_downloads(self):
+        db_root = tempfile.mkdtemp(prefix="templates_")
+        download_dir = os.path.join(fzio.TEMP_DIR, "data")
+        os.makedirs(download_dir, exist_ok=True)
+        fd, download = tempfile.mkstemp(suffix="_wn_snip2.wav", dir=download_dir)
+        os.close(fd)
+        try:
+            # a song whose path only happens to contain "temp" is the user's
+            local = os.path.join(db_root, "wn_snip1.wav")
+            shutil.copy(os.path.join(DATA_DIR, "wn_snip1.wav"), local)
+            shutil.copy(os.path.join(DATA_DIR, "wn_snip2.wav"), download)
+            self.assertFalse(fzio.is_download(local))
+            self.assertTrue(fzio.is_download(download))
+
+            databaser = fzdb.SQLiteDB({"address": os.path.join(db_root, "fz.db")},
+                                      TestHelpers.get_test_params())
+            self.assertEqual(len(databaser.write_many([fzsong.SongEntry(local),
+                                                       fzsong.SongEntry(download)])), 2)
+            self.assertTrue(os.path.exists(local))
+            self.assertFalse(os.path.exists(download))
+        finally:
+            shutil.rmtree(db_root)
+            if os.path.exists(download):
+                os.remove(download)
+
+    def test_sharded_db(self):
+        db_root = tempfile.mkdtemp()
+        try:
+            shards = [{"db_type": "sqlite", 
+                       "sqlite": {"address": os.path.join(db_root, "fz" + str(k) + ".db")}}
+                      for k in range(0, 2)]
+            shards.append({"db_type": "file", "file": {"address": os.path.join(db_root, "fs")}})
+            databaser = fzdb.get_databaser({"db_type": "sharded", "sharded": {"shards": shards}},
+                                           TestHelpers.get_test_params())
+            songs = [fzsong.SongEntry(os.path.join(DATA_DIR, "wn_snip1.wav"), title="one"),
+                     fzsong.SongEntry(os.path.join(DATA_DIR, "wn_snip2.wav"), title="two")]
+            databaser.write_many(songs)
+
+            # each song lives on exactly one shard
+            for song in songs:
+                holders = [shard for shard in databaser.shards 
+                           if song.song_id in [row[0] for row in shard.list_db()]]
+                self.assertEqual(holders, [databaser.get_shard(song.song_id)])
+            self.assertEqual(sorted(song[1] for song in databaser.list_db()), ["one", "two"])
+
+            # searches are gathered from every shard
+            self.assertEqual(databaser.slow_search(songs[0])[0][0], songs[0].song_id)
+            sigs = dict((song.title, song.signature("maxpow")) for song in songs)
+            results = dict(databaser.batch_search(sigs))
+            self.assertEqual(results["two"][0][0], songs[1].song_id)
+
+            # a failing shard fails the search, instead of looking like no match
+            def fail(*args, **kwargs):
+                raise RuntimeError("shard down")
+                yield
+            databaser.shards[0].batch_search = fail
+            yielded = []
+            with self.assertRaises(RuntimeError):
+                for name, matches in databaser.batch_search(sigs):
+                    yielded.append(name)
+            self.assertEqual(yielded, [])
+            del databaser.shards[0].batch_search
+
+            databaser.remove(songs[0].song_id)
+            self.assertIsNone(databaser.slow_search(songs[0]))
+
+            # and so does a broken sql library
+            conn = sqlite3.connect(os.path.join(db_root, "fz0.db"))
+            conn.execute("DROP TABLE fz_song_signatures;")
+            conn.close()
+            with self.assertRaises(Exception):
+                databaser.shards[0].slow_search(songs[0])
+        finally:
+            shutil.rmtree(db_root)
+
+class TestFreezamIngest(unittest.TestCase):
+
+    def setUp(self):
+        # serve the test data over http from a local server
+        handler = functools.partial(http.server.SimpleHTTPRequestHandler, 
+                                    directory=DATA_DIR)
+        handler.log_message = lambda *args: None
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.db_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.db_root)
+
+    def test_pipeline(self):
+        databaser = fzdb.FileSystemDB({"address": self.db_root}, TestHelpers.get_test_params())
+        url = "http://127.0.0.1:{0}/".format(self.server.server_address[1])
+        songs = [(url + "wn_snip1.wav", {"title": "one"}),
+                 (url + "wn_snip2.wav", {"title": "two"}),
+                 (os.path.join(DATA_DIR, "wn_snip2.wav"), {"title": "local"}),
+                 (url + "missing.wav", {"title": "missing"})]
+
+        written = fzingest.ingest(songs, databaser, jobs=2, fetchers=2, queue_size=1)
+
+        # everything but the missing song is written
+        self.assertEqual(len(written), 3)
+        titles = sorted(song[1] for song in databaser.iterate())
+        self.assertEqual(titles, ["local", "one", "two"])
+
+        # only the songs the databaser commits are counted
+        class FailingDB(object):
+            def write_many(self, song_entries):
+                return []
+        self.assertEqual(fzingest.ingest(songs[2:3], FailingDB(), jobs=1), [])
+
+    def test_bad_files(self):
+        # a directory with a file that can't be read, like fz ingest walks
+        databaser = fzdb.FileSystemDB({"address": os.path.join(self.db_root, "fs")}, 
+                                      TestHelpers.get_test_params())
+        songs = [(os.path.join(DATA_DIR, f), {"title": f}) for f in sorted(os.listdir(DATA_DIR))]
+        self.assertIn("wn_full.mp3", [song[1]["title"] for song in songs])
+        written = fzingest.ingest(songs, databaser, jobs=2)
+        titles = sorted(song[1] for song in databaser.iterate())
+        self.assertEqual(len(written), len(titles))
+        self.assertIn("wn_snip1.wav", titles)
+        self.assertNotIn("wn_full.mp3", titles)
+
+class TestFreezamEval(unittest.TestCase):
+
+    def test_sweep(self):
+        self.assertEqual(fzeval.expand_sweep({"b": [1, 2], "a": [3]}), 
+                         [{"a": 3, "b": 1}, {"a": 3, "b": 2}])
+        self.assertEqual(fzeval.expand_sweep({}), [{}])
+        params = {}
+        fzeval.set_setting(params, "search.threshold_epsilon", 500)
+        self.assertEqual(params, {"search": {"threshold_epsilon": 500}})
+
+        # swept analysis settings reach the songs that are analysed
+        params = TestHelpers.get_test_params()
+        for key, value in [("periodograms.window_size", 5), ("periodograms.window_shift", 2),
+                           ("maxpow.octaves", 4)]:
+            fzeval.set_setting(params, key, value)
+        song = fzsong.SongEntry(os.path.join(DATA_DIR, "wn_snip1.wav"),
+                                **fzsong.get_analysis(params))
+        n_windows = len(range(0, len(song.data) - 5 * song.samp_rate + 1, 2 * song.samp_rate))
+        self.assertEqual(song.signature("maxpow").shape, (n_windows, 4))
+
+    def test_query(self):
+        rng = np.random.RandomState(0)
+        data = np.ones(8000 * 30)
+        snippet, start = fzeval.make_query(rng, data, 8000, length=12, gain=6, offset=False)
+        self.assertEqual(len(snippet), 12 * 8000)
+        self.assertEqual(start, int(start))
+        self.assertTrue(10 ** (-6 / 20) <= snippet[0] <= 10 ** (6 / 20))
+        snippet, _ = fzeval.make_query(rng, data, 8000, length=12, snr=0)
+        self.assertGreater(np.std(snippet), 0.5)
+
+    def test_evaluate(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            params = TestHelpers.get_test_params()
+            songs = fzeval.synthetic_library(work_dir, 3, seed=0, length=20)
+            negatives = fzeval.synthetic_library(work_dir, 1, seed=1, length=20)
+            reports = fzeval.evaluate_sweep(params, songs, negatives, 
+                                            {"search.sig_type": ["posfreq"]}, jobs=1,
+                                            augment={"snr": 30}, queries=4, negative_queries=2)
+            self.assertEqual(len(reports), 1)
+            self.assertEqual(reports[0]["recall@1"], 1.0)
+            self.assertEqual(reports[0]["false_positive_rate"], 0.0)
+            self.assertLessEqual(reports[0]["p50"], reports[0]["p99"])
+        finally:
+            shutil.rmtree(work_dir)
+
+class TestFreezamLog(unittest.TestCase):
+
+    def test_setup_logging(self):
+        root = logging.getLogger()
+        handlers, level = list(root.handlers), root.level
+        log_dir = tempfile.mkdtemp()
+        try:
+            log_file = os.path.join(log_dir, "freezam.log")
+            listener = fzlog.setup_logging(log_file, level="info", max_bytes=2000, backups=2)
+            logger = logging.getLogger("fz.test")
+            self.assertFalse(logger.isEnabledFor(logging.DEBUG))
+            for k in range(0, 100):
+                logger.info("message %d of %d", k, 100)
+            logger.debug("never written")
+            fzlog.stop_logging(listener)
+
+            # the log is rotated rather than growing without bound
+            self.assertEqual(sorted(os.listdir(log_dir)), 
+                             ["freezam.log", "freezam.log.1", "freezam.log.2"])
+            with open(log_file) as log:
+                lines = log.read().splitlines()
+            self.assertTrue(lines[-1].endswith("fz.test - INFO - message 99 of 100"))
+            self.assertLessEqual(os.path.getsize(log_file), 2000)
+            with self.assertRaises(ValueError):
+                fzlog.get_level("loud")
+        finally:
+            for handler in list(root.handlers):
+                root.removeHandler(handler)
+            for handler in handlers:
+                root.addHandler(handler)
+            root.setLevel(level)
+            shutil.rmtree(log_dir)
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file